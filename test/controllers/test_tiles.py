@@ -1,13 +1,22 @@
+import concurrent.futures
 import unittest
+from unittest.mock import patch
 
 from test.helpers import new_test_service_context, RequestParamsMock
+from xcube_server.cache import LruMemoryCache
 from xcube_server.context import ServiceContext
+from xcube_server.controllers import tiles
 from xcube_server.controllers.tiles import get_dataset_tile, get_ne2_tile, get_dataset_tile_grid, get_ne2_tile_grid, \
-    get_legend
+    get_legend, TileParams
 from xcube_server.defaults import API_PREFIX
 from xcube_server.errors import ServiceBadRequestError, ServiceResourceNotFoundError
 
 
+def _new_preload_executor():
+    # Leaving the executor's context waits for all preloading jobs to complete
+    return concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
 class TilesControllerTest(unittest.TestCase):
 
     def test_get_dataset_tile(self):
@@ -24,6 +33,11 @@ class TilesControllerTest(unittest.TestCase):
                                                                                           vmin='0.1', vmax='0.3'))
         self.assertIsInstance(tile, bytes)
 
+    def test_get_dataset_tile_with_nan_value_range(self):
+        ctx = new_test_service_context()
+        tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmin='nan', vmax='nan'))
+        self.assertIsInstance(tile, bytes)
+
     def test_get_dataset_tile_with_time_dim(self):
         ctx = new_test_service_context()
         tile = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(time='2017-01-26'))
@@ -40,6 +54,84 @@ class TilesControllerTest(unittest.TestCase):
                          "dimension 'time' of variable 'conc_tsm' of dataset 'demo'",
                          cm.exception.reason)
 
+    def test_get_dataset_tile_from_tile_cache(self):
+        ctx = new_test_service_context()
+        ctx.mem_tile_cache = LruMemoryCache(capacity=2 ** 20)
+        tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        self.assertIsInstance(tile_1, bytes)
+        self.assertIn('rgb-demo-0-conc_tsm-time=2017-01-16T10:09:21.834255872-cbar=PuBuGn-vmin=0.0-vmax=100.0/0/0', ctx.mem_tile_cache)
+
+        # Cached tiles must be found without a tiled image
+        ctx.image_cache.clear()
+        tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        self.assertIs(tile_1, tile_2)
+        self.assertEqual(0, ctx.image_cache.size)
+
+    def test_get_dataset_tile_preloads_top_levels(self):
+        ctx = new_test_service_context()
+        ctx.mem_tile_cache = LruMemoryCache(capacity=2 ** 20)
+        with _new_preload_executor() as executor, patch.object(tiles, '_PRELOAD_EXECUTOR', executor):
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        tile_id = 'rgb-demo-0-conc_tsm-time=2017-01-16T10:09:21.834255872-cbar=PuBuGn-vmin=0.0-vmax=100.0/1/0'
+        self.assertIn(tile_id, ctx.mem_tile_cache)
+
+    def test_get_dataset_tile_preloads_neighbors(self):
+        ctx = new_test_service_context()
+        ctx.mem_tile_cache = LruMemoryCache(capacity=2 ** 24)
+        with _new_preload_executor() as executor, patch.object(tiles, '_PRELOAD_EXECUTOR', executor):
+            get_dataset_tile(ctx, 'demo', 'conc_tsm', '1', '1', '2', RequestParamsMock())
+        image_id = 'rgb-demo-2-conc_tsm-time=2017-01-16T10:09:21.834255872-cbar=PuBuGn-vmin=0.0-vmax=100.0'
+        tile_ids = [f'{image_id}/{x}/{y}'
+                    for x, y in ((0, 0), (1, 0), (2, 0), (0, 1), (2, 1), (0, 2), (1, 2), (2, 2))]
+        for tile_id in tile_ids:
+            self.assertIn(tile_id, ctx.mem_tile_cache)
+        self.assertNotIn(f'{image_id}/3/1', ctx.mem_tile_cache)
+
+    def test_image_cache_is_bounded(self):
+        ctx = new_test_service_context()
+        ctx.image_cache = LruMemoryCache(capacity=1, size_function=lambda image: 1)
+        get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        get_dataset_tile(ctx, 'demo', 'conc_chl', '0', '0', '0', RequestParamsMock())
+        self.assertEqual(1, ctx.image_cache.size)
+
+    def test_get_dataset_tile_with_different_color_mappings(self):
+        ctx = new_test_service_context()
+        ctx.mem_tile_cache = LruMemoryCache(capacity=2 ** 24)
+        tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(cbar='plasma'))
+        tile_3 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock(vmax='50'))
+        self.assertNotEqual(tile_1, tile_2)
+        self.assertNotEqual(tile_1, tile_3)
+        self.assertNotEqual(tile_2, tile_3)
+        self.assertEqual(3, ctx.image_cache.size)
+
+    def test_get_dataset_tile_with_equal_times(self):
+        ctx = new_test_service_context()
+        tile_1 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0', RequestParamsMock())
+        tile_2 = get_dataset_tile(ctx, 'demo', 'conc_tsm', '0', '0', '0',
+                                  RequestParamsMock(time='2017-01-16T10:09:21.834255872'))
+        self.assertEqual(tile_1, tile_2)
+        self.assertEqual(1, ctx.image_cache.size)
+
+    def test_tile_params(self):
+        tile_params = TileParams.from_request_params('3', '1', '2', RequestParamsMock(cbar='plasma', vmax='0.3'),
+                                                     default_tile_comp_mode=1)
+        self.assertEqual((3, 1, 2), (tile_params.x, tile_params.y, tile_params.z))
+        self.assertEqual(1, tile_params.tile_comp_mode)
+        self.assertEqual(False, tile_params.trace_perf)
+        self.assertEqual('plasma', tile_params.cmap_cbar)
+        self.assertEqual(None, tile_params.cmap_vmin)
+        self.assertEqual(0.3, tile_params.cmap_vmax)
+
+        tile_params = TileParams.from_request_params('0', '0', '0', RequestParamsMock(mode='0', debug='1'),
+                                                     default_tile_comp_mode=1)
+        self.assertEqual(0, tile_params.tile_comp_mode)
+        self.assertEqual(True, tile_params.trace_perf)
+
+        with self.assertRaises(ServiceBadRequestError) as cm:
+            TileParams.from_request_params('0', 'x', '0', RequestParamsMock())
+        self.assertEqual("""Parameter "y" must be an integer, but was 'x'""", cm.exception.reason)
+
     def test_get_ne2_tile(self):
         ctx = new_test_service_context()
         tile = get_ne2_tile(ctx, '0', '0', '0', RequestParamsMock())
@@ -17,3 +17,14 @@ class WmtsControllerTest(unittest.TestCase):
         # print(capabilities)
         # print(80 * '=')
         self.assertEqual(expected_capabilities.replace(' ', ''), capabilities.replace(' ', ''))
+
+    def test_get_wmts_capabilities_xml_is_escaped(self):
+        ctx = new_test_service_context()
+        service_provider = dict(ctx.config['ServiceProvider'], ProviderName='Brockmann & <Partners>')
+        ctx.config = dict(ctx.config, ServiceProvider=service_provider)
+        ctx.get_dataset('demo')['conc_chl'].attrs['long_name'] = 'Chl "a" & more'
+        capabilities = get_wmts_capabilities_xml(ctx, 'http://bibo?a="b"&c')
+        self.assertIn('<ows:ProviderName>Brockmann &amp; &lt;Partners&gt;</ows:ProviderName>', capabilities)
+        self.assertIn('<ows:Title>Chl "a" &amp; more</ows:Title>', capabilities)
+        self.assertIn('xlink:href="http://bibo?a=&quot;b&quot;&amp;c/', capabilities)
+        self.assertNotIn('Chl "a" & more', capabilities)
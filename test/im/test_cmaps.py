@@ -1,10 +1,21 @@
 from unittest import TestCase
 
-from xcube_server.im.cmaps import get_cmaps
+import numpy as np
+
+from xcube_server.im.cmaps import get_cmaps, get_cmap_colors
 
 
 class CmapsTest(TestCase):
 
+    def test_get_cmap_colors(self):
+        colors = get_cmap_colors('plasma', 16)
+        self.assertEqual((16, 4), colors.shape)
+        self.assertEqual(np.uint8, colors.dtype)
+        self.assertTrue(colors.flags.c_contiguous)
+        self.assertFalse(colors.flags.writeable)
+        np.testing.assert_equal(colors[-1], np.array([239, 248, 33, 255], dtype=np.uint8))
+        self.assertIs(colors, get_cmap_colors('plasma', 16))
+
     def test_get_cmaps_returns_singleton(self):
         cmaps = get_cmaps()
         self.assertIs(cmaps, get_cmaps())
@@ -1,9 +1,15 @@
+import io
 from unittest import TestCase
 
+import dask.array as da
 import numpy as np
+import xarray as xr
+from PIL import Image
 from xcube_server.im import TileGrid, GLOBAL_GEO_EXTENT
 from xcube_server.im.tiledimage import ImagePyramid, OpImage, create_ndarray_downsampling_image, \
-    TransformArrayImage, FastNdarrayDownsamplingImage, trim_tile
+    TransformArrayImage, FastNdarrayDownsamplingImage, trim_tile, encode_image, map_colors_lut, \
+    encode_transparent_image, ColorMappedRgbaImage, ColorMappedRgbaImage2, NdarrayImage, compute_tile_data, \
+    mask_array, quantize_array, map_palette_indices, QUANTIZED_NO_DATA
 from xcube_server.im.utils import aggregate_ndarray_mean
 
 
@@ -170,6 +176,148 @@ class TrimTileTest(TestCase):
                                              [3., 4., 5., np.nan],
                                              [np.nan, np.nan, np.nan, np.nan]]))
 
+    def test_trim_tile_keeps_integer_type(self):
+        a = np.arange(0, 6, dtype=np.uint16)
+        a.shape = 2, 3
+        b = trim_tile(a, (4, 3), fill_value=9)
+        self.assertEqual(np.uint16, b.dtype)
+        np.testing.assert_equal(b, np.array([[0, 1, 2, 9],
+                                             [3, 4, 5, 9],
+                                             [9, 9, 9, 9]]))
+        b = trim_tile(a, (4, 3))
+        self.assertEqual(np.float64, b.dtype)
+
+
+class EncodeImageTest(TestCase):
+    def test_encode_image(self):
+        a = np.zeros((16, 32, 4), dtype=np.uint8)
+        a[..., 0] = np.arange(32, dtype=np.uint8)
+        a[..., 3] = 255
+        image = Image.fromarray(a, mode='RGBA')
+
+        encoded_image = encode_image(image, 'PNG')
+        self.assertIsInstance(encoded_image, bytes)
+        self.assertEqual(b'\x89PNG', encoded_image[0:4])
+        decoded_image = Image.open(io.BytesIO(encoded_image))
+        self.assertEqual((32, 16), decoded_image.size)
+        np.testing.assert_equal(np.array(decoded_image), a)
+
+        encoded_image = encode_image(image.convert('RGB'), 'JPEG')
+        self.assertEqual(b'\xff\xd8', encoded_image[0:2])
+
+
+class EncodeTransparentImageTest(TestCase):
+    def test_encode_transparent_image(self):
+        encoded_image = encode_transparent_image((32, 16), 'PNG')
+        self.assertIs(encoded_image, encode_transparent_image((32, 16), 'PNG'))
+        decoded_image = Image.open(io.BytesIO(encoded_image))
+        self.assertEqual('RGBA', decoded_image.mode)
+        np.testing.assert_equal(np.array(decoded_image), np.zeros((16, 32, 4), dtype=np.uint8))
+
+    def test_transparent_tiles_are_encoded_once(self):
+        array = np.full((16, 32), np.nan)
+        array[0:8, 0:16] = 0.5
+        image = ColorMappedRgbaImage2(array, tile_size=(16, 8), cmap_name='jet', encode=True, format='PNG')
+        self.assertIsNot(encode_transparent_image((16, 8), 'PNG'), image.get_tile(0, 0))
+        self.assertIs(encode_transparent_image((16, 8), 'PNG'), image.get_tile(1, 0))
+        self.assertIs(encode_transparent_image((16, 8), 'PNG'), image.get_tile(1, 1))
+
+
+class ComputeTileDataTest(TestCase):
+    def test_compute_tile_data(self):
+        a = np.arange(64, dtype=np.float64).reshape((8, 8))
+        self.assertIs(a, compute_tile_data(a))
+
+        tile = compute_tile_data(da.from_array(a, chunks=(4, 4)))
+        self.assertIsInstance(tile, np.ndarray)
+        np.testing.assert_equal(tile, a)
+
+        tile = compute_tile_data(xr.DataArray(a, dims=('y', 'x')).chunk(dict(x=2, y=2))[2:6, 2:6])
+        self.assertIsInstance(tile, xr.DataArray)
+        self.assertIsInstance(tile.data, np.ndarray)
+        np.testing.assert_equal(tile.values, a[2:6, 2:6])
+
+
+class MapColorsLutTest(TestCase):
+    def test_map_colors_lut(self):
+        packed_colors = np.array([10, 20, 30, 40], dtype=np.uint32)
+        values = np.array([-1.0, 0.0, 0.3, 0.6, 0.99, 1.0, 2.0, np.nan, -999.0, 0.5])
+        mask = np.array([False, False, False, False, False, False, False, False, False, True])
+        packed_rgba = np.full(values.size, 1, dtype=np.uint32)
+        map_colors_lut(values, mask, 0.0, 1.0, -999.0, packed_colors, packed_rgba)
+        np.testing.assert_equal(packed_rgba, np.array([10, 10, 20, 30, 40, 40, 40, 0, 0, 0], dtype=np.uint32))
+
+
+class QuantizeArrayTest(TestCase):
+    def test_quantize_array(self):
+        values = np.array([[-1.0, 0.0, 0.3, 0.6, 0.99], [1.0, 2.0, np.nan, -999.0, 0.5]])
+        indices = quantize_array(np.ma.masked_equal(values, 0.5), (0.0, 1.0), num_colors=4, no_data_value=-999.0)
+        self.assertEqual(np.uint16, indices.dtype)
+        n = QUANTIZED_NO_DATA
+        np.testing.assert_equal(indices, np.array([[0, 0, 1, 2, 3], [3, 3, n, n, n]], dtype=np.uint16))
+
+    def test_color_mapped_quantized_image(self):
+        array = np.linspace(-0.5, 1.5, 16 * 30, dtype=np.float32).reshape((16, 30))
+        array[3:5, 2:9] = np.nan
+        array[10, 20] = -999.0
+
+        def new_image(source_array, fill_value, quantized):
+            source_image = TransformArrayImage(NdarrayImage(source_array, tile_size=(8, 8), fill_value=fill_value),
+                                               flip_y=True, force_masked=not quantized, no_data_value=-999.0)
+            return ColorMappedRgbaImage(source_image, value_range=(0.0, 1.0), cmap_name='plasma',
+                                        no_data_value=-999.0, encode=True, format='PNG', quantized=quantized)
+
+        index_array = quantize_array(mask_array(array, no_data_value=-999.0), (0.0, 1.0), no_data_value=-999.0)
+        image = new_image(array, np.nan, False)
+        quantized_image = new_image(index_array, QUANTIZED_NO_DATA, True)
+        for tile_y in range(2):
+            for tile_x in range(4):
+                np.testing.assert_equal(_decode_rgba(quantized_image.get_tile(tile_x, tile_y)),
+                                        _decode_rgba(image.get_tile(tile_x, tile_y)))
+
+
+class ColorMappedRgbaImageTest(TestCase):
+    @staticmethod
+    def new_image(array, num_colors, encode):
+        return ColorMappedRgbaImage(NdarrayImage(array, tile_size=(32, 16)),
+                                    value_range=(0.0, 1.0), cmap_name='plasma', num_colors=num_colors,
+                                    encode=encode, format='PNG' if encode else None)
+
+    def test_palette_png(self):
+        array = np.linspace(0.0, 1.0, 16 * 32).reshape((16, 32))
+        array[2:6, 3:7] = np.nan
+        tile = self.new_image(array, 256, True).get_tile(0, 0)
+        decoded_image = Image.open(io.BytesIO(tile))
+        self.assertEqual('P', decoded_image.mode)
+        np.testing.assert_equal(_decode_rgba(tile),
+                                np.array(self.new_image(array, 256, False).get_tile(0, 0)))
+
+    def test_rgba_png_if_palette_too_small(self):
+        array = np.linspace(0.0, 1.0, 16 * 32).reshape((16, 32))
+        tile = self.new_image(array, 512, True).get_tile(0, 0)
+        decoded_image = Image.open(io.BytesIO(tile))
+        self.assertEqual('RGBA', decoded_image.mode)
+        np.testing.assert_equal(np.array(decoded_image),
+                                np.array(self.new_image(array, 512, False).get_tile(0, 0)))
+
+    def test_transparent_tile(self):
+        array = np.full((16, 32), np.nan)
+        self.assertIs(encode_transparent_image((32, 16), 'PNG'), self.new_image(array, 256, True).get_tile(0, 0))
+
+
+class MapPaletteIndicesTest(TestCase):
+    def test_map_palette_indices(self):
+        color_indices = np.array([[5, 3, 5], [QUANTIZED_NO_DATA, 3, 7]], dtype=np.uint16)
+        palette_image = np.zeros((2, 3), dtype=np.uint8)
+        palette_indices = np.zeros(9, dtype=np.int32)
+        self.assertEqual(4, map_palette_indices(color_indices, 8, palette_image, palette_indices))
+        np.testing.assert_equal(palette_image, np.array([[0, 1, 0], [2, 1, 3]]))
+        np.testing.assert_equal(palette_indices[0:4], np.array([5, 3, 8, 7]))
+
+        color_indices = np.arange(300, dtype=np.uint16).reshape((20, 15))
+        self.assertEqual(257, map_palette_indices(color_indices, 300, np.zeros((20, 15), dtype=np.uint8),
+                                                  np.zeros(301, dtype=np.int32)))
+
 
 class ImagePyramidTest(TestCase):
     def test_create_from_image(self):
@@ -307,3 +455,7 @@ class ImagePyramidTest(TestCase):
         self.assertEqual((1, 270, 270), tile_0_1_0.shape)
         self.assertAlmostEqual(0, tile_0_1_0[..., 0, 0])
         self.assertAlmostEqual(0, tile_0_1_0[..., 269, 269])
+
+
+def _decode_rgba(encoded_image: bytes) -> np.ndarray:
+    return np.array(Image.open(io.BytesIO(encoded_image)).convert('RGBA'))
@@ -1,5 +1,12 @@
 import unittest
 
+from tornado.httputil import HTTPServerRequest
+
+from xcube_server.app import new_application
+from xcube_server.defaults import API_PREFIX
+from xcube_server.handlers import GetDatasetsHandler, GetColorBarsHtmlHandler, GetDatasetHandler, \
+    GetDatasetVarTileHandler, GetNE2TileHandler
+
 
 class AppSmokeTest(unittest.TestCase):
 
@@ -11,3 +18,40 @@ class AppSmokeTest(unittest.TestCase):
         # service.stop()
         # IOLoop.current().call_later(0.1, service.stop)
         # service.start()
+
+    def test_find_handler(self):
+        application = new_application()
+        prefix = f'/xcube{API_PREFIX}'
+
+        def find_handler(uri):
+            return application.find_handler(HTTPServerRequest(method='GET', uri=prefix + uri))
+
+        def find_handler_class(uri):
+            return find_handler(uri).handler_class
+
+        self.assertIs(GetDatasetsHandler, find_handler_class('/datasets'))
+        self.assertIs(GetDatasetsHandler, find_handler_class('/datasets?details=1'))
+        self.assertIs(GetColorBarsHtmlHandler, find_handler_class('/colorbars.html'))
+        self.assertIs(GetDatasetHandler, find_handler_class('/datasets/demo'))
+
+        delegate = find_handler('/datasets/demo%201/vars/conc_chl/tiles/2/1/0.png')
+        self.assertIs(GetDatasetVarTileHandler, delegate.handler_class)
+        self.assertEqual({'ds_id': b'demo 1', 'var_name': b'conc_chl', 'z': b'2', 'x': b'1', 'y': b'0'},
+                         delegate.path_kwargs)
+        delegate = find_handler('/wmts/1.0.0/tile/demo/conc_chl/2/1/0.png')
+        self.assertIs(GetDatasetVarTileHandler, delegate.handler_class)
+        self.assertEqual({'ds_id': b'demo', 'var_name': b'conc_chl', 'z': b'2', 'y': b'1', 'x': b'0'},
+                         delegate.path_kwargs)
+        # Served from the dispatch cache
+        delegate = find_handler('/datasets/demo%201/vars/conc_chl/tiles/2/1/0.png')
+        self.assertIs(GetDatasetVarTileHandler, delegate.handler_class)
+        self.assertEqual({'ds_id': b'demo 1', 'var_name': b'conc_chl', 'z': b'2', 'x': b'1', 'y': b'0'},
+                         delegate.path_kwargs)
+        delegate = find_handler('/ne2/tiles/2/1/0.jpg')
+        self.assertIs(GetNE2TileHandler, delegate.handler_class)
+        self.assertEqual({'z': b'2', 'x': b'1', 'y': b'0'}, delegate.path_kwargs)
+        delegate = find_handler('/datasets/demo/vars/conc_chl/tiles/2/1/0.jpg')
+        self.assertEqual(404, delegate.handler_kwargs['status_code'])
+        self.assertEqual(404, find_handler('/datasets/demo/').handler_kwargs['status_code'])
+        delegate = application.find_handler(HTTPServerRequest(method='GET', uri='/datasets/demo/coords/time'))
+        self.assertEqual(404, delegate.handler_kwargs['status_code'])
@@ -2,7 +2,7 @@ import os
 import shutil
 from unittest import TestCase
 
-from xcube_server.cache import CacheStore, Cache, MemoryCacheStore, FileCacheStore
+from xcube_server.cache import CacheStore, Cache, MemoryCacheStore, FileCacheStore, LruMemoryCache
 
 
 class MemoryCacheStoreTest(TestCase):
@@ -188,3 +188,64 @@ class CacheTest(TestCase):
         self.assertEqual(cache.get_value('k5'), 'yyyy')
         self.assertEqual(cache.size, 600)
         self.assertEqual(cache_store.trace, 'can_load_from_key(k5);load_from_key(k5);restore(k5, S/yyyy);')
+
+
+class LruMemoryCacheTest(TestCase):
+
+    def test_put_and_get_and_remove(self):
+        cache = LruMemoryCache(capacity=3, size_function=len)
+        self.assertEqual(cache.capacity, 3)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.get_value('k1'), None)
+
+        cache.put_value('k1', 'x')
+        cache.put_value('k2', 'xx')
+        self.assertEqual(cache.get_value('k1'), 'x')
+        self.assertEqual(cache.get_value('k2'), 'xx')
+        self.assertEqual(cache.size, 3)
+        self.assertIn('k1', cache)
+
+        cache.put_value('k2', 'y')
+        self.assertEqual(cache.get_value('k2'), 'y')
+        self.assertEqual(cache.size, 2)
+
+        cache.remove_value('k2')
+        self.assertEqual(cache.get_value('k2'), None)
+        self.assertEqual(cache.size, 1)
+
+        cache.put_value('k3', 'z')
+        cache.remove_values(lambda key: key != 'k3')
+        self.assertNotIn('k1', cache)
+        self.assertIn('k3', cache)
+        self.assertEqual(cache.size, 1)
+
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+        self.assertNotIn('k3', cache)
+
+    def test_discards_least_recently_used_one_by_one(self):
+        cache = LruMemoryCache(capacity=3, size_function=len)
+        cache.put_value('k1', 'x')
+        cache.put_value('k2', 'x')
+        cache.put_value('k3', 'x')
+        # Touch k1 so that k2 becomes the least recently used
+        self.assertEqual(cache.get_value('k1'), 'x')
+
+        cache.put_value('k4', 'x')
+        self.assertEqual(cache.size, 3)
+        self.assertNotIn('k2', cache)
+        self.assertIn('k1', cache)
+        self.assertIn('k3', cache)
+        self.assertIn('k4', cache)
+
+        cache.put_value('k5', 'xx')
+        self.assertEqual(cache.size, 3)
+        self.assertNotIn('k3', cache)
+        self.assertNotIn('k1', cache)
+        self.assertIn('k4', cache)
+        self.assertIn('k5', cache)
+
+        # Values larger than the capacity are not cached
+        cache.put_value('k6', 'xxxx')
+        self.assertNotIn('k6', cache)
+        self.assertEqual(cache.size, 3)
@@ -1,9 +1,16 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest.mock import MagicMock, patch
 
+import numpy as np
 import xarray as xr
 
-from test.helpers import new_test_service_context
-from xcube_server.errors import ServiceResourceNotFoundError
+from test.helpers import new_test_service_context, get_res_test_dir, RequestParamsMock
+from xcube_server.context import ServiceContext, _get_local_dataset_tag, _get_obs_dataset_tag
+from xcube_server.errors import ServiceBadRequestError, ServiceResourceNotFoundError
 
 
 class ServiceContextTest(unittest.TestCase):
@@ -38,6 +45,159 @@ class ServiceContextTest(unittest.TestCase):
         self.assertNotIn('demo', ctx.dataset_cache)
         self.assertNotIn('demo2', ctx.dataset_cache)
 
+    def test_config_and_response_cache(self):
+        ctx = new_test_service_context()
+        ctx.response_cache.put_value('wmts', (0, 'etag', b'<Capabilities/>'))
+        ctx.config = dict(ctx.config)
+        self.assertNotIn('wmts', ctx.response_cache)
+
+    def test_datasets_version(self):
+        ctx = new_test_service_context()
+        datasets_version = ctx.datasets_version
+        ctx.get_dataset('demo')
+        self.assertNotEqual(datasets_version, ctx.datasets_version)
+        datasets_version = ctx.datasets_version
+        ctx.get_dataset('demo')
+        self.assertEqual(datasets_version, ctx.datasets_version)
+
+        # Reopened, but unchanged
+        ctx.dataset_cache.clear()
+        ctx.get_dataset('demo')
+        self.assertEqual(datasets_version, ctx.datasets_version)
+
+        # Reopened and changed
+        ctx.dataset_cache.clear()
+        with patch('xcube_server.context._get_local_dataset_tag', return_value='changed'):
+            ctx.get_dataset('demo')
+        self.assertNotEqual(datasets_version, ctx.datasets_version)
+
+    def test_get_dataset_tag(self):
+        ctx1 = new_test_service_context()
+        ctx2 = new_test_service_context()
+        # Equal in all processes
+        self.assertEqual(ctx1.get_dataset_tag('demo'), ctx2.get_dataset_tag('demo'))
+
+    def test_get_local_dataset_tag(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(temp_dir, 'cube.nc')
+            with open(file_path, 'w') as fp:
+                fp.write('x')
+            os.utime(file_path, ns=(0, 1000))
+            self.assertEqual('3e8-1', _get_local_dataset_tag(file_path))
+
+            zarr_path = os.path.join(temp_dir, 'cube.zarr')
+            os.mkdir(zarr_path)
+            self.assertIsNotNone(_get_local_dataset_tag(zarr_path))
+            with open(os.path.join(zarr_path, '.zmetadata'), 'w') as fp:
+                fp.write('{}')
+            os.utime(os.path.join(zarr_path, '.zmetadata'), ns=(0, 2000))
+            self.assertEqual('7d0-2', _get_local_dataset_tag(zarr_path))
+
+            self.assertIsNone(_get_local_dataset_tag(os.path.join(temp_dir, 'missing.nc')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_obs_dataset_tag(self):
+        obs_file_system = MagicMock()
+        obs_file_system.info.return_value = {'ETag': '"8c1f"', 'LastModified': '2019-02-01'}
+        self.assertEqual('8c1f', _get_obs_dataset_tag(obs_file_system, 'bucket/cube.zarr'))
+        obs_file_system.info.assert_called_once_with('bucket/cube.zarr/.zmetadata')
+
+        obs_file_system.info.side_effect = [FileNotFoundError(), {'LastModified': '2019-02-01'}]
+        self.assertEqual('2019-02-01', _get_obs_dataset_tag(obs_file_system, 'bucket/cube.zarr'))
+
+        obs_file_system.info.side_effect = FileNotFoundError()
+        self.assertIsNone(_get_obs_dataset_tag(obs_file_system, 'bucket/cube.zarr'))
+
+    def test_config_tag(self):
+        ctx1 = ServiceContext(config=dict(Datasets=[dict(Identifier='demo', Path='cube.nc')], Styles=[]))
+        ctx2 = ServiceContext(config=dict(Styles=[], Datasets=[dict(Path='cube.nc', Identifier='demo')]))
+        self.assertEqual(ctx1.config_tag, ctx2.config_tag)
+        ctx2.config = dict(Styles=[], Datasets=[dict(Path='cube2.nc', Identifier='demo')])
+        self.assertNotEqual(ctx1.config_tag, ctx2.config_tag)
+
+    def test_dataset_cache_capacity(self):
+        ctx = ServiceContext(base_dir=get_res_test_dir(), dataset_cache_capacity=2)
+        ctx.config = dict(Datasets=[
+            dict(Identifier='demo',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+            dict(Identifier='demo2',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+            dict(Identifier='demo3',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+        ])
+        ctx.get_dataset('demo')
+        ctx.get_dataset('demo2')
+        ctx.get_dataset('demo')
+        ctx.get_dataset('demo3')
+        self.assertEqual(['demo', 'demo3'], list(ctx.dataset_cache.keys()))
+
+        # Discarded datasets are opened again on demand
+        self.assertIsInstance(ctx.get_dataset('demo2'), xr.Dataset)
+        self.assertEqual(['demo3', 'demo2'], list(ctx.dataset_cache.keys()))
+
+    def test_dataset_cache_capacity_is_unlimited_by_default(self):
+        ctx = ServiceContext(base_dir=get_res_test_dir())
+        ctx.config = dict(Datasets=[dict(Identifier=f'demo{i}', Path="../../../xcube_server/res/demo/cube.nc")
+                                    for i in range(3)])
+        for i in range(3):
+            ctx.get_dataset(f'demo{i}')
+        self.assertEqual(['demo0', 'demo1', 'demo2'], list(ctx.dataset_cache.keys()))
+
+    def test_dataset_cache_capacity_does_not_close_discarded_datasets(self):
+        ctx = ServiceContext(base_dir=get_res_test_dir(), dataset_cache_capacity=1)
+        ctx.config = dict(Datasets=[
+            dict(Identifier='demo',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+            dict(Identifier='demo2',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+        ])
+        # Requests in progress may still read from it
+        ml_dataset = ctx.get_ml_dataset('demo')
+        with patch.object(ml_dataset, 'close') as close:
+            ctx.get_dataset('demo2')
+        self.assertNotIn('demo', ctx.dataset_cache)
+        close.assert_not_called()
+
+    def test_cached_dataset_not_blocked_by_opening_dataset(self):
+        ctx = new_test_service_context()
+        ml_dataset = ctx.get_ml_dataset('demo')
+
+        opening = threading.Event()
+        opened = threading.Event()
+
+        def open_dataset_slowly():
+            # Held while another dataset is opened
+            with ctx._lock:
+                opening.set()
+                opened.wait(timeout=10)
+
+        thread = threading.Thread(target=open_dataset_slowly)
+        thread.start()
+        try:
+            opening.wait(timeout=10)
+            self.assertIs(ml_dataset, ctx.get_ml_dataset('demo'))
+        finally:
+            opened.set()
+            thread.join()
+
+    def test_dataset_cache_capacity_discards_images(self):
+        ctx = ServiceContext(base_dir=get_res_test_dir(), dataset_cache_capacity=1)
+        ctx.config = dict(Datasets=[
+            dict(Identifier='demo',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+            dict(Identifier='demo2',
+                 Path="../../../xcube_server/res/demo/cube.nc"),
+        ])
+        ctx.get_dataset('demo')
+        ctx.image_cache.put_value(('demo', 0, 'conc_chl'), 'image')
+        ctx.image_cache.put_value(('demo2', 0, 'conc_chl'), 'image')
+        ctx.get_dataset('demo2')
+        # Images of the discarded dataset are gone
+        self.assertNotIn(('demo', 0, 'conc_chl'), ctx.image_cache)
+        self.assertIn(('demo2', 0, 'conc_chl'), ctx.image_cache)
+
     def test_get_dataset_and_variable(self):
         ctx = new_test_service_context()
         ds, var = ctx.get_dataset_and_variable('demo', 'conc_tsm')
@@ -54,6 +214,45 @@ class ServiceContextTest(unittest.TestCase):
         self.assertEqual(404, cm.exception.status_code)
         self.assertEqual('Variable "conc_ys" not found in dataset "demo"', cm.exception.reason)
 
+    def test_get_dataset_descriptor(self):
+        ctx = new_test_service_context()
+        self.assertEqual('demo', ctx.get_dataset_descriptor('demo')['Identifier'])
+        with self.assertRaises(ServiceResourceNotFoundError) as cm:
+            ctx.get_dataset_descriptor('demox')
+        self.assertEqual('Dataset "demox" not found', cm.exception.reason)
+
+        ctx.config = dict(ctx.config, Datasets=[dict(Identifier='demox', Path='cube.nc'),
+                                                dict(Identifier='demox', Path='cube2.nc')])
+        self.assertEqual('cube.nc', ctx.get_dataset_descriptor('demox')['Path'])
+        with self.assertRaises(ServiceResourceNotFoundError):
+            ctx.get_dataset_descriptor('demo')
+
+    def test_get_var_indexers(self):
+        var = xr.DataArray(np.zeros((2, 2, 2)), dims=['time', 'depth', 'band'],
+                           coords=dict(time=np.array(['2017-01-16', '2017-01-25'], dtype='datetime64[ns]'),
+                                       depth=np.array([0.5, 1.5]),
+                                       band=np.array([1, 2], dtype=np.uint8)))
+        dim_names = ['time', 'depth', 'band']
+
+        var_indexers = ServiceContext.get_var_indexers('demo', 'x', var, dim_names, RequestParamsMock())
+        self.assertEqual(dict(time=np.datetime64('2017-01-16', 'ns'), depth=0.5, band=1), var_indexers)
+
+        var_indexers = ServiceContext.get_var_indexers('demo', 'x', var, dim_names,
+                                                       RequestParamsMock(time='2017-01-20T12:00:00Z',
+                                                                         depth='1', band='current'))
+        self.assertEqual(dict(time=np.datetime64('2017-01-20T12:00:00', 'ns'), depth=1.0, band=2), var_indexers)
+        self.assertIsInstance(var_indexers['time'], np.datetime64)
+        self.assertIsInstance(var_indexers['depth'], float)
+
+        with self.assertRaises(ServiceBadRequestError) as cm:
+            ServiceContext.get_var_indexers('demo', 'x', var, dim_names, RequestParamsMock(band='1.5'))
+        self.assertEqual("'1.5' is not a valid value for dimension 'band' of variable 'x' of dataset 'demo'",
+                         cm.exception.reason)
+
+        var = var.assign_coords(band=['red', 'green'])
+        with self.assertRaises(ServiceBadRequestError):
+            ServiceContext.get_var_indexers('demo', 'x', var, dim_names, RequestParamsMock(band='red'))
+
     def test_get_color_mapping(self):
         ctx = new_test_service_context()
         cm = ctx.get_color_mapping('demo', 'conc_chl')
@@ -62,9 +261,25 @@ class ServiceContextTest(unittest.TestCase):
         self.assertEqual(('PuBuGn', 0., 100.), cm)
         cm = ctx.get_color_mapping('demo', 'kd489')
         self.assertEqual(('jet', 0., 6.), cm)
-        cm = ctx.get_color_mapping('demo', '_')
+        with self.assertLogs('xcube', level='WARNING') as logs:
+            cm = ctx.get_color_mapping('demo', '_')
+            self.assertEqual(('jet', 0., 1.), cm)
+            cm = ctx.get_color_mapping('demo', '_')
+            self.assertEqual(('jet', 0., 1.), cm)
+        self.assertEqual(1, len(logs.output))
+        # Defaults of unknown variables are not stored
+        self.assertNotIn(('demo', '_'), ctx._color_mappings)
+
+        ctx.config = dict(ctx.config, Styles=[dict(Identifier='default',
+                                                   ColorMappings=dict(conc_chl=dict(ColorBar='viridis')))])
+        cm = ctx.get_color_mapping('demo', 'conc_chl')
+        self.assertEqual(('viridis', 0., 1.), cm)
+        cm = ctx.get_color_mapping('demo', 'conc_tsm')
         self.assertEqual(('jet', 0., 1.), cm)
 
+        with self.assertRaises(ServiceResourceNotFoundError):
+            ctx.get_color_mapping('demox', 'conc_chl')
+
     def test_get_feature_collections(self):
         ctx = new_test_service_context()
         feature_collections = ctx.get_place_groups()
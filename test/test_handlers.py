@@ -1,3 +1,6 @@
+import json
+from unittest.mock import patch
+
 from tornado.testing import AsyncHTTPTestCase
 
 from test.helpers import new_test_service_context
@@ -29,6 +32,27 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/')
         self.assertResponseOK(response)
 
+    def test_fetch_resource(self):
+        response = self.fetch(self.prefix + '/res/openapi.yml')
+        self.assertResponseOK(response)
+        etag = response.headers['Etag']
+        self.assertRegex(etag, r'^"[0-9a-f]+-[0-9a-f]+"$')
+        response = self.fetch(self.prefix + '/res/openapi.yml', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self.assertEqual(b'', response.body)
+
+    def test_fetch_versioned_resource(self):
+        response = self.fetch(self.prefix + '/res/openapi.yml?v=1')
+        self.assertResponseOK(response)
+        self.assertEqual('public, max-age=315360000, immutable', response.headers['Cache-Control'])
+
+    def test_fetch_error_json(self):
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/x/0.png')
+        self.assertBadRequestResponse(response, 'Parameter "x" must be an integer, but was \'x\'')
+        self.assertEqual({'error': {'code': 400,
+                                    'message': 'Parameter "x" must be an integer, but was \'x\''}},
+                         json.loads(response.body))
+
     def test_fetch_wmts_kvp_capabilities(self):
         response = self.fetch(self.prefix + '/wmts/kvp'
                                             '?SERVICE=WMTS'
@@ -115,6 +139,35 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/wmts/1.0.0/WMTSCapabilities.xml')
         self.assertResponseOK(response)
 
+    def test_fetch_wmts_capabilities_cached(self):
+        response = self.fetch(self.prefix + '/wmts/1.0.0/WMTSCapabilities.xml')
+        self.assertResponseOK(response)
+        self.assertIn(f'http://127.0.0.1:{self.get_http_port()}{self.prefix}/wmts/kvp?', response.body.decode())
+        etag = response.headers['Etag']
+
+        # Served for the base URL of each request
+        response = self.fetch(self.prefix + '/wmts/1.0.0/WMTSCapabilities.xml', headers={'Host': 'xcube.org'})
+        self.assertResponseOK(response)
+        self.assertIn(f'http://xcube.org{self.prefix}/wmts/kvp?', response.body.decode())
+        self.assertNotEqual(etag, response.headers['Etag'])
+
+        response = self.fetch(self.prefix + '/wmts/1.0.0/WMTSCapabilities.xml', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+
+        # Reopening unchanged datasets keeps the cached capabilities
+        ctx = self._app.service_context
+        ctx.dataset_cache.clear()
+        ctx.get_dataset('demo')
+        self.assertEqual(ctx.datasets_version, ctx.response_cache.get_value('wmts')[0])
+
+        # Changed datasets may change the capabilities, so they are rendered again
+        ctx.dataset_cache.clear()
+        with patch('xcube_server.context._get_local_dataset_tag', return_value='changed'):
+            ctx.get_dataset('demo')
+        self.assertNotEqual(ctx.datasets_version, ctx.response_cache.get_value('wmts')[0])
+        response = self.fetch(self.prefix + '/wmts/1.0.0/WMTSCapabilities.xml', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+
     def test_fetch_wmts_tile(self):
         response = self.fetch(self.prefix + '/wmts/1.0.0/tile/demo/conc_chl/0/0/0.png')
         self.assertResponseOK(response)
@@ -149,6 +202,49 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png')
         self.assertResponseOK(response)
 
+    def test_fetch_dataset_tile_not_modified(self):
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png')
+        self.assertResponseOK(response)
+        self.assertEqual('public, max-age=3600', response.headers['Cache-Control'])
+        etag = response.headers['Etag']
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self.assertEqual(b'', response.body)
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png?cbar=jet',
+                              headers={'If-None-Match': etag})
+        self.assertResponseOK(response)
+
+        # The ETag is derived from the dataset file, so it is kept when the dataset is reopened
+        # and it is equal in all server processes
+        self._app.service_context.dataset_cache.clear()
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self._app.service_context = new_test_service_context()
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+
+        # A changed dataset
+        self._app.service_context.dataset_cache.clear()
+        with patch('xcube_server.context._get_local_dataset_tag', return_value='changed'):
+            response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png',
+                                  headers={'If-None-Match': etag})
+        self.assertResponseOK(response)
+
+    def test_fetch_dataset_tile_current_time(self):
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png?time=current')
+        self.assertResponseOK(response)
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+        response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png?time=current',
+                              headers={'If-None-Match': response.headers['Etag']})
+        self.assertEqual(304, response.code)
+
+    def test_fetch_dataset_tile_unknown_dataset(self):
+        response = self.fetch(self.prefix + '/datasets/demox/vars/conc_chl/tiles/0/0/0.png')
+        self.assertResourceNotFoundResponse(response, 'Dataset "demox" not found')
+
     def test_fetch_dataset_tile_with_params(self):
         response = self.fetch(self.prefix + '/datasets/demo/vars/conc_chl/tiles/0/0/0.png?time=current&cbar=jet&debug=1')
         self.assertResponseOK(response)
@@ -177,6 +273,21 @@ class HandlersTest(AsyncHTTPTestCase):
         response = self.fetch(self.prefix + '/colorbars.html')
         self.assertResponseOK(response)
 
+    def test_fetch_color_bars_compressed(self):
+        response = self.fetch(self.prefix + '/colorbars', decompress_response=False,
+                              headers={'Accept-Encoding': 'gzip'})
+        self.assertResponseOK(response)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+
+    def test_fetch_color_bars_not_modified(self):
+        response = self.fetch(self.prefix + '/colorbars')
+        self.assertResponseOK(response)
+        etag = response.headers['Etag']
+        response = self.fetch(self.prefix + '/colorbars', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self.assertEqual(b'', response.body)
+
     def test_fetch_feature_collections(self):
         response = self.fetch(self.prefix + '/places')
         self.assertResponseOK(response)
@@ -1,12 +1,20 @@
+import concurrent.futures
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import MagicMock, patch
 
 import numpy as np
 import pandas as pd
 import xarray as xr
+import zarr
 
 from xcube_server.im import TileGrid
-from xcube_server.mldataset import BaseMultiLevelDataset, ComputedMultiLevelDataset
+from xcube_server.mldataset import BaseMultiLevelDataset, ComputedMultiLevelDataset, \
+    FileStorageMultiLevelDataset, ObjectStorageMultiLevelDataset, open_local_zarr, _PrefetchStore
 
 
 class BaseMultiLevelDatasetTest(unittest.TestCase):
@@ -31,6 +39,34 @@ class BaseMultiLevelDatasetTest(unittest.TestCase):
 
         ml_ds.close()
 
+    def test_tile_grid_and_datasets_computed_once(self):
+        ds = _get_test_dataset()
+
+        class CountingMultiLevelDataset(BaseMultiLevelDataset):
+            num_tile_grids = 0
+            num_datasets = 0
+
+            def _get_tile_grid_lazily(self):
+                CountingMultiLevelDataset.num_tile_grids += 1
+                time.sleep(0.05)
+                return super()._get_tile_grid_lazily()
+
+            def _get_dataset_lazily(self, index, **kwargs):
+                CountingMultiLevelDataset.num_datasets += 1
+                time.sleep(0.05)
+                return super()._get_dataset_lazily(index, **kwargs)
+
+        ml_ds = CountingMultiLevelDataset(ds)
+        threads = [threading.Thread(target=lambda: (ml_ds.tile_grid, ml_ds.get_dataset(1))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, CountingMultiLevelDataset.num_tile_grids)
+        # Level 0 for the tile grid, level 1
+        self.assertEqual(2, CountingMultiLevelDataset.num_datasets)
+        ml_ds.close()
+
 
 class ComputedMultiLevelDatasetTest(unittest.TestCase):
     def test_it(self):
@@ -66,6 +102,131 @@ class ComputedMultiLevelDatasetTest(unittest.TestCase):
         ml_ds2.close()
 
 
+class FileStorageMultiLevelDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_it(self):
+        ds = _get_test_dataset().isel(time=slice(0, 2))
+        ds.to_zarr(os.path.join(self.temp_dir, '0.zarr'))
+        ds.isel(lat=slice(None, None, 2), lon=slice(None, None, 2)).to_zarr(os.path.join(self.temp_dir, '1.zarr'))
+
+        ml_ds = FileStorageMultiLevelDataset(self.temp_dir)
+        self.assertEqual(2, ml_ds.num_levels)
+        self.assertEqual((2, 720, 1440), ml_ds.get_dataset(0).noise.shape)
+        self.assertEqual((2, 360, 720), ml_ds.get_dataset(1).noise.shape)
+        ml_ds.close()
+
+
+class ObjectStorageMultiLevelDatasetTest(unittest.TestCase):
+    def test_it(self):
+        obs_file_system = MagicMock()
+        obs_file_system.walk.return_value = ['0.zarr', '1.zarr', 'README.md']
+        obs_file_system.isdir.side_effect = lambda path: path.endswith('.zarr')
+        ds = _get_test_dataset().isel(time=slice(0, 2))
+
+        ml_ds = ObjectStorageMultiLevelDataset('demo', obs_file_system, 'bucket/demo.levels', prefetch_depth=3)
+        self.assertEqual(2, ml_ds.num_levels)
+
+        with patch('xcube_server.mldataset.open_obs_zarr', return_value=ds) as open_obs_zarr:
+            self.assertIs(ds, ml_ds.get_dataset(1))
+        open_obs_zarr.assert_called_once_with(obs_file_system, 'bucket/demo.levels/1.zarr', prefetch_depth=3)
+        ml_ds.close()
+
+    def test_missing_level(self):
+        obs_file_system = MagicMock()
+        obs_file_system.walk.return_value = ['0.zarr', '2.zarr']
+        obs_file_system.isdir.return_value = True
+
+        with self.assertRaises(ValueError) as cm:
+            ObjectStorageMultiLevelDataset('demo', obs_file_system, 'bucket/demo.levels')
+        self.assertEqual("Invalid dataset descriptor 'demo': missing level 1 in bucket/demo.levels",
+                         f'{cm.exception}')
+
+
+class OpenLocalZarrTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_open_local_zarr(self):
+        ds = _get_test_dataset().isel(time=slice(0, 2))
+
+        path = os.path.join(self.temp_dir, 'plain.zarr')
+        ds.to_zarr(path, consolidated=False)
+        ds2 = open_local_zarr(path)
+        np.testing.assert_equal(ds2.noise.values, ds.noise.values)
+
+        path = os.path.join(self.temp_dir, 'consolidated.zarr')
+        ds.to_zarr(path, consolidated=True)
+        # Proves that metadata is read from the consolidated metadata only
+        os.remove(os.path.join(path, 'noise', '.zarray'))
+        ds2 = open_local_zarr(path)
+        np.testing.assert_equal(ds2.noise.values, ds.noise.values)
+
+    def test_open_local_zarr_chunks(self):
+        ds = _get_test_dataset().isel(time=slice(0, 2)).chunk(dict(time=1, lat=90, lon=90))
+
+        path = os.path.join(self.temp_dir, 'chunked.zarr')
+        ds.to_zarr(path)
+        ds2 = open_local_zarr(path)
+        self.assertEqual(((1, 1), (90,) * 8, (90,) * 16), ds2.noise.chunks)
+
+        ds2 = open_local_zarr(path, chunks=dict(time=2))
+        self.assertEqual(((2,), (90,) * 8, (90,) * 16), ds2.noise.chunks)
+
+
+class PrefetchStoreTest(unittest.TestCase):
+    def test_reads_following_chunks_ahead(self):
+        ds = _get_test_dataset().isel(time=slice(0, 2)).chunk(dict(time=1, lat=90, lon=90))
+        store = _ReadLoggingStore()
+        ds.to_zarr(store)
+        chunk_3 = store['noise/1.2.3']
+        chunk_4 = store['noise/1.2.4']
+        store.read_keys.clear()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            prefetch_store = _PrefetchStore(store, 2, executor=executor)
+            self.assertEqual(chunk_3, prefetch_store['noise/1.2.3'])
+            self.assertEqual(chunk_4, prefetch_store['noise/1.2.4'])
+            with self.assertRaises(KeyError):
+                # noinspection PyStatementEffect
+                prefetch_store['noise/1.2.16']
+            with self.assertRaises(KeyError):
+                # noinspection PyStatementEffect
+                prefetch_store['.zmissing']
+
+        # Each chunk is read once, also the missing ones following the last chunk
+        self.assertEqual(['.zmissing',
+                          'noise/1.2.16', 'noise/1.2.17', 'noise/1.2.18',
+                          'noise/1.2.3', 'noise/1.2.4', 'noise/1.2.5', 'noise/1.2.6'],
+                         sorted(store.read_keys))
+
+    def test_open_zarr(self):
+        ds = _get_test_dataset().isel(time=slice(0, 2)).chunk(dict(time=1, lat=90, lon=90))
+        store = zarr.MemoryStore()
+        ds.to_zarr(store)
+
+        prefetch_store = _PrefetchStore(store, 4)
+        ds2 = xr.open_zarr(zarr.LRUStoreCache(prefetch_store, max_size=2 ** 24))
+        np.testing.assert_equal(ds2.noise.values, ds.noise.values)
+
+
+class _ReadLoggingStore(dict):
+    def __init__(self):
+        super().__init__()
+        self.read_keys = []
+
+    def __getitem__(self, key):
+        self.read_keys.append(key)
+        return super().__getitem__(key)
+
+
 def _get_test_dataset():
     w = 1440
     h = 720
@@ -14,3 +14,6 @@ class NaturalEarth2Test(TestCase):
         tile = pyramid.get_tile(7, 3, 2)
         self.assertIsNotNone(tile)
         self.assertEqual(9032, len(tile))
+
+    def test_natural_earth_2_pyramid_is_shared(self):
+        self.assertIs(ne2.NaturalEarth2Image.get_pyramid(), ne2.NaturalEarth2Image.get_pyramid())
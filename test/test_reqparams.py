@@ -25,6 +25,9 @@ class RequestParamsTest(unittest.TestCase):
         self.assertEqual('bert', rp.get_query_argument('s', 'bert'))
         self.assertEqual(234, rp.get_query_argument_int('i', 234))
         self.assertEqual(0.2, rp.get_query_argument_float('f', 0.2))
+        default = 2 ** 100
+        self.assertIs(default, rp.get_query_argument_int('i', default))
+        self.assertIsNone(rp.get_query_argument_float('f', None))
 
         rp = RequestParamsMock(s='bibo', i='465', f='0.1')
         self.assertEqual('bibo', rp.get_query_argument('s', None))
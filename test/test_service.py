@@ -57,6 +57,8 @@ class UrlPatternTest(unittest.TestCase):
                          '/open/(?P<ws_name>[^\;\/\?\:\@\&\=\+\$\,]+)')
         self.assertEqual(service.url_pattern('/open/ws{{id1}}/wf{{id2}}'),
                          '/open/ws(?P<id1>[^\;\/\?\:\@\&\=\+\$\,]+)/wf(?P<id2>[^\;\/\?\:\@\&\=\+\$\,]+)')
+        self.assertIs(service.url_pattern('/open/{{ws_name}}'),
+                      service.url_pattern('/open/{{ws_name}}'))
 
     def test_url_pattern_fail(self):
         with self.assertRaises(ValueError) as cm:
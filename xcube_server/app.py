@@ -19,9 +19,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
 import os
+import re
+from typing import Dict, List, Pattern, Sequence, Tuple, Type
 
-from tornado.web import Application, StaticFileHandler
+from tornado.escape import url_unescape
+from tornado.web import Application, RequestHandler, URLSpec
 
 from xcube_server.defaults import DEFAULT_NAME, API_PREFIX
 from xcube_server.handlers import GetNE2TileHandler, GetDatasetVarTileHandler, InfoHandler, GetNE2TileGridHandler, \
@@ -29,76 +33,256 @@ from xcube_server.handlers import GetNE2TileHandler, GetDatasetVarTileHandler, I
     GetDatasetsHandler, FindPlacesHandler, FindDatasetPlacesHandler, \
     GetDatasetCoordsHandler, GetTimeSeriesInfoHandler, GetTimeSeriesForPointHandler, WMTSKvpHandler, \
     GetTimeSeriesForGeometryHandler, GetTimeSeriesForFeaturesHandler, GetTimeSeriesForGeometriesHandler, \
-    GetPlaceGroupsHandler, GetDatasetVarLegendHandler, GetDatasetHandler
+    GetPlaceGroupsHandler, GetDatasetVarLegendHandler, GetDatasetHandler, ResourceFileHandler
 from xcube_server.service import url_pattern
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
 
 
+_RES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'res')
+
+# Templates of the tile routes, which are also dispatched by path segments, see _TILE_ROUTE_TRIE
+_WMTS_TILE_TEMPLATE = '/wmts/1.0.0/tile/{{ds_id}}/{{var_name}}/{{z}}/{{y}}/{{x}}.png'
+_DATASET_TILE_TEMPLATE = '/datasets/{{ds_id}}/vars/{{var_name}}/tiles/{{z}}/{{x}}/{{y}}.png'
+_NE2_TILE_TEMPLATE = '/ne2/tiles/{{z}}/{{x}}/{{y}}.jpg'
+
+# Routes relative to the application prefix, their URL patterns are translated only once
+_ROUTES = (
+    ('/res/(.*)',
+     ResourceFileHandler, {'path': _RES_PATH}),
+    (url_pattern('/'),
+     InfoHandler),
+
+    (url_pattern('/wmts/1.0.0/WMTSCapabilities.xml'),
+     GetWMTSCapabilitiesXmlHandler),
+    (url_pattern(_WMTS_TILE_TEMPLATE),
+     GetDatasetVarTileHandler),
+    (url_pattern('/wmts/kvp'),
+     WMTSKvpHandler),
+
+    # Natural Earth 2 tiles for testing
+
+    (url_pattern('/datasets'),
+     GetDatasetsHandler),
+    (url_pattern('/datasets/{{ds_id}}'),
+     GetDatasetHandler),
+    (url_pattern('/datasets/{{ds_id}}/coords/{{dim_name}}'),
+     GetDatasetCoordsHandler),
+    (url_pattern('/datasets/{{ds_id}}/vars/{{var_name}}/legend.png'),
+     GetDatasetVarLegendHandler),
+    (url_pattern(_DATASET_TILE_TEMPLATE),
+     GetDatasetVarTileHandler),
+    (url_pattern('/datasets/{{ds_id}}/vars/{{var_name}}/tilegrid'),
+     GetDatasetVarTileGridHandler),
+
+    # Natural Earth 2 tiles for testing
+
+    (url_pattern('/ne2/tilegrid'),
+     GetNE2TileGridHandler),
+    (url_pattern(_NE2_TILE_TEMPLATE),
+     GetNE2TileHandler),
+
+    # Color Bars API
+
+    (url_pattern('/colorbars'),
+     GetColorBarsJsonHandler),
+    (url_pattern('/colorbars.html'),
+     GetColorBarsHtmlHandler),
+
+    # Places API (PRELIMINARY & UNSTABLE - will be revised soon)
+
+    (url_pattern('/places'),
+     GetPlaceGroupsHandler),
+    (url_pattern('/places/{{collection_name}}'),
+     FindPlacesHandler),
+    (url_pattern('/places/{{collection_name}}/{{ds_id}}'),
+     FindDatasetPlacesHandler),
+
+    # Time-series API (for VITO's DCS4COP viewer only, PRELIMINARY & UNSTABLE - will be revised soon)
+
+    (url_pattern('/ts'),
+     GetTimeSeriesInfoHandler),
+    (url_pattern('/ts/{{ds_id}}/{{var_name}}/point'),
+     GetTimeSeriesForPointHandler),
+    (url_pattern('/ts/{{ds_id}}/{{var_name}}/geometry'),
+     GetTimeSeriesForGeometryHandler),
+    (url_pattern('/ts/{{ds_id}}/{{var_name}}/geometries'),
+     GetTimeSeriesForGeometriesHandler),
+    (url_pattern('/ts/{{ds_id}}/{{var_name}}/places'),
+     GetTimeSeriesForFeaturesHandler),
+)
+
+
+# Handlers of routes without placeholders, looked up by their exact path, see _Application
+_LITERAL_ROUTES = {route[0]: route[1] for route in _ROUTES if len(route) == 2 and re.compile(route[0]).groups == 0}
+
+# Routes with {{NAME}} placeholders, matched by a single combined regular expression, see _Application
+_PLACEHOLDER_ROUTES = tuple(route for route in _ROUTES
+                            if len(route) == 2 and len(re.compile(route[0]).groupindex) > 0)
+
+# Maximum number of placeholder paths whose handler class and path arguments are remembered, see _Application
+_DISPATCH_CACHE_CAPACITY = 2048
+
+# The named group of a placeholder
+_NAMED_GROUP_RE = re.compile(r'\(\?P<(\w+)>')
+
+# A path segment of a route template that is a single placeholder, optionally followed by a file extension
+_PLACEHOLDER_SEGMENT_RE = re.compile(r'{{(\w+)}}(\.\w+)?')
+
+# Characters that a placeholder's value must not contain, see url_pattern()
+_RESERVED_CHARS = frozenset(';/?:@&=+$,')
+
+
+def _new_segment_trie(routes: Sequence[Tuple[str, Type[RequestHandler]]]) -> Dict:
+    """
+    Build a trie of route templates keyed on path segments. A literal segment is keyed by itself,
+    a placeholder segment by None. The last segment is a placeholder with a file extension, keyed by
+    (None, extension), which maps to the handler class and the names of the route's placeholders.
+    The routes must not have a literal and a placeholder segment at the same position of a common parent.
+    """
+    trie = dict()
+    for template, handler_class in routes:
+        node = trie
+        names = []
+        *segments, last_segment = template.split('/')[1:]
+        for segment in segments:
+            match = _PLACEHOLDER_SEGMENT_RE.fullmatch(segment)
+            if match is not None:
+                names.append(match.group(1))
+            node = node.setdefault(None if match is not None else segment, dict())
+        match = _PLACEHOLDER_SEGMENT_RE.fullmatch(last_segment)
+        names.append(match.group(1))
+        node[None, match.group(2)] = handler_class, names
+    return trie
+
+
+# The highest-frequency routes, looked up by path segments instead of regular expressions, see _Application
+_TILE_ROUTE_TRIE = _new_segment_trie([(_WMTS_TILE_TEMPLATE, GetDatasetVarTileHandler),
+                                      (_DATASET_TILE_TEMPLATE, GetDatasetVarTileHandler),
+                                      (_NE2_TILE_TEMPLATE, GetNE2TileHandler)])
+
+
+def _find_tile_route(path: str, start: int):
+    """
+    Find the tile route of the path that begins at index *start* of *path* in _TILE_ROUTE_TRIE.
+
+    :return: The handler class and the path arguments, or None if no tile route matches
+    """
+    segments = path[start:].split('/')
+    if len(segments) < 2 or segments[0]:
+        return None
+    node = _TILE_ROUTE_TRIE
+    values = []
+    for segment in segments[1:-1]:
+        child = node.get(segment)
+        if child is None:
+            child = node.get(None)
+            if child is None or not segment or not _RESERVED_CHARS.isdisjoint(segment):
+                return None
+            values.append(segment)
+        node = child
+    value, dot, extension = segments[-1].rpartition('.')
+    route = node.get((None, dot + extension))
+    if route is None or not value or not _RESERVED_CHARS.isdisjoint(value):
+        return None
+    values.append(value)
+    handler_class, names = route
+    return handler_class, {name: url_unescape(v, encoding=None, plus=False) for name, v in zip(names, values)}
+
+
+@functools.lru_cache(maxsize=8)
+def _new_prefixed_routes(prefix: str):
+    """
+    Prefix the routes and compile the combined regular expression of the placeholder routes.
+    The combined regular expression matches paths relative to the prefix.
+    The result only depends on the prefix, so it is computed once and shared by all applications
+    created for the same service name.
+
+    :param prefix: The application prefix
+    :return: The prefixed URL specs, the literal handlers by path, the combined placeholder regex, and the
+        handler class and group-to-placeholder names by route group name
+    """
+    # Pre-built URL specs, so that applications of the same name share their compiled patterns
+    routes = tuple(URLSpec(prefix + route[0], *route[1:]) for route in _ROUTES)
+    literal_handlers = {prefix + path: handler for path, handler in _LITERAL_ROUTES.items()}
+    # Group names must be unique within a regular expression, so qualify each placeholder by its route
+    route_patterns = []
+    placeholder_routes = {}
+    for index, (pattern, handler_class) in enumerate(_PLACEHOLDER_ROUTES):
+        route_group = f'r{index}'
+        route_patterns.append(f'(?P<{route_group}>'
+                              + _NAMED_GROUP_RE.sub(f'(?P<{route_group}_\\1>', pattern)
+                              + ')$')
+        placeholder_routes[route_group] = (handler_class,
+                                           [(f'{route_group}_{name}', name)
+                                            for name in re.compile(pattern).groupindex])
+    return routes, literal_handlers, re.compile('|'.join(route_patterns)), placeholder_routes
+
+
+class _Application(Application):
+    """
+    A Tornado application that finds the handlers of literal routes by a dictionary lookup of the request path.
+    Routes with placeholders are matched by a single regular expression that combines all their
+    patterns in the original order, with a named group per route that identifies the matching one.
+    Before that, tile routes are looked up in a trie of path segments.
+    As all routes share the application prefix, it is checked once by a string comparison,
+    and the combined regular expression only matches the rest of the path.
+    The results for the most recently requested placeholder paths are kept in a bounded dictionary.
+    Other paths, e.g. static resources or unknown paths, fall back to Tornado's rule matching
+    that tries the regular expressions of all routes one after the other.
+    """
+
+    def __init__(self,
+                 prefix: str,
+                 handlers,
+                 literal_handlers: Dict[str, Type[RequestHandler]],
+                 placeholder_regex: Pattern,
+                 placeholder_routes: Dict[str, Tuple[Type[RequestHandler], List[Tuple[str, str]]]],
+                 **settings):
+        super().__init__(handlers, **settings)
+        self._prefix = prefix
+        self._literal_handlers = literal_handlers
+        self._placeholder_regex = placeholder_regex
+        self._placeholder_routes = placeholder_routes
+        # Handler classes and path arguments of recently requested placeholder paths, only used on the IOLoop thread
+        self._dispatch_cache = dict()
+
+    def find_handler(self, request, **kwargs):
+        path = request.path
+        handler_class = self._literal_handlers.get(path)
+        if handler_class is not None:
+            return self.get_handler_delegate(request, handler_class)
+        dispatch_cache = self._dispatch_cache
+        route = dispatch_cache.get(path)
+        if route is None:
+            route = self._find_placeholder_route(path)
+            if route is None:
+                return super().find_handler(request, **kwargs)
+            if len(dispatch_cache) >= _DISPATCH_CACHE_CAPACITY:
+                # Dictionaries keep insertion order, so this evicts the oldest entry
+                del dispatch_cache[next(iter(dispatch_cache))]
+            dispatch_cache[path] = route
+        handler_class, path_kwargs = route
+        return self.get_handler_delegate(request, handler_class, path_kwargs=path_kwargs)
+
+    def _find_placeholder_route(self, path: str):
+        prefix = self._prefix
+        if not path.startswith(prefix):
+            return None
+        tile_route = _find_tile_route(path, len(prefix))
+        if tile_route is not None:
+            return tile_route
+        match = self._placeholder_regex.match(path, len(prefix))
+        if match is None:
+            return None
+        # The route's group encloses its placeholders, so it is the last one closed
+        handler_class, groups = self._placeholder_routes[match.lastgroup]
+        return handler_class, {name: url_unescape(match.group(group), encoding=None, plus=False)
+                               for group, name in groups}
+
+
 def new_application(name: str = DEFAULT_NAME):
+    # A new application per call, because a service stores its context in it
     prefix = f"/{name}{API_PREFIX}"
-    application = Application([
-        (prefix + '/res/(.*)',
-         StaticFileHandler, {'path': os.path.join(os.path.dirname(__file__), 'res')}),
-        (prefix + url_pattern('/'),
-         InfoHandler),
-
-        (prefix + url_pattern('/wmts/1.0.0/WMTSCapabilities.xml'),
-         GetWMTSCapabilitiesXmlHandler),
-        (prefix + url_pattern('/wmts/1.0.0/tile/{{ds_id}}/{{var_name}}/{{z}}/{{y}}/{{x}}.png'),
-         GetDatasetVarTileHandler),
-        (prefix + url_pattern('/wmts/kvp'),
-         WMTSKvpHandler),
-
-        # Natural Earth 2 tiles for testing
-
-        (prefix + url_pattern('/datasets'),
-         GetDatasetsHandler),
-        (prefix + url_pattern('/datasets/{{ds_id}}'),
-         GetDatasetHandler),
-        (prefix + url_pattern('/datasets/{{ds_id}}/coords/{{dim_name}}'),
-         GetDatasetCoordsHandler),
-        (prefix + url_pattern('/datasets/{{ds_id}}/vars/{{var_name}}/legend.png'),
-         GetDatasetVarLegendHandler),
-        (prefix + url_pattern('/datasets/{{ds_id}}/vars/{{var_name}}/tiles/{{z}}/{{x}}/{{y}}.png'),
-         GetDatasetVarTileHandler),
-        (prefix + url_pattern('/datasets/{{ds_id}}/vars/{{var_name}}/tilegrid'),
-         GetDatasetVarTileGridHandler),
-
-        # Natural Earth 2 tiles for testing
-
-        (prefix + url_pattern('/ne2/tilegrid'),
-         GetNE2TileGridHandler),
-        (prefix + url_pattern('/ne2/tiles/{{z}}/{{x}}/{{y}}.jpg'),
-         GetNE2TileHandler),
-
-        # Color Bars API
-
-        (prefix + url_pattern('/colorbars'),
-         GetColorBarsJsonHandler),
-        (prefix + url_pattern('/colorbars.html'),
-         GetColorBarsHtmlHandler),
-
-        # Places API (PRELIMINARY & UNSTABLE - will be revised soon)
-
-        (prefix + url_pattern('/places'),
-         GetPlaceGroupsHandler),
-        (prefix + url_pattern('/places/{{collection_name}}'),
-         FindPlacesHandler),
-        (prefix + url_pattern('/places/{{collection_name}}/{{ds_id}}'),
-         FindDatasetPlacesHandler),
-
-        # Time-series API (for VITO's DCS4COP viewer only, PRELIMINARY & UNSTABLE - will be revised soon)
-
-        (prefix + url_pattern('/ts'),
-         GetTimeSeriesInfoHandler),
-        (prefix + url_pattern('/ts/{{ds_id}}/{{var_name}}/point'),
-         GetTimeSeriesForPointHandler),
-        (prefix + url_pattern('/ts/{{ds_id}}/{{var_name}}/geometry'),
-         GetTimeSeriesForGeometryHandler),
-        (prefix + url_pattern('/ts/{{ds_id}}/{{var_name}}/geometries'),
-         GetTimeSeriesForGeometriesHandler),
-        (prefix + url_pattern('/ts/{{ds_id}}/{{var_name}}/places'),
-         GetTimeSeriesForFeaturesHandler),
-    ])
-    return application
+    # JSON and XML responses are gzip-compressed if the client accepts it, images are left as they are
+    return _Application(prefix, *_new_prefixed_routes(prefix), compress_response=True)
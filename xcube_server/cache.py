@@ -25,6 +25,7 @@ import os.path
 import sys
 import time
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
 from threading import RLock
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
@@ -196,7 +197,7 @@ POLICY_LFU = _policy_lfu
 #: Discard items by Random Replacement
 POLICY_RR = _policy_rr
 
-_T0 = time.process_time()
+_T0 = time.perf_counter()
 
 
 class Cache:
@@ -251,7 +252,7 @@ class Cache:
             self.stored_size = stored_size
 
         def _access(self):
-            self.access_time = time.process_time() - _T0
+            self.access_time = time.perf_counter() - _T0
             self.access_count += 1
 
     def __init__(self, store=MemoryCacheStore(), capacity=1000, threshold=0.75, policy=POLICY_LRU, parent_cache=None):
@@ -410,12 +411,94 @@ class Cache:
             self.remove_value(key)
 
 
+class LruMemoryCache:
+    """
+    A thread-safe in-memory cache that discards the least recently used values first.
+
+    In contrast to :py:class:`Cache`, which trims down to a threshold in bursts once its maximum size is reached,
+    this cache discards single values, and only as many as required to stay within its *capacity*.
+    All operations have constant (amortized) time complexity.
+
+    :param capacity: the size capacity in units used by *size_function*
+    :param size_function: a function that computes the size of a value, defaults to its size in bytes
+    """
+
+    def __init__(self, capacity=1000, size_function=None):
+        self._capacity = capacity
+        self._size_function = size_function or _compute_object_size
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def size(self):
+        return self._size
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get_value(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            if _DEBUG_CACHE:
+                _debug_print('restored value for key "%s" from LRU cache' % key)
+            return entry[0]
+
+    def put_value(self, key, value):
+        size = self._size_function(value)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+            if size > self._capacity:
+                # Value would never fit
+                return
+            while self._entries and self._size + size > self._capacity:
+                discarded_key, (_, discarded_size) = self._entries.popitem(last=False)
+                self._size -= discarded_size
+                if _DEBUG_CACHE:
+                    _debug_print('discarded value for key "%s" from LRU cache' % discarded_key)
+            self._entries[key] = value, size
+            self._size += size
+
+    def remove_value(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def remove_values(self, key_predicate):
+        """
+        Remove all values whose key satisfies *key_predicate*. Takes linear time.
+
+        :param key_predicate: a function that takes a key and returns whether to remove its value
+        """
+        with self._lock:
+            for key in [key for key in self._entries.keys() if key_predicate(key)]:
+                self.remove_value(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
 def _debug_print(msg):
     print("Cache:", msg)
 
 
 def _compute_object_size(obj):
-    if hasattr(obj, 'nbytes'):
+    if isinstance(obj, bytes):
+        # An encoded tile, by far the most frequent cache value, no need to probe it for other attributes
+        return sys.getsizeof(obj)
+    elif hasattr(obj, 'nbytes'):
         # A numpy ndarray instance
         return obj.nbytes
     elif hasattr(obj, 'size') and hasattr(obj, 'mode'):
@@ -19,11 +19,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import sys
+from typing import Optional
+
 import click
 
 from xcube_server import __version__, __description__
 from xcube_server.defaults import DEFAULT_PORT, DEFAULT_NAME, DEFAULT_ADDRESS, DEFAULT_UPDATE_PERIOD, \
-    DEFAULT_CONFIG_FILE, DEFAULT_TILE_CACHE_SIZE, DEFAULT_TILE_COMP_MODE
+    DEFAULT_CONFIG_FILE, DEFAULT_TILE_CACHE_SIZE, DEFAULT_TILE_COMP_MODE, DEFAULT_NUM_WORKERS, \
+    DEFAULT_DATASET_CACHE_SIZE
 
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
 
@@ -49,12 +53,24 @@ __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
                    f'Unit suffixes {"K"!r}, {"M"!r}, {"G"!r} may be used. '
                    f'Defaults to {DEFAULT_TILE_CACHE_SIZE!r}. '
                    f'The special value {"OFF"!r} disables tile caching.')
+@click.option('--datasetcache', metavar='COUNT', default=DEFAULT_DATASET_CACHE_SIZE, type=int,
+              help='Maximum number of opened datasets kept in memory by each server process. '
+                   'Least recently used datasets are discarded and opened again when requested. '
+                   'Should not be less than the number of configured datasets, because capabilities '
+                   'and catalogue requests read all of them. '
+                   'Zero or a negative value means no limit. Defaults to no limit.')
 @click.option('--tilemode', metavar='MODE', default=None, type=int,
               help='Tile computation mode. '
                    'This is an internal option used to switch between different tile computation implementations. '
                    f'Defaults to {DEFAULT_TILE_COMP_MODE!r}.')
+@click.option('--workers', metavar='COUNT', default=DEFAULT_NUM_WORKERS, type=int,
+              help='Number of server processes sharing the port. Zero means one per CPU. '
+                   'Each process has its own tile cache. '
+                   f'Defaults to {DEFAULT_NUM_WORKERS!r}.')
 @click.option('--verbose', '-v', is_flag=True,
               help="Delegate logging to the console (stderr).")
+@click.option('--accesslog', is_flag=True,
+              help="Log every request, not only failed ones.")
 @click.option('--traceperf', is_flag=True,
               help="Print performance diagnostics (stdout).")
 def run_server(name: str,
@@ -63,8 +79,11 @@ def run_server(name: str,
                update: float,
                config: str,
                tilecache: str,
+               datasetcache: Optional[int],
                tilemode: int,
+               workers: int,
                verbose: bool,
+               accesslog: bool,
                traceperf: bool):
     """
     Run an Xcube server.
@@ -84,12 +103,15 @@ def run_server(name: str,
                           tile_comp_mode=tilemode,
                           update_period=update,
                           log_to_stderr=verbose,
+                          access_log=accesslog,
+                          num_workers=workers,
+                          dataset_cache_size=datasetcache,
                           trace_perf=traceperf)
         service.start()
-        return 0
     except Exception as e:
-        print('error: %s' % e)
-        return 1
+        # Errors go to stderr, so they don't interleave with the output of a shutting down service
+        click.echo(f'error: {e}', err=True)
+        sys.exit(1)
 
 
 def main(args=None):
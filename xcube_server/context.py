@@ -19,29 +19,31 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
 import glob
+import hashlib
+import json
 import logging
 import os
 import threading
 import time
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import fiona
-import numpy as np
 import pandas as pd
 import s3fs
 import xarray as xr
-import zarr
 
 from xcube_server.im import TileGrid
 from . import __version__
-from .cache import MemoryCacheStore, Cache, FileCacheStore
+from .cache import Cache, FileCacheStore, LruMemoryCache
 from .defaults import DEFAULT_CMAP_CBAR, DEFAULT_CMAP_VMIN, \
     DEFAULT_CMAP_VMAX, FILE_TILE_CACHE_PATH, \
-    API_PREFIX, DEFAULT_NAME, DEFAULT_TRACE_PERF
+    API_PREFIX, DEFAULT_NAME, DEFAULT_TRACE_PERF, IMAGE_CACHE_CAPACITY, DEFAULT_DATASET_CACHE_SIZE, \
+    OBS_MAX_POOL_CONNECTIONS, OBS_PREFETCH_DEPTH, RESPONSE_CACHE_CAPACITY
 from .errors import ServiceConfigError, ServiceError, ServiceBadRequestError, ServiceResourceNotFoundError
 from .mldataset import FileStorageMultiLevelDataset, BaseMultiLevelDataset, MultiLevelDataset, \
-    ComputedMultiLevelDataset, ObjectStorageMultiLevelDataset
+    ComputedMultiLevelDataset, ObjectStorageMultiLevelDataset, open_obs_zarr, open_local_zarr
 from .perf import measure_time
 from .reqparams import RequestParams
 
@@ -52,6 +54,24 @@ _LOG = logging.getLogger('xcube')
 
 Config = Dict[str, Any]
 
+# Maximum number of (ds_id, var_name) pairs remembered to warn about undefined color mappings only once
+_MAX_COLOR_MAPPING_WARNINGS = 1000
+
+# Process-global pool of S3 file systems keyed by (endpoint_url, region_name),
+# so TLS/auth setup and client state are shared between datasets
+_OBS_FILE_SYSTEMS: Dict[Tuple[Optional[str], Optional[str]], s3fs.S3FileSystem] = dict()
+_OBS_FILE_SYSTEMS_LOCK = threading.Lock()
+
+# Parsers of dimension values given in requests, keyed by the kind of the dimension's coordinates' dtype.
+# Datetimes are of the coordinates' type, so that tiled images and their IDs are shared with
+# requests that use the default or current time, see get_dataset_tile()
+_DIM_VALUE_PARSERS: Dict[str, Callable[[str], Any]] = {
+    'f': float,
+    'i': int,
+    'u': int,
+    'M': lambda dim_value_str: pd.to_datetime(dim_value_str).to_datetime64(),
+}
+
 
 # noinspection PyMethodMayBeStatic
 class ServiceContext:
@@ -63,24 +83,42 @@ class ServiceContext:
                  trace_perf: bool = DEFAULT_TRACE_PERF,
                  tile_comp_mode: int = None,
                  mem_tile_cache_capacity: int = None,
-                 file_tile_cache_capacity: int = None):
+                 file_tile_cache_capacity: int = None,
+                 dataset_cache_capacity: Optional[int] = DEFAULT_DATASET_CACHE_SIZE):
         self._name = name
         self.base_dir = os.path.abspath(base_dir or '')
         self._config = config if config is not None else dict()
+        self._color_mappings = self._get_color_mappings(self._config)
+        self._color_mapping_warnings = set()
+        self._dataset_descriptor_index = None
+        self._config_tag = _get_config_tag(self._config)
         self._place_group_cache = dict()
         self._feature_index = 0
         self._tile_comp_mode = tile_comp_mode
         self._trace_perf = trace_perf
         self._lock = threading.RLock()
-
-        self.dataset_cache = dict()  # contains tuples of form (MultiLevelDataset, ds_descriptor)
+        # Rendered responses that only depend on the configuration and the opened datasets,
+        # replaced whenever the configuration changes
+        self.response_cache = _new_response_cache()
+
+        # contains tuples of form (MultiLevelDataset, ds_descriptor, dataset_tag), least recently used first
+        self.dataset_cache = collections.OrderedDict()
+        # Guards the order and entries of dataset_cache. Only held briefly, other than _lock,
+        # which is held while opening a dataset, so that each dataset is opened only once.
+        self._dataset_cache_lock = threading.Lock()
+        # None or a non-positive value means the number of opened datasets is not limited
+        self._dataset_cache_capacity = dataset_cache_capacity \
+            if dataset_cache_capacity is not None and dataset_cache_capacity > 0 else None
+        # tags of the datasets opened so far, even if discarded since
+        self._dataset_tags = dict()
+        # incremented whenever a dataset is opened whose tag differs from the one it had before
+        self._datasets_version = 0
         # TODO by forman: move pyramid_cache, mem_tile_cache, rgb_tile_cache into dataset_cache values
-        self.image_cache = dict()
+        # contains tiled images, bounded by number of images
+        self.image_cache = LruMemoryCache(capacity=IMAGE_CACHE_CAPACITY, size_function=lambda image: 1)
 
         if mem_tile_cache_capacity and mem_tile_cache_capacity > 0:
-            self.mem_tile_cache = Cache(MemoryCacheStore(),
-                                        capacity=mem_tile_cache_capacity,
-                                        threshold=0.75)
+            self.mem_tile_cache = LruMemoryCache(capacity=mem_tile_cache_capacity)
         else:
             self.mem_tile_cache = None
 
@@ -104,19 +142,21 @@ class ServiceContext:
 
             clean_image_caches = False
 
-            if not new_dataset_descriptors:
-                for ml_dataset, _ in self.dataset_cache.values():
-                    ml_dataset.close()
-                self.dataset_cache.clear()
-
-            if new_dataset_descriptors and old_dataset_descriptors:
-                ds_names = list(self.dataset_cache.keys())
-                for ds_name in ds_names:
-                    dataset_descriptor = self.find_dataset_descriptor(new_dataset_descriptors, ds_name)
-                    if dataset_descriptor is None:
-                        ml_dataset, _ = self.dataset_cache[ds_name]
+            with self._dataset_cache_lock:
+                if not new_dataset_descriptors:
+                    for ml_dataset, _, _ in self.dataset_cache.values():
                         ml_dataset.close()
-                        del self.dataset_cache[ds_name]
+                    self.dataset_cache.clear()
+
+                if new_dataset_descriptors and old_dataset_descriptors:
+                    new_ds_names = {dataset_descriptor['Identifier']
+                                    for dataset_descriptor in new_dataset_descriptors}
+                    ds_names = list(self.dataset_cache.keys())
+                    for ds_name in ds_names:
+                        if ds_name not in new_ds_names:
+                            ml_dataset, _, _ = self.dataset_cache[ds_name]
+                            ml_dataset.close()
+                            del self.dataset_cache[ds_name]
 
             if clean_image_caches:
                 self.image_cache.clear()
@@ -124,6 +164,21 @@ class ServiceContext:
                     self.rgb_tile_cache.clear()
 
         self._config = config
+        self._color_mappings = self._get_color_mappings(config)
+        self._color_mapping_warnings = set()
+        self._dataset_descriptor_index = None
+        self._config_tag = _get_config_tag(config)
+        self.response_cache = _new_response_cache()
+
+    @property
+    def config_tag(self) -> str:
+        """A short hash of the configuration. Equal configurations have equal tags, also across processes."""
+        return self._config_tag
+
+    @property
+    def datasets_version(self) -> int:
+        """A number that changes whenever a dataset is opened for the first time or has changed when reopened."""
+        return self._datasets_version
 
     @property
     def tile_comp_mode(self) -> int:
@@ -137,11 +192,11 @@ class ServiceContext:
         return base_url + '/' + self._name + API_PREFIX + '/' + '/'.join(path)
 
     def get_ml_dataset(self, ds_id: str) -> MultiLevelDataset:
-        ml_dataset, _ = self._get_dataset_entry(ds_id)
+        ml_dataset, _, _ = self._get_dataset_entry(ds_id)
         return ml_dataset
 
     def get_dataset(self, ds_id: str) -> xr.Dataset:
-        ml_dataset, _ = self._get_dataset_entry(ds_id)
+        ml_dataset, _, _ = self._get_dataset_entry(ds_id)
         return ml_dataset.base_dataset
 
     def get_dataset_and_variable(self, ds_id: str, var_name: str) -> Tuple[xr.Dataset, xr.DataArray]:
@@ -164,47 +219,107 @@ class ServiceContext:
         return dataset_descriptors
 
     def get_dataset_descriptor(self, ds_id: str) -> Dict[str, Any]:
-        dataset_descriptors = self.get_dataset_descriptors()
-        if not dataset_descriptors:
-            raise ServiceConfigError(f"No datasets configured")
-        dataset_descriptor = self.find_dataset_descriptor(dataset_descriptors, ds_id)
+        dataset_descriptor_index = self._dataset_descriptor_index
+        if dataset_descriptor_index is None:
+            # Looked up for every tile, so index the descriptors once per configuration.
+            # Reversed, so that the first of several descriptors with equal identifiers wins.
+            dataset_descriptor_index = {dataset_descriptor['Identifier']: dataset_descriptor
+                                        for dataset_descriptor in reversed(self.get_dataset_descriptors())}
+            self._dataset_descriptor_index = dataset_descriptor_index
+        dataset_descriptor = dataset_descriptor_index.get(ds_id)
         if dataset_descriptor is None:
             raise ServiceResourceNotFoundError(f'Dataset "{ds_id}" not found')
         return dataset_descriptor
 
+    def get_dataset_tag(self, ds_id: str) -> str:
+        """
+        Get a tag of dataset *ds_id* that changes whenever its contents may have changed.
+        Derived from the modification time of local datasets and from the ETag of object storage datasets,
+        so that it is equal in all server processes. Otherwise, it is the time the dataset was opened.
+        Opens the dataset, if not yet done.
+        """
+        _, _, dataset_tag = self._get_dataset_entry(ds_id)
+        return dataset_tag
+
     def get_tile_grid(self, ds_id: str) -> TileGrid:
-        ml_dataset, _ = self._get_dataset_entry(ds_id)
+        ml_dataset, _, _ = self._get_dataset_entry(ds_id)
         return ml_dataset.tile_grid
 
     def get_color_mapping(self, ds_id: str, var_name: str):
-        dataset_descriptor = self.get_dataset_descriptor(ds_id)
-        style_name = dataset_descriptor.get('Style', 'default')
-        styles = self.config.get('Styles')
-        if styles:
-            style = None
-            for s in styles:
-                if style_name == s['Identifier']:
-                    style = s
-            # TODO: check color_mappings is not None
-            if style:
-                color_mappings = style.get('ColorMappings')
-                if color_mappings:
-                    # TODO: check color_mappings is not None
-                    color_mapping = color_mappings.get(var_name)
-                    if color_mapping:
-                        cmap_cbar = color_mapping.get('ColorBar', DEFAULT_CMAP_CBAR)
-                        cmap_vmin, cmap_vmax = color_mapping.get('ValueRange', (DEFAULT_CMAP_VMIN, DEFAULT_CMAP_VMAX))
-                        return cmap_cbar, cmap_vmin, cmap_vmax
-        _LOG.warning(f'color mapping for variable {var_name!r} of dataset {ds_id!r} undefined: using defaults')
+        color_mapping = self._color_mappings.get((ds_id, var_name))
+        if color_mapping is not None:
+            return color_mapping
+        # Raises if dataset is unknown
+        self.get_dataset_descriptor(ds_id)
+        # Called for every tile, so warn only once until the configuration changes. Variable names are
+        # taken from request URLs unchecked, hence the number of remembered names is bounded.
+        if (ds_id, var_name) not in self._color_mapping_warnings:
+            if len(self._color_mapping_warnings) >= _MAX_COLOR_MAPPING_WARNINGS:
+                self._color_mapping_warnings.clear()
+            self._color_mapping_warnings.add((ds_id, var_name))
+            _LOG.warning(f'color mapping for variable {var_name!r} of dataset {ds_id!r} undefined: using defaults')
         return DEFAULT_CMAP_CBAR, DEFAULT_CMAP_VMIN, DEFAULT_CMAP_VMAX
 
-    def _get_dataset_entry(self, ds_id: str) -> Tuple[MultiLevelDataset, Dict[str, Any]]:
-        if ds_id not in self.dataset_cache:
-            with self._lock:
-                self.dataset_cache[ds_id] = self._create_dataset_entry(ds_id)
-        return self.dataset_cache[ds_id]
-
-    def _create_dataset_entry(self, ds_id: str) -> Tuple[MultiLevelDataset, Dict[str, Any]]:
+    @classmethod
+    def _get_color_mappings(cls, config: Config) -> Dict[Tuple[str, str], Tuple[str, float, float]]:
+        """
+        Flatten the color mappings of all configured datasets into a mapping (ds_id, var_name) -> (cbar, vmin, vmax).
+
+        :param config: the service configuration
+        :return: the flattened color mappings
+        """
+        styles = dict()
+        for style in config.get('Styles') or []:
+            # Last style wins, if identifiers are not unique
+            styles[style['Identifier']] = style
+        color_mappings = dict()
+        for dataset_descriptor in config.get('Datasets') or []:
+            ds_id = dataset_descriptor.get('Identifier')
+            style = styles.get(dataset_descriptor.get('Style', 'default'))
+            # TODO: check color_mappings is not None
+            if not style or not style.get('ColorMappings'):
+                continue
+            for var_name, color_mapping in style['ColorMappings'].items():
+                if color_mapping and (ds_id, var_name) not in color_mappings:
+                    cmap_cbar = color_mapping.get('ColorBar', DEFAULT_CMAP_CBAR)
+                    cmap_vmin, cmap_vmax = color_mapping.get('ValueRange', (DEFAULT_CMAP_VMIN, DEFAULT_CMAP_VMAX))
+                    color_mappings[ds_id, var_name] = cmap_cbar, cmap_vmin, cmap_vmax
+        return color_mappings
+
+    def _get_dataset_entry(self, ds_id: str) -> Tuple[MultiLevelDataset, Dict[str, Any], str]:
+        with self._dataset_cache_lock:
+            dataset_entry = self.dataset_cache.get(ds_id)
+            if dataset_entry is not None:
+                self.dataset_cache.move_to_end(ds_id)
+                return dataset_entry
+        with self._lock:
+            with self._dataset_cache_lock:
+                dataset_entry = self.dataset_cache.get(ds_id)
+            if dataset_entry is not None:
+                # Opened by another thread meanwhile
+                return dataset_entry
+            dataset_entry = self._create_dataset_entry(ds_id)
+            discarded_ds_ids = []
+            with self._dataset_cache_lock:
+                self.dataset_cache[ds_id] = dataset_entry
+                _, _, dataset_tag = dataset_entry
+                if self._dataset_tags.get(ds_id) != dataset_tag:
+                    # Not if an unchanged dataset is reopened, e.g. after it has been discarded
+                    self._dataset_tags[ds_id] = dataset_tag
+                    self._datasets_version += 1
+                capacity = self._dataset_cache_capacity
+                while capacity is not None and len(self.dataset_cache) > capacity:
+                    # Discard least recently used dataset. It is not closed, because requests in progress
+                    # may still read from it, it is closed once it is no longer referenced.
+                    discarded_ds_id, _ = self.dataset_cache.popitem(last=False)
+                    discarded_ds_ids.append(discarded_ds_id)
+            for discarded_ds_id in discarded_ds_ids:
+                # Tiled images reference the dataset's arrays, so they would keep it in memory
+                self.image_cache.remove_values(lambda image_key: image_key[0] == discarded_ds_id)
+                _LOG.info(f'Discarded dataset {discarded_ds_id!r} to stay within dataset cache capacity')
+            return dataset_entry
+
+    def _create_dataset_entry(self, ds_id: str) -> Tuple[MultiLevelDataset, Dict[str, Any], str]:
 
         dataset_descriptor = self.get_dataset_descriptor(ds_id)
 
@@ -214,6 +329,9 @@ class ServiceContext:
 
         t1 = time.perf_counter()
 
+        # Derived from the dataset's storage if possible, so that it is equal in all processes
+        dataset_tag = None
+
         fs_type = dataset_descriptor.get('FileSystem', 'local')
         if fs_type == 'obs':
             data_format = dataset_descriptor.get('Format', 'zarr')
@@ -222,22 +340,24 @@ class ServiceContext:
                 s3_client_kwargs['endpoint_url'] = dataset_descriptor['Endpoint']
             if 'Region' in dataset_descriptor:
                 s3_client_kwargs['region_name'] = dataset_descriptor['Region']
-            obs_file_system = s3fs.S3FileSystem(anon=True, client_kwargs=s3_client_kwargs)
+            obs_file_system = _get_obs_file_system(s3_client_kwargs)
+            prefetch_depth = dataset_descriptor.get('PrefetchDepth', OBS_PREFETCH_DEPTH)
+            dataset_tag = _get_obs_dataset_tag(obs_file_system, path)
             if data_format == 'zarr':
-                store = s3fs.S3Map(root=path, s3=obs_file_system, check=False)
-                cached_store = zarr.LRUStoreCache(store, max_size=2 ** 28)
                 with measure_time(tag=f"opened remote zarr dataset {path}"):
-                    ds = xr.open_zarr(cached_store)
+                    ds = open_obs_zarr(obs_file_system, path, prefetch_depth=prefetch_depth)
                 ml_dataset = BaseMultiLevelDataset(ds)
             elif data_format == 'levels':
                 with measure_time(tag=f"opened remote levels dataset {path}"):
                     ml_dataset = ObjectStorageMultiLevelDataset(ds_id, obs_file_system, path,
-                                                                exception_type=ServiceConfigError)
+                                                                exception_type=ServiceConfigError,
+                                                                prefetch_depth=prefetch_depth)
             else:
                 raise ServiceConfigError(f"Invalid format={data_format!r} in dataset descriptor {ds_id!r}")
         elif fs_type == 'local':
             if not os.path.isabs(path):
                 path = os.path.join(self.base_dir, path)
+            dataset_tag = _get_local_dataset_tag(path)
 
             data_format = dataset_descriptor.get('Format', 'nc')
             if data_format == 'nc':
@@ -246,7 +366,7 @@ class ServiceContext:
                     ml_dataset = BaseMultiLevelDataset(ds)
             elif data_format == 'zarr':
                 with measure_time(tag=f"opened local zarr dataset {path}"):
-                    ds = xr.open_zarr(path)
+                    ds = open_local_zarr(path)
                     ml_dataset = BaseMultiLevelDataset(ds)
             elif data_format == 'levels':
                 with measure_time(tag=f"opened local levels dataset {path}"):
@@ -276,6 +396,13 @@ class ServiceContext:
                                                        input_parameters,
                                                        exception_type=ServiceConfigError)
 
+            script_tag = _get_local_dataset_tag(path)
+            if script_tag is not None:
+                # Changes with the script and with any of the input datasets
+                tags = [script_tag] + [self.get_dataset_tag(input_dataset_id)
+                                       for input_dataset_id in input_dataset_ids]
+                dataset_tag = hashlib.sha1(' '.join(tags).encode('utf-8')).hexdigest()[:16]
+
         else:
             raise ServiceConfigError(f"Invalid fs={fs_type!r} in dataset descriptor {ds_id!r}")
 
@@ -284,7 +411,11 @@ class ServiceContext:
         if self.config.get("trace_perf", False):
             _LOG.info(f'Opening {ds_id!r} took {t2 - t1} seconds')
 
-        return ml_dataset, dataset_descriptor
+        if dataset_tag is None:
+            # The time of opening, differs between processes and whenever the dataset is reopened
+            dataset_tag = '%x' % time.time_ns()
+
+        return ml_dataset, dataset_descriptor, dataset_tag
 
     def get_legend_label(self, ds_name: str, var_name: str):
         dataset = self.get_dataset(ds_name)
@@ -436,14 +567,11 @@ class ServiceContext:
                     var_indexers[dim_name] = coord_var.values[0]
                 elif dim_value_str == 'current':
                     var_indexers[dim_name] = coord_var.values[-1]
-                elif np.issubdtype(coord_var.dtype, np.floating):
-                    var_indexers[dim_name] = float(dim_value_str)
-                elif np.issubdtype(coord_var.dtype, np.integer):
-                    var_indexers[dim_name] = int(dim_value_str)
-                elif np.issubdtype(coord_var.dtype, np.datetime64):
-                    var_indexers[dim_name] = pd.to_datetime(dim_value_str)
                 else:
-                    raise ValueError(f'unable to dimension value {dim_value_str!r} to {coord_var.dtype!r}')
+                    parse_dim_value = _DIM_VALUE_PARSERS.get(coord_var.dtype.kind)
+                    if parse_dim_value is None:
+                        raise ValueError(f'unable to dimension value {dim_value_str!r} to {coord_var.dtype!r}')
+                    var_indexers[dim_name] = parse_dim_value(dim_value_str)
             except ValueError as e:
                 raise ServiceBadRequestError(
                     f'{dim_value_str!r} is not a valid value for dimension {dim_name!r} '
@@ -454,5 +582,57 @@ class ServiceContext:
     def find_dataset_descriptor(cls,
                                 dataset_descriptors: List[Dict[str, Any]],
                                 ds_name: str) -> Optional[Dict[str, Any]]:
-        # TODO: optimize by dict/key lookup
+        # Linear search, use get_dataset_descriptor() for the configured descriptors
         return next((dsd for dsd in dataset_descriptors if dsd['Identifier'] == ds_name), None)
+
+
+def _get_obs_file_system(s3_client_kwargs: Dict[str, Any]) -> s3fs.S3FileSystem:
+    key = s3_client_kwargs.get('endpoint_url'), s3_client_kwargs.get('region_name')
+    with _OBS_FILE_SYSTEMS_LOCK:
+        obs_file_system = _OBS_FILE_SYSTEMS.get(key)
+        if obs_file_system is None:
+            # Chunks of tiles, time series, etc. are read concurrently. botocore keeps only 10 connections
+            # alive by default, so most concurrent reads would open new connections and discard them afterwards.
+            obs_file_system = s3fs.S3FileSystem(anon=True, client_kwargs=s3_client_kwargs,
+                                                config_kwargs=dict(max_pool_connections=OBS_MAX_POOL_CONNECTIONS))
+            _OBS_FILE_SYSTEMS[key] = obs_file_system
+        return obs_file_system
+
+
+def _get_local_dataset_tag(path: str) -> Optional[str]:
+    """
+    Get a tag from the modification time and size of the file at *path*.
+    For zarr directories, the consolidated metadata is used, because the modification time of
+    a directory only changes when entries are added or removed.
+    """
+    zmetadata_path = os.path.join(path, '.zmetadata')
+    try:
+        stat = os.stat(zmetadata_path if os.path.isfile(zmetadata_path) else path)
+    except OSError:
+        return None
+    return '%x-%x' % (stat.st_mtime_ns, stat.st_size)
+
+
+def _get_obs_dataset_tag(obs_file_system: s3fs.S3FileSystem, path: str) -> Optional[str]:
+    """
+    Get a tag from the ETag or the last modification time of the metadata of the zarr dataset at *path*.
+    """
+    for key in ('.zmetadata', '.zgroup'):
+        try:
+            info = obs_file_system.info(f'{path}/{key}')
+        except (OSError, ValueError):
+            continue
+        tag = info.get('ETag') or info.get('LastModified')
+        if tag:
+            return str(tag).strip('"')
+    return None
+
+
+def _new_response_cache() -> LruMemoryCache:
+    return LruMemoryCache(capacity=RESPONSE_CACHE_CAPACITY, size_function=lambda response: 1)
+
+
+def _get_config_tag(config: Config) -> str:
+    # A canonical serialization, so that configurations which only differ in key order get equal tags
+    config_json = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.blake2b(config_json.encode('utf-8'), digest_size=8).hexdigest()
@@ -1,36 +1,112 @@
+import concurrent.futures
 import io
 import logging
-from typing import Dict, Any
+import threading
+from typing import Dict, Any, Optional, Tuple, Iterable, List
 
+import dask
 import matplotlib
 import matplotlib.cm as cm
 import matplotlib.colorbar
 import matplotlib.colors
 import matplotlib.figure
 import numpy as np
+import xarray as xr
 
+from ..cache import LruMemoryCache
 from ..context import ServiceContext
-from ..defaults import DEFAULT_CMAP_WIDTH, DEFAULT_CMAP_HEIGHT
+from ..defaults import DEFAULT_CMAP_WIDTH, DEFAULT_CMAP_HEIGHT, PRELOAD_TILE_LEVELS
 from ..errors import ServiceBadRequestError, ServiceResourceNotFoundError
-from ..im import NdarrayImage, TransformArrayImage, ColorMappedRgbaImage, ColorMappedRgbaImage2, TileGrid
+from ..im import NdarrayImage, TransformArrayImage, ColorMappedRgbaImage, ColorMappedRgbaImage2, TileGrid, \
+    TiledImage, QUANTIZED_NO_DATA, mask_array, quantize_array
 from ..ne2 import NaturalEarth2Image
 from ..perf import measure_time_cm
 from ..reqparams import RequestParams
 
 _LOG = logging.getLogger('xcube')
 
+# Executor used to preload tiles in the background
+_PRELOAD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='xcube-tile-preload')
+# IDs of tiles scheduled for preloading
+_PRELOAD_TILE_IDS = set()
+# Maximum number of tiles scheduled for preloading, further tiles are not preloaded
+_MAX_PRELOAD_TILES = 256
+_PRELOAD_LOCK = threading.Lock()
+# Locks used to create tiled images, selected by the hash of the image key
+_IMAGE_LOCKS = tuple(threading.Lock() for _ in range(64))
+
+
+class TileParams:
+    """
+    The parameters of a dataset tile request, parsed once per request.
+
+    :param x: The tile's x index
+    :param y: The tile's y index
+    :param z: The tile's z index, i.e. the pyramid level
+    :param tile_comp_mode: The tile computation mode
+    :param trace_perf: Whether to trace tile computation performance
+    :param cmap_cbar: Optional color bar name
+    :param cmap_vmin: Optional minimum value of the color mapping
+    :param cmap_vmax: Optional maximum value of the color mapping
+    """
+
+    __slots__ = ('x', 'y', 'z', 'tile_comp_mode', 'trace_perf', 'cmap_cbar', 'cmap_vmin', 'cmap_vmax')
+
+    def __init__(self,
+                 x: int, y: int, z: int,
+                 tile_comp_mode: Optional[int] = None,
+                 trace_perf: bool = False,
+                 cmap_cbar: Optional[str] = None,
+                 cmap_vmin: Optional[float] = None,
+                 cmap_vmax: Optional[float] = None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.tile_comp_mode = tile_comp_mode
+        self.trace_perf = trace_perf
+        self.cmap_cbar = cmap_cbar
+        self.cmap_vmin = cmap_vmin
+        self.cmap_vmax = cmap_vmax
+
+    @classmethod
+    def from_request_params(cls,
+                            x: str, y: str, z: str,
+                            params: RequestParams,
+                            default_tile_comp_mode: Optional[int] = None,
+                            default_trace_perf: bool = False) -> 'TileParams':
+        """
+        Parse the tile indices and the tile-related query arguments of a request.
+
+        :param x: The tile's x index
+        :param y: The tile's y index
+        :param z: The tile's z index
+        :param params: The request parameters
+        :param default_tile_comp_mode: Tile computation mode used if query argument "mode" is not given
+        :param default_trace_perf: Value used if query argument "debug" is not given
+        :return: a new TileParams instance
+        :raise: ServiceBadRequestError
+        """
+        return TileParams(RequestParams.to_int('x', x),
+                          RequestParams.to_int('y', y),
+                          RequestParams.to_int('z', z),
+                          tile_comp_mode=params.get_query_argument_int('mode', default_tile_comp_mode),
+                          trace_perf=params.get_query_argument_int('debug', default_trace_perf) != 0,
+                          cmap_cbar=params.get_query_argument('cbar', default=None),
+                          cmap_vmin=params.get_query_argument_float('vmin', default=None),
+                          cmap_vmax=params.get_query_argument_float('vmax', default=None))
+
 
 def get_dataset_tile(ctx: ServiceContext,
                      ds_id: str,
                      var_name: str,
                      x: str, y: str, z: str,
                      params: RequestParams):
-    x = RequestParams.to_int('x', x)
-    y = RequestParams.to_int('y', y)
-    z = RequestParams.to_int('z', z)
-
-    tile_comp_mode = params.get_query_argument_int('mode', ctx.tile_comp_mode)
-    trace_perf = params.get_query_argument_int('debug', ctx.trace_perf) != 0
+    tile_params = TileParams.from_request_params(x, y, z, params,
+                                                 default_tile_comp_mode=ctx.tile_comp_mode,
+                                                 default_trace_perf=ctx.trace_perf)
+    x, y, z = tile_params.x, tile_params.y, tile_params.z
+    tile_comp_mode = tile_params.tile_comp_mode
+    trace_perf = tile_params.trace_perf
 
     measure_time = measure_time_cm(logger=_LOG, disabled=not trace_perf)
 
@@ -45,103 +121,303 @@ def get_dataset_tile(ctx: ServiceContext,
 
     var_indexers = ctx.get_var_indexers(ds_id, var_name, var, dim_names, params)
 
-    cmap_cbar = params.get_query_argument('cbar', default=None)
-    cmap_vmin = params.get_query_argument_float('vmin', default=None)
-    cmap_vmax = params.get_query_argument_float('vmax', default=None)
+    cmap_cbar = tile_params.cmap_cbar
+    cmap_vmin = tile_params.cmap_vmin
+    cmap_vmax = tile_params.cmap_vmax
     if cmap_cbar is None or cmap_vmin is None or cmap_vmax is None:
         default_cmap_cbar, default_cmap_vmin, default_cmap_vmax = ctx.get_color_mapping(ds_id, var_name)
         cmap_cbar = cmap_cbar or default_cmap_cbar
         cmap_vmin = cmap_vmin or default_cmap_vmin
         cmap_vmax = cmap_vmax or default_cmap_vmax
 
-    image_id = '-'.join([ds_id, f"{z}", var_name]
-                        + [f'{dim_name}={dim_value}' for dim_name, dim_value in var_indexers.items()])
-
-    if image_id in ctx.image_cache:
-        image = ctx.image_cache[image_id]
-    else:
-        no_data_value = var.attrs.get('_FillValue')
-        valid_range = var.attrs.get('valid_range')
-        if valid_range is None:
-            valid_min = var.attrs.get('valid_min')
-            valid_max = var.attrs.get('valid_max')
-            if valid_min is not None and valid_max is not None:
-                valid_range = [valid_min, valid_max]
-
-        # Make sure we work with 2D image arrays only
-        if var.ndim == 2:
-            assert len(var_indexers) == 0
-            array = var
-        elif var.ndim > 2:
-            assert len(var_indexers) == var.ndim - 2
-            array = var.sel(method='nearest', **var_indexers)
-        else:
-            raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{var_name}" '
-                                         'must be an N-D Dataset with N >= 2, '
-                                         f'but "{var_name}" is only {var.ndim}-D')
-
-        cmap_vmin = np.nanmin(array.values) if np.isnan(cmap_vmin) else cmap_vmin
-        cmap_vmax = np.nanmax(array.values) if np.isnan(cmap_vmax) else cmap_vmax
-
-        tile_grid = ctx.get_tile_grid(ds_id)
-
-        if not tile_comp_mode:
-            image = NdarrayImage(array,
-                                 image_id=f'ndai-{image_id}',
-                                 tile_size=tile_grid.tile_size,
-                                 # tile_cache=ctx.mem_tile_cache,
-                                 trace_perf=trace_perf)
-            image = TransformArrayImage(image,
-                                        image_id=f'tai-{image_id}',
-                                        flip_y=tile_grid.inv_y,
-                                        force_masked=True,
-                                        no_data_value=no_data_value,
-                                        valid_range=valid_range,
-                                        # tile_cache=ctx.mem_tile_cache,
-                                        trace_perf=trace_perf)
-            image = ColorMappedRgbaImage(image,
-                                         image_id=f'rgb-{image_id}',
-                                         value_range=(cmap_vmin, cmap_vmax),
-                                         cmap_name=cmap_cbar,
-                                         encode=True,
-                                         format='PNG',
-                                         tile_cache=ctx.mem_tile_cache,
-                                         trace_perf=trace_perf)
+    # Tiled images are looked up by a tuple key, which is cheaper to create than the string image ID.
+    # NaN value range limits are represented by None, because NaN never equals NaN.
+    image_key = (ds_id, z, var_name, cmap_cbar,
+                 None if np.isnan(cmap_vmin) else cmap_vmin,
+                 None if np.isnan(cmap_vmax) else cmap_vmax,
+                 *var_indexers.items())
+
+    image = ctx.image_cache.get_value(image_key)
+
+    tile_cache = ctx.mem_tile_cache
+    if tile_cache is not None:
+        # Short-cut: return the final tile if already cached, so we don't need to (re)create the tiled image.
+        # The tile ID must be the same as used by the RGBA image, see OpImage.get_tile_id().
+        # A cached image knows its ID, so the lengthy image ID is only formatted if the image is gone.
+        if image is not None:
+            tile_id = image.get_tile_id(x, y)
         else:
-            image = ColorMappedRgbaImage2(array,
-                                          image_id=f'rgb-{image_id}',
-                                          tile_size=tile_grid.tile_size,
-                                          cmap_range=(cmap_vmin, cmap_vmax),
-                                          cmap_name=cmap_cbar,
-                                          encode=True,
-                                          format='PNG',
-                                          flip_y=tile_grid.inv_y,
-                                          no_data_value=no_data_value,
-                                          valid_range=valid_range,
-                                          tile_cache=ctx.mem_tile_cache,
-                                          trace_perf=trace_perf)
-
-        ctx.image_cache[image_id] = image
-        if trace_perf:
-            _LOG.info(f'Created tiled image {image_id!r} of size {image.size} with tile grid:')
-            _LOG.info(f'  num_levels: {tile_grid.num_levels}')
-            _LOG.info(f'  num_level_zero_tiles: {tile_grid.num_tiles(0)}')
-            _LOG.info(f'  tile_size: {tile_grid.tile_size}')
-            _LOG.info(f'  geo_extent: {tile_grid.geo_extent}')
-            _LOG.info(f'  inv_y: {tile_grid.inv_y}')
+            tile_id = f'rgb-{_get_image_id(ds_id, z, var_name, var_indexers, cmap_cbar, cmap_vmin, cmap_vmax)}/{x}/{y}'
+        tile = tile_cache.get_value(tile_id)
+        if tile is not None:
+            if trace_perf:
+                _LOG.info(f'<<< tile {tile_id} at level {z}: restored from tile cache')
+            return tile
+
+    if image is None:
+        # Viewers request many tiles of a new image at once, so make sure it is created only once
+        with _IMAGE_LOCKS[hash(image_key) % len(_IMAGE_LOCKS)]:
+            image = ctx.image_cache.get_value(image_key)
+            if image is None:
+                image_id = _get_image_id(ds_id, z, var_name, var_indexers, cmap_cbar, cmap_vmin, cmap_vmax)
+                # All tiles of the coarsest levels will be requested soon, so load their data at once
+                image = _new_tiled_image(ctx, ds_id, var_name, var, var_indexers, image_id,
+                                         cmap_cbar, cmap_vmin, cmap_vmax, tile_comp_mode,
+                                         z < PRELOAD_TILE_LEVELS, trace_perf)
+                ctx.image_cache.put_value(image_key, image)
+                if tile_cache is not None and z < PRELOAD_TILE_LEVELS:
+                    # Tiles of the coarsest levels are requested first by any viewer, so compute them in advance
+                    num_tiles_x, num_tiles_y = image.num_tiles
+                    _preload_tiles(image, tile_cache,
+                                   [(tile_x, tile_y)
+                                    for tile_y in range(num_tiles_y)
+                                    for tile_x in range(num_tiles_x)
+                                    if tile_x != x or tile_y != y],
+                                   trace_perf)
 
     if trace_perf:
-        _LOG.info(f'>>> tile {image_id}/{z}/{y}/{x}')
+        _LOG.info(f'>>> tile {image.get_tile_id(x, y)} at level {z}')
 
     with measure_time() as measured_time:
         tile = image.get_tile(x, y)
 
     if trace_perf:
-        _LOG.info(f'<<< tile {image_id}/{z}/{y}/{x}: took ' + '%.2f seconds' % measured_time.duration)
+        _LOG.info(f'<<< tile {image.get_tile_id(x, y)} at level {z}: took '
+                  + '%.2f seconds' % measured_time.duration)
+
+    if tile_cache is not None:
+        # Neighboring tiles are likely to be requested next
+        _preload_tiles(image, tile_cache, _get_neighbor_tiles(image, x, y), trace_perf)
 
     return tile
 
 
+def _new_tiled_image(ctx: ServiceContext,
+                     ds_id: str,
+                     var_name: str,
+                     var: xr.DataArray,
+                     var_indexers: Dict[str, Any],
+                     image_id: str,
+                     cmap_cbar: str,
+                     cmap_vmin: float,
+                     cmap_vmax: float,
+                     tile_comp_mode: Optional[int],
+                     load_array: bool,
+                     trace_perf: bool) -> TiledImage:
+    measure_time = measure_time_cm(logger=_LOG, disabled=not trace_perf)
+
+    no_data_value = var.attrs.get('_FillValue')
+    valid_range = var.attrs.get('valid_range')
+    if valid_range is None:
+        valid_min = var.attrs.get('valid_min')
+        valid_max = var.attrs.get('valid_max')
+        if valid_min is not None and valid_max is not None:
+            valid_range = [valid_min, valid_max]
+
+    # Make sure we work with 2D image arrays only
+    if var.ndim == 2:
+        assert len(var_indexers) == 0
+        array = var
+    elif var.ndim > 2:
+        assert len(var_indexers) == var.ndim - 2
+        array = _get_var_2d_array(var, var_indexers)
+    else:
+        raise ServiceBadRequestError(f'Variable "{var_name}" of dataset "{var_name}" '
+                                     'must be an N-D Dataset with N >= 2, '
+                                     f'but "{var_name}" is only {var.ndim}-D')
+
+    # Tiles are subsets of tile_array. Slicing plain (dask) arrays is much faster than slicing DataArrays.
+    tile_array = array
+    if array.chunks is not None:
+        if load_array:
+            # Level images of multi-level datasets are often strided views into the full-resolution chunks.
+            # Computing the (small) image array at once reads every chunk only once and keeps the result,
+            # instead of reading the full-resolution chunks again for every tile.
+            with measure_time() as measured_time:
+                array = array.compute()
+            if trace_perf:
+                _LOG.info(f'Loaded array of {image_id!r}: took ' + '%.2f seconds' % measured_time.duration)
+        # Either in memory or lazy dask array, so this won't load anything
+        tile_array = array.data
+
+    if np.isnan(cmap_vmin) or np.isnan(cmap_vmax):
+        with measure_time() as measured_time:
+            array_min, array_max = _get_array_value_range(array)
+        if trace_perf:
+            _LOG.info(f'Computed value range of {image_id!r}: took ' + '%.2f seconds' % measured_time.duration)
+        cmap_vmin = array_min if np.isnan(cmap_vmin) else cmap_vmin
+        cmap_vmax = array_max if np.isnan(cmap_vmax) else cmap_vmax
+
+    tile_grid = ctx.get_tile_grid(ds_id)
+
+    if not tile_comp_mode and load_array:
+        # The image array is in memory and the image is specific to the value range,
+        # so we map values to color indices only once. Tiles are then color-mapped by plain table lookups.
+        with measure_time() as measured_time:
+            index_array = quantize_array(mask_array(array.values, no_data_value=no_data_value, valid_range=valid_range),
+                                         (cmap_vmin, cmap_vmax),
+                                         no_data_value=no_data_value)
+        if trace_perf:
+            _LOG.info(f'Quantized array of {image_id!r}: took ' + '%.2f seconds' % measured_time.duration)
+        image = NdarrayImage(index_array,
+                             image_id=f'ndai-{image_id}',
+                             tile_size=tile_grid.tile_size,
+                             fill_value=QUANTIZED_NO_DATA,
+                             trace_perf=trace_perf)
+        image = TransformArrayImage(image,
+                                    image_id=f'tai-{image_id}',
+                                    flip_y=tile_grid.inv_y,
+                                    force_masked=False,
+                                    trace_perf=trace_perf)
+        image = ColorMappedRgbaImage(image,
+                                     image_id=f'rgb-{image_id}',
+                                     value_range=(cmap_vmin, cmap_vmax),
+                                     cmap_name=cmap_cbar,
+                                     encode=True,
+                                     format='PNG',
+                                     tile_cache=ctx.mem_tile_cache,
+                                     trace_perf=trace_perf,
+                                     quantized=True)
+    elif not tile_comp_mode:
+        image = NdarrayImage(tile_array,
+                             image_id=f'ndai-{image_id}',
+                             tile_size=tile_grid.tile_size,
+                             # tile_cache=ctx.mem_tile_cache,
+                             trace_perf=trace_perf)
+        image = TransformArrayImage(image,
+                                    image_id=f'tai-{image_id}',
+                                    flip_y=tile_grid.inv_y,
+                                    force_masked=True,
+                                    no_data_value=no_data_value,
+                                    valid_range=valid_range,
+                                    # tile_cache=ctx.mem_tile_cache,
+                                    trace_perf=trace_perf)
+        image = ColorMappedRgbaImage(image,
+                                     image_id=f'rgb-{image_id}',
+                                     value_range=(cmap_vmin, cmap_vmax),
+                                     cmap_name=cmap_cbar,
+                                     encode=True,
+                                     format='PNG',
+                                     tile_cache=ctx.mem_tile_cache,
+                                     trace_perf=trace_perf)
+    else:
+        image = ColorMappedRgbaImage2(tile_array,
+                                      image_id=f'rgb-{image_id}',
+                                      tile_size=tile_grid.tile_size,
+                                      cmap_range=(cmap_vmin, cmap_vmax),
+                                      cmap_name=cmap_cbar,
+                                      encode=True,
+                                      format='PNG',
+                                      flip_y=tile_grid.inv_y,
+                                      no_data_value=no_data_value,
+                                      valid_range=valid_range,
+                                      tile_cache=ctx.mem_tile_cache,
+                                      trace_perf=trace_perf)
+
+    if trace_perf:
+        _LOG.info(f'Created tiled image {image_id!r} of size {image.size} with tile grid:')
+        _LOG.info(f'  num_levels: {tile_grid.num_levels}')
+        _LOG.info(f'  num_level_zero_tiles: {tile_grid.num_tiles(0)}')
+        _LOG.info(f'  tile_size: {tile_grid.tile_size}')
+        _LOG.info(f'  geo_extent: {tile_grid.geo_extent}')
+        _LOG.info(f'  inv_y: {tile_grid.inv_y}')
+
+    return image
+
+
+def _get_image_id(ds_id: str, z: int, var_name: str, var_indexers: Dict[str, Any],
+                  cmap_cbar: str, cmap_vmin: float, cmap_vmax: float) -> str:
+    return '-'.join([ds_id, f"{z}", var_name]
+                    + [f'{dim_name}={dim_value}' for dim_name, dim_value in var_indexers.items()]
+                    + [f'cbar={cmap_cbar}', f'vmin={cmap_vmin}', f'vmax={cmap_vmax}'])
+
+
+def _get_array_value_range(array: xr.DataArray) -> Tuple[float, float]:
+    """
+    Get the minimum and maximum of *array* ignoring NaNs.
+
+    Other than ``np.nanmin(array.values)``, this doesn't load the entire array into memory,
+    if *array* is backed by a chunked dask array. Instead both reductions are computed
+    chunk-wise within a single pass over the data.
+
+    :param array: The array
+    :return: the tuple (min, max)
+    """
+    array_min = array.min(skipna=True)
+    array_max = array.max(skipna=True)
+    if array.chunks is not None:
+        array_min, array_max = dask.compute(array_min, array_max)
+    return float(array_min), float(array_max)
+
+
+def _preload_tiles(image: TiledImage, tile_cache: LruMemoryCache, tiles: Iterable[Tuple[int, int]], trace_perf: bool):
+    """
+    Compute the given *tiles* of *image* in the background so they end up in its *tile_cache*.
+    Tiles that are already cached or already scheduled for computation are ignored, and no more tiles
+    are scheduled once ``_MAX_PRELOAD_TILES`` are pending.
+
+    :param image: The tiled image, expected to use *tile_cache*
+    :param tile_cache: The image's tile cache
+    :param tiles: The (x, y) indexes of the tiles to be computed
+    :param trace_perf: Whether to trace tile computation performance
+    """
+    tile_ids = []
+    with _PRELOAD_LOCK:
+        for tile_x, tile_y in tiles:
+            if len(_PRELOAD_TILE_IDS) >= _MAX_PRELOAD_TILES:
+                break
+            tile_id = image.get_tile_id(tile_x, tile_y)
+            if tile_id not in _PRELOAD_TILE_IDS and tile_id not in tile_cache:
+                _PRELOAD_TILE_IDS.add(tile_id)
+                tile_ids.append((tile_id, tile_x, tile_y))
+    if tile_ids:
+        _PRELOAD_EXECUTOR.submit(_compute_tiles, image, tile_ids, trace_perf)
+
+
+def _compute_tiles(image: TiledImage, tile_ids: List[Tuple[str, int, int]], trace_perf: bool):
+    measure_time = measure_time_cm(logger=_LOG, disabled=not trace_perf)
+    with measure_time() as measured_time:
+        for tile_id, tile_x, tile_y in tile_ids:
+            try:
+                image.get_tile(tile_x, tile_y)
+            except Exception as e:
+                _LOG.warning(f'failed to preload tile {tile_id}: {e}')
+            finally:
+                with _PRELOAD_LOCK:
+                    _PRELOAD_TILE_IDS.discard(tile_id)
+    if trace_perf:
+        _LOG.info(f'Preloaded {len(tile_ids)} tile(s) of {image.id!r}: took '
+                  + '%.2f seconds' % measured_time.duration)
+
+
+def _get_neighbor_tiles(image: TiledImage, tile_x: int, tile_y: int) -> List[Tuple[int, int]]:
+    """
+    Get the (x, y) indexes of the up to eight tiles of *image* surrounding the tile at *tile_x*, *tile_y*.
+    """
+    num_tiles_x, num_tiles_y = image.num_tiles
+    return [(x, y)
+            for y in range(max(0, tile_y - 1), min(num_tiles_y, tile_y + 2))
+            for x in range(max(0, tile_x - 1), min(num_tiles_x, tile_x + 2))
+            if x != tile_x or y != tile_y]
+
+
+def _get_var_2d_array(var: xr.DataArray, var_indexers: Dict[str, Any]) -> xr.DataArray:
+    """
+    Get the 2D spatial slice of *var* selected by *var_indexers*, which map
+    non-spatial dimension names to coordinate values.
+
+    The nearest positions are looked up in the dimension indexes and then selected using ``var.isel()``.
+    This is much faster than xarray's label-based ``var.sel(method='nearest', ...)``, and unlike indexing
+    ``var.data``, it keeps lazily loaded variables lazy.
+
+    :param var: The variable
+    :param var_indexers: Maps non-spatial dimension names to coordinate values
+    :return: the 2D spatial slice
+    """
+    return var.isel({dim_name: int(var.indexes[dim_name].get_indexer([dim_value], method='nearest')[0])
+                     for dim_name, dim_value in var_indexers.items()})
+
+
 def get_legend(ctx: ServiceContext,
                ds_id: str,
                var_name: str,
@@ -1,4 +1,7 @@
 import math
+from xml.sax.saxutils import escape
+
+import numpy as np
 
 from ..context import ServiceContext
 
@@ -8,25 +11,108 @@ _WGS84_MEAN_EARTH_PERIMETER_IN_METERS = 2.0 * math.pi * _WGS84_MEAN_EARTH_RADIUS
 _WGS84_METERS_PER_DEGREE = _WGS84_MEAN_EARTH_PERIMETER_IN_METERS / 360.0
 _STD_PIXEL_SIZE_IN_METERS = 0.28e-3
 
+# Entities to be replaced in attribute values delimited by double quotes, in addition to &, <, and >
+_XML_ATTR_ENTITIES = {'"': '&quot;'}
 
-def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
-    service_identification_xml = (
-        f"\n"
-        f"    <ows:ServiceIdentification>\n"
-        f"        <ows:Title>xcube WMTS</ows:Title>\n"
-        f"        <ows:Abstract>Web Map Tile Service (WMTS) for xcube-conformant data cubes</ows:Abstract>\n"
-        f"        <ows:Keywords>\n"
-        f"            <ows:Keyword>tile</ows:Keyword>\n"
-        f"            <ows:Keyword>tile matrix set</ows:Keyword>\n"
-        f"            <ows:Keyword>map</ows:Keyword>\n"
-        f"        </ows:Keywords>\n"
-        f"        <ows:ServiceType>OGC WMTS</ows:ServiceType>\n"
-        f"        <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>\n"
-        f"        <ows:Fees>none</ows:Fees>\n"
-        f"        <ows:AccessConstraints>none</ows:AccessConstraints>\n"
-        f"    </ows:ServiceIdentification>\n"
-    )
+# Joins the values of a dimension into a sequence of <Value> elements
+_DIMENSION_VALUE_START = '                <Value>'
+_DIMENSION_VALUE_END = '</Value>\n'
+_DIMENSION_VALUE_SEPARATOR = _DIMENSION_VALUE_END + _DIMENSION_VALUE_START
+
+# Static parts of the capabilities document, see get_wmts_capabilities_xml()
+_SERVICE_IDENTIFICATION_XML = (
+    "\n"
+    "    <ows:ServiceIdentification>\n"
+    "        <ows:Title>xcube WMTS</ows:Title>\n"
+    "        <ows:Abstract>Web Map Tile Service (WMTS) for xcube-conformant data cubes</ows:Abstract>\n"
+    "        <ows:Keywords>\n"
+    "            <ows:Keyword>tile</ows:Keyword>\n"
+    "            <ows:Keyword>tile matrix set</ows:Keyword>\n"
+    "            <ows:Keyword>map</ows:Keyword>\n"
+    "        </ows:Keywords>\n"
+    "        <ows:ServiceType>OGC WMTS</ows:ServiceType>\n"
+    "        <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>\n"
+    "        <ows:Fees>none</ows:Fees>\n"
+    "        <ows:AccessConstraints>none</ows:AccessConstraints>\n"
+    "    </ows:ServiceIdentification>\n"
+)
+
+_OPERATIONS_METADATA_XML_TEMPLATE = (
+    "\n"
+    "    <ows:OperationsMetadata>\n"
+    "        <ows:Operation name=\"GetCapabilities\">\n"
+    "            <ows:DCP>\n"
+    "                <ows:HTTP>\n"
+    "                    <ows:Get xlink:href=\"{wmts_kvp_url}\">\n"
+    "                        <ows:Constraint name=\"GetEncoding\">\n"
+    "                            <ows:AllowedValues>\n"
+    "                                <ows:Value>KVP</ows:Value>\n"
+    "                            </ows:AllowedValues>\n"
+    "                        </ows:Constraint>\n"
+    "                    </ows:Get>\n"
+    "                    <ows:Get xlink:href=\"{wmts_rest_cap_url}\">\n"
+    "                        <ows:Constraint name=\"GetEncoding\">\n"
+    "                            <ows:AllowedValues>\n"
+    "                                <ows:Value>REST</ows:Value>\n"
+    "                            </ows:AllowedValues>\n"
+    "                        </ows:Constraint>\n"
+    "                    </ows:Get>\n"
+    "                </ows:HTTP>\n"
+    "            </ows:DCP>\n"
+    "        </ows:Operation>\n"
+    "        <ows:Operation name=\"GetTile\">\n"
+    "            <ows:DCP>\n"
+    "                <ows:HTTP>\n"
+    "                    <ows:Get xlink:href=\"{wmts_kvp_url}\">\n"
+    "                        <ows:Constraint name=\"GetEncoding\">\n"
+    "                            <ows:AllowedValues>\n"
+    "                                <ows:Value>KVP</ows:Value>\n"
+    "                            </ows:AllowedValues>\n"
+    "                        </ows:Constraint>\n"
+    "                    </ows:Get>\n"
+    "                    <ows:Get xlink:href=\"{wmts_rest_tile_url}\">\n"
+    "                        <ows:Constraint name=\"GetEncoding\">\n"
+    "                            <ows:AllowedValues>\n"
+    "                                <ows:Value>REST</ows:Value>\n"
+    "                            </ows:AllowedValues>\n"
+    "                        </ows:Constraint>\n"
+    "                    </ows:Get>\n"
+    "                </ows:HTTP>\n"
+    "            </ows:DCP>\n"
+    "        </ows:Operation>\n"
+    "    </ows:OperationsMetadata>\n"
+)
+
+_TILE_MATRIX_XML_TEMPLATE = (
+    '            <TileMatrix>\n'
+    '                <ows:Identifier>{level}</ows:Identifier>\n'
+    '                <ScaleDenominator>{scale_denominator}</ScaleDenominator>\n'
+    '                <TopLeftCorner>{lon1} {lat2}</TopLeftCorner>\n'
+    '                <TileWidth>{tile_size_x}</TileWidth>\n'
+    '                <TileHeight>{tile_size_y}</TileHeight>\n'
+    '                <MatrixWidth>{num_tiles_x}</MatrixWidth>\n'
+    '                <MatrixHeight>{num_tiles_y}</MatrixHeight>\n'
+    '            </TileMatrix>\n'
+)
+
+# Start of a <Layer> element, followed by its <Dimension> elements
+_LAYER_XML_TEMPLATE = (
+    '        <Layer>\n'
+    '            <ows:Identifier>{ds_name}.{var_name}</ows:Identifier>\n'
+    '            <ows:Title>{var_title}</ows:Title>\n'
+    '            <ows:Abstract>{var_abstract}</ows:Abstract>\n'
+    '            <ows:WGS84BoundingBox>\n'
+    '                <ows:LowerCorner>{lon1} {lat1}</ows:LowerCorner>\n'
+    '                <ows:UpperCorner>{lon2} {lat2}</ows:UpperCorner>\n'
+    '            </ows:WGS84BoundingBox>\n'
+    '            <Style isDefault="true"><ows:Identifier>Default</ows:Identifier></Style>\n'
+    '            <Format>image/png</Format>\n'
+    '            <TileMatrixSetLink><TileMatrixSet>{tile_grid_id}</TileMatrixSet></TileMatrixSetLink>\n'
+    '            <ResourceURL format="image/png" resourceType="tile" template="{layer_tile_url}"/>\n'
+)
 
+
+def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
     service_provider = ctx.config['ServiceProvider']
     service_contact = service_provider['ServiceContact']
     contact_info = service_contact['ContactInfo']
@@ -36,23 +122,24 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
     service_provider_xml = (
         f"\n"
         f"    <ows:ServiceProvider>\n"
-        f"        <ows:ProviderName>{service_provider['ProviderName']}</ows:ProviderName>\n"
-        f"        <ows:ProviderSite xlink:href=\"{service_provider['ProviderSite']}\"/>\n"
+        f"        <ows:ProviderName>{_escape_text(service_provider['ProviderName'])}</ows:ProviderName>\n"
+        f"        <ows:ProviderSite xlink:href=\"{_escape_attr(service_provider['ProviderSite'])}\"/>\n"
         f"        <ows:ServiceContact>\n"
-        f"            <ows:IndividualName>{service_contact['IndividualName']}</ows:IndividualName>\n"
-        f"            <ows:PositionName>{service_contact['PositionName']}</ows:PositionName>\n"
+        f"            <ows:IndividualName>{_escape_text(service_contact['IndividualName'])}</ows:IndividualName>\n"
+        f"            <ows:PositionName>{_escape_text(service_contact['PositionName'])}</ows:PositionName>\n"
         f"            <ows:ContactInfo>\n"
         f"                <ows:Phone>\n"
-        f"                    <ows:Voice>{phone['Voice']}</ows:Voice>\n"
-        f"                    <ows:Facsimile>{phone['Facsimile']}</ows:Facsimile>\n"
+        f"                    <ows:Voice>{_escape_text(phone['Voice'])}</ows:Voice>\n"
+        f"                    <ows:Facsimile>{_escape_text(phone['Facsimile'])}</ows:Facsimile>\n"
         f"                </ows:Phone>\n"
         f"                <ows:Address>\n"
-        f"                    <ows:DeliveryPoint>{address['DeliveryPoint']}</ows:DeliveryPoint>\n"
-        f"                    <ows:City>{address['City']}</ows:City>\n"
-        f"                    <ows:AdministrativeArea>{address['AdministrativeArea']}</ows:AdministrativeArea>\n"
-        f"                    <ows:PostalCode>{address['PostalCode']}</ows:PostalCode>\n"
-        f"                    <ows:Country>{address['Country']}</ows:Country>\n"
-        f"                    <ows:ElectronicMailAddress>{address['ElectronicMailAddress']}"
+        f"                    <ows:DeliveryPoint>{_escape_text(address['DeliveryPoint'])}</ows:DeliveryPoint>\n"
+        f"                    <ows:City>{_escape_text(address['City'])}</ows:City>\n"
+        f"                    <ows:AdministrativeArea>{_escape_text(address['AdministrativeArea'])}"
+        f"</ows:AdministrativeArea>\n"
+        f"                    <ows:PostalCode>{_escape_text(address['PostalCode'])}</ows:PostalCode>\n"
+        f"                    <ows:Country>{_escape_text(address['Country'])}</ows:Country>\n"
+        f"                    <ows:ElectronicMailAddress>{_escape_text(address['ElectronicMailAddress'])}"
         f"</ows:ElectronicMailAddress>\n"
         f"                </ows:Address>\n"
         f"            </ows:ContactInfo>\n"
@@ -64,67 +151,47 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
     wmts_rest_cap_url = ctx.get_service_url(base_url, 'wmts/1.0.0/WMTSCapabilities.xml')
     wmts_rest_tile_url = ctx.get_service_url(base_url, 'wmts/1.0.0/')
 
-    operations_metadata_xml = (
-        f"\n"
-        f"    <ows:OperationsMetadata>\n"
-        f"        <ows:Operation name=\"GetCapabilities\">\n"
-        f"            <ows:DCP>\n"
-        f"                <ows:HTTP>\n"
-        f"                    <ows:Get xlink:href=\"{wmts_kvp_url}\">\n"
-        f"                        <ows:Constraint name=\"GetEncoding\">\n"
-        f"                            <ows:AllowedValues>\n"
-        f"                                <ows:Value>KVP</ows:Value>\n"
-        f"                            </ows:AllowedValues>\n"
-        f"                        </ows:Constraint>\n"
-        f"                    </ows:Get>\n"
-        f"                    <ows:Get xlink:href=\"{wmts_rest_cap_url}\">\n"
-        f"                        <ows:Constraint name=\"GetEncoding\">\n"
-        f"                            <ows:AllowedValues>\n"
-        f"                                <ows:Value>REST</ows:Value>\n"
-        f"                            </ows:AllowedValues>\n"
-        f"                        </ows:Constraint>\n"
-        f"                    </ows:Get>\n"
-        f"                </ows:HTTP>\n"
-        f"            </ows:DCP>\n"
-        f"        </ows:Operation>\n"
-        f"        <ows:Operation name=\"GetTile\">\n"
-        f"            <ows:DCP>\n"
-        f"                <ows:HTTP>\n"
-        f"                    <ows:Get xlink:href=\"{wmts_kvp_url}\">\n"
-        f"                        <ows:Constraint name=\"GetEncoding\">\n"
-        f"                            <ows:AllowedValues>\n"
-        f"                                <ows:Value>KVP</ows:Value>\n"
-        f"                            </ows:AllowedValues>\n"
-        f"                        </ows:Constraint>\n"
-        f"                    </ows:Get>\n"
-        f"                    <ows:Get xlink:href=\"{wmts_rest_tile_url}\">\n"
-        f"                        <ows:Constraint name=\"GetEncoding\">\n"
-        f"                            <ows:AllowedValues>\n"
-        f"                                <ows:Value>REST</ows:Value>\n"
-        f"                            </ows:AllowedValues>\n"
-        f"                        </ows:Constraint>\n"
-        f"                    </ows:Get>\n"
-        f"                </ows:HTTP>\n"
-        f"            </ows:DCP>\n"
-        f"        </ows:Operation>\n"
-        f"    </ows:OperationsMetadata>\n"
+    operations_metadata_xml = _OPERATIONS_METADATA_XML_TEMPLATE.format(
+        wmts_kvp_url=_escape_attr(wmts_kvp_url),
+        wmts_rest_cap_url=_escape_attr(wmts_rest_cap_url),
+        wmts_rest_tile_url=_escape_attr(wmts_rest_tile_url)
     )
 
     dataset_descriptors = ctx.get_dataset_descriptors()
     written_tile_grids = []
-    indent = '    '
 
     layer_base_url = ctx.get_service_url(base_url, 'wmts/1.0.0/tile/%s/%s/{TileMatrix}/{TileRow}/{TileCol}.png')
 
+    # Rendered <Dimension> elements by dataset and dimension name
     dimensions_xml_cache = dict()
 
-    contents_xml_lines = [(0, '<Contents>')]
+    # Already indented lines, each terminated by a newline, joined only once.
+    # Contents and themes are collected in a single pass over the datasets and their variables.
+    contents_xml_lines = ['<Contents>\n']
+    themes_xml_lines = ['<Themes>\n']
     for dataset_descriptor in dataset_descriptors:
         ds_name = dataset_descriptor['Identifier']
         ds = ctx.get_dataset(ds_name)
-        for var_name in ds.data_vars:
-            var = ds[var_name]
-            if len(var.shape) <= 2 or var.dims[-1] != 'lon' or var.dims[-2] != 'lat':
+        ds_title = dataset_descriptor.get('Title', ds.attrs.get('title', f'{ds_name} xcube dataset'))
+        ds_abstract = ds.attrs.get('comment', '')
+        themes_xml_lines.append(
+            f'        <Theme>\n'
+            f'            <ows:Title>{_escape_text(ds_title)}</ows:Title>\n'
+            f'            <ows:Abstract>{_escape_text(ds_abstract)}</ows:Abstract>\n'
+            f'            <ows:Identifier>{_escape_text(ds_name)}</ows:Identifier>\n'
+        )
+        for var_name, var in ds.data_vars.items():
+            var_title = var.attrs.get('title', var.attrs.get('long_name', var_name))
+            layer_id = _escape_text(f'{ds_name}.{var_name}')
+            themes_xml_lines.append(
+                f'            <Theme>\n'
+                f'                <ows:Title>{_escape_text(var_title)}</ows:Title>\n'
+                f'                <ows:Identifier>{layer_id}</ows:Identifier>\n'
+                f'                <LayerRef>{layer_id}</LayerRef>\n'
+                f'            </Theme>\n'
+            )
+
+            if var.ndim <= 2 or var.dims[-2:] != ('lat', 'lon'):
                 continue
 
             tile_grid = ctx.get_tile_grid(ds_name)
@@ -147,50 +214,41 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
                     pixel_span = tile_span_y / tile_size_y
                     scale_denominator_0 = pixel_span * _WGS84_METERS_PER_DEGREE / _STD_PIXEL_SIZE_IN_METERS
 
-                    contents_xml_lines.append((2, '<TileMatrixSet>'))
-                    contents_xml_lines.append((3, f'<ows:Identifier>{tile_grid_id}</ows:Identifier>'))
-                    contents_xml_lines.append((3, f'<ows:SupportedCRS>{supported_crs}</ows:SupportedCRS>'))
-                    contents_xml_lines.append((3, '<ows:BoundingBox>'))
-                    contents_xml_lines.append((4, f'<ows:LowerCorner>{lon1} {lat1}</ows:LowerCorner>'))
-                    contents_xml_lines.append((4, f'<ows:UpperCorner>{lon2} {lat2}</ows:UpperCorner>'))
-                    contents_xml_lines.append((3, '</ows:BoundingBox>'))
+                    contents_xml_lines.append(
+                        f'        <TileMatrixSet>\n'
+                        f'            <ows:Identifier>{tile_grid_id}</ows:Identifier>\n'
+                        f'            <ows:SupportedCRS>{supported_crs}</ows:SupportedCRS>\n'
+                        f'            <ows:BoundingBox>\n'
+                        f'                <ows:LowerCorner>{lon1} {lat1}</ows:LowerCorner>\n'
+                        f'                <ows:UpperCorner>{lon2} {lat2}</ows:UpperCorner>\n'
+                        f'            </ows:BoundingBox>\n'
+                    )
 
                     for level in range(tile_grid.num_levels):
                         factor = 2 ** level
                         num_tiles_x = tile_grid.num_level_zero_tiles_x * factor
                         num_tiles_y = tile_grid.num_level_zero_tiles_y * factor
                         scale_denominator = scale_denominator_0 / factor
-                        contents_xml_lines.append((3, '<TileMatrix>'))
-                        contents_xml_lines.append((4, f'<ows:Identifier>{level}</ows:Identifier>'))
-                        contents_xml_lines.append((4, f'<ScaleDenominator>{scale_denominator}</ScaleDenominator>'))
-                        contents_xml_lines.append((4, f'<TopLeftCorner>{lon1} {lat2}</TopLeftCorner>'))
-                        contents_xml_lines.append((4, f'<TileWidth>{tile_size_x}</TileWidth>'))
-                        contents_xml_lines.append((4, f'<TileHeight>{tile_size_y}</TileHeight>'))
-                        contents_xml_lines.append((4, f'<MatrixWidth>{num_tiles_x}</MatrixWidth>'))
-                        contents_xml_lines.append((4, f'<MatrixHeight>{num_tiles_y}</MatrixHeight>'))
-                        contents_xml_lines.append((3, '</TileMatrix>'))
-
-                    contents_xml_lines.append((2, '</TileMatrixSet>'))
-
-                var_title = ds_name + "/" + var.attrs.get('title', var.attrs.get('long_name', var_name))
+                        contents_xml_lines.append(
+                            _TILE_MATRIX_XML_TEMPLATE.format(level=level, scale_denominator=scale_denominator,
+                                                             lon1=lon1, lat2=lat2,
+                                                             tile_size_x=tile_size_x, tile_size_y=tile_size_y,
+                                                             num_tiles_x=num_tiles_x, num_tiles_y=num_tiles_y)
+                        )
+
+                    contents_xml_lines.append('        </TileMatrixSet>\n')
+
                 var_abstract = var.attrs.get('comment', '')
 
                 layer_tile_url = layer_base_url % (ds_name, var_name)
-                contents_xml_lines.append((2, '<Layer>'))
-                contents_xml_lines.append((3, f'<ows:Identifier>{ds_name}.{var_name}</ows:Identifier>'))
-                contents_xml_lines.append((3, f'<ows:Title>{var_title}</ows:Title>'))
-                contents_xml_lines.append((3, f'<ows:Abstract>{var_abstract}</ows:Abstract>'))
-                contents_xml_lines.append((3, '<ows:WGS84BoundingBox>'))
-                contents_xml_lines.append((4, f'<ows:LowerCorner>{lon1} {lat1}</ows:LowerCorner>'))
-                contents_xml_lines.append((4, f'<ows:UpperCorner>{lon2} {lat2}</ows:UpperCorner>'))
-                contents_xml_lines.append((3, '</ows:WGS84BoundingBox>'))
-                contents_xml_lines.append(
-                    (3, '<Style isDefault="true"><ows:Identifier>Default</ows:Identifier></Style>'))
-                contents_xml_lines.append((3, '<Format>image/png</Format>'))
-                contents_xml_lines.append(
-                    (3, f'<TileMatrixSetLink><TileMatrixSet>{tile_grid_id}</TileMatrixSet></TileMatrixSetLink>'))
                 contents_xml_lines.append(
-                    (3, f'<ResourceURL format="image/png" resourceType="tile" template="{layer_tile_url}"/>'))
+                    _LAYER_XML_TEMPLATE.format(ds_name=_escape_text(ds_name), var_name=_escape_text(var_name),
+                                               var_title=_escape_text(f'{ds_name}/{var_title}'),
+                                               var_abstract=_escape_text(var_abstract),
+                                               lon1=lon1, lat1=lat1, lon2=lon2, lat2=lat2,
+                                               tile_grid_id=tile_grid_id,
+                                               layer_tile_url=_escape_attr(layer_tile_url))
+                )
 
                 non_spatial_dims = var.dims[0:-2]
                 for dim_name in non_spatial_dims:
@@ -198,7 +256,7 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
                         continue
                     dimension_xml_key = f'{ds_name}.{dim_name}'
                     if dimension_xml_key in dimensions_xml_cache:
-                        dimensions_xml_lines = dimensions_xml_cache[dimension_xml_key]
+                        dimension_xml = dimensions_xml_cache[dimension_xml_key]
                     else:
                         coord_var = ds.coords[dim_name]
                         if len(coord_var.shape) != 1:
@@ -216,57 +274,46 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
                         units = 'ISO8601' if dim_name == 'time' else coord_var.attrs.get('units', '')
                         default = 'current' if dim_name == 'time' else '0'
                         current = 'true' if dim_name == 'time' else 'false'
-                        dimensions_xml_lines = [(3, '<Dimension>'),
-                                                (4, f'<ows:Identifier>{dim_name}</ows:Identifier>'),
-                                                (4, f'<ows:Title>{var_title}</ows:Title>'),
-                                                (4, f'<ows:UOM>{units}</ows:UOM>'),
-                                                (4, f'<Default>{default}</Default>'),
-                                                (4, f'<Current>{current}</Current>')]
+                        dimension_xml_lines = [f'            <Dimension>\n'
+                                               f'                <ows:Identifier>{_escape_text(dim_name)}'
+                                               f'</ows:Identifier>\n'
+                                               f'                <ows:Title>{_escape_text(var_title)}</ows:Title>\n'
+                                               f'                <ows:UOM>{_escape_text(units)}</ows:UOM>\n'
+                                               f'                <Default>{default}</Default>\n'
+                                               f'                <Current>{current}</Current>\n']
+                        # Values are converted to strings by NumPy, and the elements are joined in one go
                         if coord_bnds_var is not None:
-                            coord_bnds_var_values = coord_bnds_var.values
-                            for i in range(len(coord_var)):
-                                value1 = coord_bnds_var_values[i, 0]
-                                value2 = coord_bnds_var_values[i, 1]
-                                dimensions_xml_lines.append((4, f'<Value>{value1}/{value2}</Value>'))
+                            coord_bnds_var_values = coord_bnds_var.values[:len(coord_var)]
+                            values = np.char.add(np.char.add(coord_bnds_var_values[:, 0].astype(str), '/'),
+                                                 coord_bnds_var_values[:, 1].astype(str))
                         else:
-                            coord_var_values = coord_var.values
-                            for i in range(len(coord_var)):
-                                value = coord_var_values[i]
-                                dimensions_xml_lines.append((4, f'<Value>{value}</Value>'))
-                        dimensions_xml_lines.append((3, '</Dimension>'))
-                        dimensions_xml_cache[dimension_xml_key] = dimensions_xml_lines
+                            values = coord_var.values.astype(str)
+                        values = values.tolist()
+                        if coord_var.dtype.kind in 'OSU':
+                            # Only strings may contain characters to be escaped, numbers and times never do
+                            values = [escape(value) for value in values]
+                        if len(values) > 0:
+                            dimension_xml_lines.append(_DIMENSION_VALUE_START
+                                                       + _DIMENSION_VALUE_SEPARATOR.join(values)
+                                                       + _DIMENSION_VALUE_END)
+                        dimension_xml_lines.append('            </Dimension>\n')
+                        dimension_xml = ''.join(dimension_xml_lines)
+                        dimensions_xml_cache[dimension_xml_key] = dimension_xml
 
-                    contents_xml_lines.extend(dimensions_xml_lines)
-                contents_xml_lines.append((2, '</Layer>'))
+                    contents_xml_lines.append(dimension_xml)
+                contents_xml_lines.append('        </Layer>\n')
 
-    contents_xml_lines.append((1, '</Contents>'))
+        themes_xml_lines.append('        </Theme>\n')
 
-    contents_xml = '\n'.join(['%s%s' % (n * indent, xml) for n, xml in contents_xml_lines])
+    contents_xml_lines.append('    </Contents>')
 
-    themes_xml_lines = [(0, '<Themes>')]
-    for dataset_descriptor in dataset_descriptors:
-        ds_name = dataset_descriptor.get('Identifier')
-        ds = ctx.get_dataset(ds_name)
-        ds_title = dataset_descriptor.get('Title', ds.attrs.get('title', f'{ds_name} xcube dataset'))
-        ds_abstract = ds.attrs.get('comment', '')
-        themes_xml_lines.append((2, '<Theme>'))
-        themes_xml_lines.append((3, f'<ows:Title>{ds_title}</ows:Title>'))
-        themes_xml_lines.append((3, f'<ows:Abstract>{ds_abstract}</ows:Abstract>'))
-        themes_xml_lines.append((3, f'<ows:Identifier>{ds_name}</ows:Identifier>'))
-        for var_name in ds.data_vars:
-            var = ds[var_name]
-            var_title = var.attrs.get('title', var.attrs.get('long_name', var_name))
-            themes_xml_lines.append((3, '<Theme>'))
-            themes_xml_lines.append((4, f'<ows:Title>{var_title}</ows:Title>'))
-            themes_xml_lines.append((4, f'<ows:Identifier>{ds_name}.{var_name}</ows:Identifier>'))
-            themes_xml_lines.append((4, f'<LayerRef>{ds_name}.{var_name}</LayerRef>'))
-            themes_xml_lines.append((3, '</Theme>'))
-        themes_xml_lines.append((2, '</Theme>'))
-    themes_xml_lines.append((1, '</Themes>'))
-    themes_xml = '\n'.join(['%s%s' % (n * indent, xml) for n, xml in themes_xml_lines])
+    contents_xml = ''.join(contents_xml_lines)
+
+    themes_xml_lines.append('    </Themes>')
+    themes_xml = ''.join(themes_xml_lines)
 
     get_capablities_rest_url = ctx.get_service_url(base_url, 'wmts/1.0.0/WMTSCapabilities.xml')
-    service_metadata_url_xml = f'<ServiceMetadataURL xlink:href="{get_capablities_rest_url}"/>'
+    service_metadata_url_xml = f'<ServiceMetadataURL xlink:href="{_escape_attr(get_capablities_rest_url)}"/>'
 
     return (
         f"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
@@ -277,7 +324,7 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
         f"          xsi:schemaLocation=\"http://www.opengis.net/wmts/1.0"
         f" http://schemas.opengis.net/wmts/1.0.0/wmtsGetCapabilities_response.xsd\"\n"
         f"          version=\"1.0.0\">\n"
-        f"    {service_identification_xml}\n"
+        f"    {_SERVICE_IDENTIFICATION_XML}\n"
         f"    {service_provider_xml}\n"
         f"    {operations_metadata_xml}\n"
         f"    {contents_xml}\n"
@@ -285,3 +332,11 @@ def get_wmts_capabilities_xml(ctx: ServiceContext, base_url: str):
         f"    {service_metadata_url_xml}\n"
         f"</Capabilities>\n"
     )
+
+
+def _escape_text(value) -> str:
+    return escape(str(value))
+
+
+def _escape_attr(value) -> str:
+    return escape(str(value), _XML_ATTR_ENTITIES)
@@ -32,6 +32,9 @@ DEFAULT_UPDATE_PERIOD = 2.
 DEFAULT_LOG_PREFIX = os.path.abspath('xcube_server.log')
 DEFAULT_TILE_COMP_MODE = 0
 DEFAULT_TRACE_PERF = False
+DEFAULT_NUM_WORKERS = 1
+# Maximum number of opened datasets kept in memory by each process, None means no limit
+DEFAULT_DATASET_CACHE_SIZE = None
 
 DEFAULT_CMAP_CBAR = 'jet'
 DEFAULT_CMAP_VMIN = 0.
@@ -47,4 +50,23 @@ FILE_TILE_CACHE_PATH = './image-cache'
 
 MEM_TILE_CACHE_CAPACITY = 2 * _GIGAS
 
+# Seconds that clients may reuse a tile without revalidating it, after that its ETag is checked
+TILE_CACHE_MAX_AGE = 60 * 60
+
+# Capacity of the in-memory chunk cache of each zarr dataset opened from object storage
+OBS_STORE_CACHE_CAPACITY = 2 ** 30
+# Maximum number of kept-alive connections to each object storage endpoint
+OBS_MAX_POOL_CONNECTIONS = 64
+# Number of following chunks of a variable read ahead from object storage whenever a chunk is read, 0 disables it
+OBS_PREFETCH_DEPTH = 0
+# Maximum number of threads reading chunks ahead from object storage
+OBS_PREFETCH_MAX_WORKERS = 8
+
+# Maximum number of tiled images kept in memory
+IMAGE_CACHE_CAPACITY = 64
+# Maximum number of rendered responses, such as WMTS capabilities, kept in memory
+RESPONSE_CACHE_CAPACITY = 16
+# Number of coarsest pyramid levels whose tiles are preloaded into the memory tile cache
+PRELOAD_TILE_LEVELS = 2
+
 API_PREFIX = f"/api/{__version__}"
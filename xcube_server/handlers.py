@@ -19,9 +19,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import hashlib
 import json
 
+from tornado.escape import utf8, xhtml_escape
 from tornado.ioloop import IOLoop
+from tornado.web import StaticFileHandler
 
 from . import __version__, __description__
 from .controllers.catalogue import get_datasets, get_dataset_coordinates, get_color_bars, get_dataset
@@ -30,6 +34,7 @@ from .controllers.tiles import get_dataset_tile, get_dataset_tile_grid, get_ne2_
 from .controllers.time_series import get_time_series_info, get_time_series_for_point, get_time_series_for_geometry, \
     get_time_series_for_geometry_collection, get_time_series_for_feature_collection
 from .controllers.wmts import get_wmts_capabilities_xml
+from .defaults import TILE_CACHE_MAX_AGE
 from .errors import ServiceBadRequestError
 from .service import ServiceRequestHandler
 
@@ -52,9 +57,93 @@ _WMTS_KVP_LOWER_KEYS = [k.lower() for k in _WMTS_KVP_KEYS]
 _WMTS_VERSION = "1.0.0"
 _WMTS_TILE_FORMAT = "image/png"
 
+# Tiles are computed in a dedicated pool, so that many concurrent tile requests
+# don't starve other requests that also use the IOLoop's default executor.
+_TILE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='xcube-tile')
+
+# Passed as base URL to render cached responses, replaced by the actual base URL of each request
+_BASE_URL_PLACEHOLDER = '\0base_url\0'
+
+
+# noinspection PyAbstractClass
+class _CachedResponseHandler(ServiceRequestHandler):
+    """
+    Base class for handlers whose responses only depend on the service configuration, the opened datasets,
+    and the base URL. A response is rendered once and then served from the service context's response cache,
+    together with its ETag, until the configuration changes or datasets are (re)opened.
+    Conditional requests are answered with 304.
+    """
+
+    _etag = None
+
+    async def finish_cached(self, key, content_type: str, render, *args, with_base_url: bool = False):
+        """
+        Finish the request with the cached response for *key*, or render and cache it first.
+        Keys must not be derived from the request, otherwise clients could flush the cache.
+
+        :param key: Key of the response, must be hashable
+        :param content_type: The response's content type
+        :param render: Function that renders the response, called with the service context and *args*
+        :param args: Further arguments passed to *render*
+        :param with_base_url: Whether *render* expects the base URL as first argument after the service context.
+            The response is then rendered once for all base URLs and completed for each request.
+        """
+        ctx = self.service_context
+        datasets_version = ctx.datasets_version
+        cached_response = ctx.response_cache.get_value(key)
+        if cached_response is None or cached_response[0] != datasets_version:
+            if with_base_url:
+                args = (_BASE_URL_PLACEHOLDER,) + args
+            content = utf8(await IOLoop.current().run_in_executor(None, render, ctx, *args))
+            # If rendering (re)opened datasets, the response is rendered again next time
+            cached_response = datasets_version, hashlib.sha1(content).hexdigest(), content
+            ctx.response_cache.put_value(key, cached_response)
+        _, etag, content = cached_response
+        if with_base_url:
+            base_url = self.base_url
+            if content_type == 'application/xml':
+                # The base URL is part of attribute values
+                base_url = xhtml_escape(base_url)
+            base_url = utf8(base_url)
+            content = content.replace(utf8(_BASE_URL_PLACEHOLDER), base_url)
+            etag = hashlib.sha1(utf8(etag) + base_url).hexdigest()
+        self._etag = '"%s"' % etag
+        self.set_header('Content-Type', content_type)
+        self.finish(content)
+
+    def compute_etag(self):
+        return self._etag if self._etag is not None else super().compute_etag()
+
+
+# noinspection PyAbstractClass
+class _TileRequestHandler(ServiceRequestHandler):
+    """
+    Base class for tile handlers. A tile only depends on the request URI, the service configuration,
+    and the data it is computed from, so its ETag is derived from them. Conditional requests are answered
+    with 304 before the tile is computed.
+    """
+
+    async def prepare(self):
+        key = f'{self.service_context.config_tag} {await self.get_data_tag()} {self.request.uri}'
+        self.set_header('Etag', '"%s"' % hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest())
+        if any(b'current' in values for values in self.request.query_arguments.values()):
+            # The current time step changes as data is appended, so clients must revalidate every time
+            self.set_header('Cache-Control', 'no-cache')
+        else:
+            self.set_header('Cache-Control', f'public, max-age={TILE_CACHE_MAX_AGE}')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+
+    async def get_data_tag(self) -> str:
+        """
+        Get a tag that changes whenever the data changes from which the tile is computed.
+        """
+        return ''
+
 
 # noinspection PyAbstractClass
-class WMTSKvpHandler(ServiceRequestHandler):
+class WMTSKvpHandler(_CachedResponseHandler):
 
     async def get(self):
         # According to WMTS 1.0 spec, all WMTS-specific keys must be case insensitive.
@@ -68,12 +157,7 @@ class WMTSKvpHandler(ServiceRequestHandler):
             version = self.params.get_query_argument("version", _WMTS_VERSION)
             if version != _WMTS_VERSION:
                 raise ServiceBadRequestError(f'Value for "version" parameter must be "{_WMTS_VERSION}"')
-            capabilities = await IOLoop.current().run_in_executor(None,
-                                                                  get_wmts_capabilities_xml,
-                                                                  self.service_context,
-                                                                  self.base_url)
-            self.set_header("Content-Type", "application/xml")
-            self.finish(capabilities)
+            await self.finish_cached('wmts', "application/xml", get_wmts_capabilities_xml, with_base_url=True)
         elif request == "GetTile":
             version = self.params.get_query_argument("version", _WMTS_VERSION)
             if version != _WMTS_VERSION:
@@ -92,7 +176,7 @@ class WMTSKvpHandler(ServiceRequestHandler):
             x = self.params.get_query_argument_int("tilecol")
             y = self.params.get_query_argument_int("tilerow")
             z = self.params.get_query_argument_int("tilematrix")
-            tile = await IOLoop.current().run_in_executor(None,
+            tile = await IOLoop.current().run_in_executor(_TILE_EXECUTOR,
                                                           get_dataset_tile,
                                                           self.service_context,
                                                           ds_id, var_name,
@@ -118,15 +202,10 @@ class WMTSKvpHandler(ServiceRequestHandler):
 
 
 # noinspection PyAbstractClass
-class GetWMTSCapabilitiesXmlHandler(ServiceRequestHandler):
+class GetWMTSCapabilitiesXmlHandler(_CachedResponseHandler):
 
     async def get(self):
-        capabilities = await IOLoop.current().run_in_executor(None,
-                                                              get_wmts_capabilities_xml,
-                                                              self.service_context,
-                                                              self.base_url)
-        self.set_header('Content-Type', 'application/xml')
-        self.finish(capabilities)
+        await self.finish_cached('wmts', 'application/xml', get_wmts_capabilities_xml, with_base_url=True)
 
 
 # noinspection PyAbstractClass
@@ -159,16 +238,24 @@ class GetDatasetCoordsHandler(ServiceRequestHandler):
 
 
 # noinspection PyAbstractClass,PyBroadException
-class GetDatasetVarTileHandler(ServiceRequestHandler):
+class GetDatasetVarTileHandler(_TileRequestHandler):
+
+    async def get_data_tag(self) -> str:
+        ds_id = self.path_kwargs['ds_id']
+        if ds_id in self.service_context.dataset_cache:
+            return self.service_context.get_dataset_tag(ds_id)
+        # Opening the dataset may take a while
+        return await IOLoop.current().run_in_executor(_TILE_EXECUTOR, self.service_context.get_dataset_tag, ds_id)
 
     async def get(self, ds_id: str, var_name: str, z: str, x: str, y: str):
-        tile = await IOLoop.current().run_in_executor(None,
+        tile = await IOLoop.current().run_in_executor(_TILE_EXECUTOR,
                                                       get_dataset_tile,
                                                       self.service_context,
                                                       ds_id, var_name,
                                                       x, y, z,
                                                       self.params)
         self.set_header('Content-Type', 'image/png')
+        self.set_header('Content-Length', str(len(tile)))
         self.finish(tile)
 
 
@@ -198,10 +285,10 @@ class GetDatasetVarTileGridHandler(ServiceRequestHandler):
 
 
 # noinspection PyAbstractClass
-class GetNE2TileHandler(ServiceRequestHandler):
+class GetNE2TileHandler(_TileRequestHandler):
 
     async def get(self, z: str, x: str, y: str):
-        response = await IOLoop.current().run_in_executor(None,
+        response = await IOLoop.current().run_in_executor(_TILE_EXECUTOR,
                                                           get_ne2_tile,
                                                           self.service_context,
                                                           x, y, z,
@@ -221,25 +308,21 @@ class GetNE2TileGridHandler(ServiceRequestHandler):
 
 
 # noinspection PyAbstractClass
-class GetColorBarsJsonHandler(ServiceRequestHandler):
+class GetColorBarsJsonHandler(_CachedResponseHandler):
 
     # noinspection PyShadowingBuiltins
-    def get(self):
+    async def get(self):
         mime_type = 'application/json'
-        response = get_color_bars(self.service_context, mime_type)
-        self.set_header('Content-Type', mime_type)
-        self.write(response)
+        await self.finish_cached(('colorbars', mime_type), mime_type, get_color_bars, mime_type)
 
 
 # noinspection PyAbstractClass
-class GetColorBarsHtmlHandler(ServiceRequestHandler):
+class GetColorBarsHtmlHandler(_CachedResponseHandler):
 
     # noinspection PyShadowingBuiltins
-    def get(self):
+    async def get(self):
         mime_type = 'text/html'
-        response = get_color_bars(self.service_context, mime_type)
-        self.set_header('Content-Type', mime_type)
-        self.write(response)
+        await self.finish_cached(('colorbars', mime_type), mime_type, get_color_bars, mime_type)
 
 
 # noinspection PyAbstractClass
@@ -387,3 +470,25 @@ class GetTimeSeriesForFeaturesHandler(ServiceRequestHandler):
                                                           start_date, end_date)
         self.set_header('Content-Type', 'application/json')
         self.finish(response)
+
+
+# noinspection PyAbstractClass
+class ResourceFileHandler(StaticFileHandler):
+    """
+    Serves the package's resource files.
+
+    Unlike the base class, which hashes a file's entire contents once per process to compute its ETag,
+    and then keeps the hash even if the file changes, the ETag is derived from the file's
+    modification time and size, which are known from the stat() call made for every request anyway.
+    Versioned requests, i.e. those with a "v" query argument, are marked immutable.
+    """
+
+    def compute_etag(self):
+        modified = self.get_modified_time()
+        if modified is None:
+            return None
+        return '"%x-%x"' % (int(modified.timestamp()), self.get_content_size())
+
+    def set_extra_headers(self, path):
+        if 'v' in self.request.arguments:
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % self.CACHE_MAX_AGE)
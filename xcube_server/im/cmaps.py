@@ -19,6 +19,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import base64
+import functools
 import io
 import logging
 from threading import Lock
@@ -189,3 +190,22 @@ def ensure_cmaps_loaded():
             # import pprint
             # pprint.pprint(_CMAPS)
         _LOCK.release()
+
+
+@functools.lru_cache(maxsize=128)
+def get_cmap_colors(cmap_name: str, num_colors: int = 256) -> np.ndarray:
+    """
+    Get the colors of a color map as a color lookup table.
+
+    Lookup tables are computed only once for a given color map and number of colors,
+    so the returned array is shared and read-only.
+
+    :param cmap_name: A Matplotlib color map name
+    :param num_colors: Number of colors
+    :return: a C-contiguous uint8 array of shape (num_colors, 4) containing RGBA values
+    """
+    ensure_cmaps_loaded()
+    cmap = cm.get_cmap(cmap_name, num_colors)
+    colors = np.ascontiguousarray(cmap(np.arange(num_colors), bytes=True))
+    colors.flags.writeable = False
+    return colors
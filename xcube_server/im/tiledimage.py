@@ -18,18 +18,22 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import functools
 import io
 import logging
+import multiprocessing.pool
+import os
+import threading
 import uuid
 from abc import ABCMeta, abstractmethod
 from typing import Tuple, Sequence, Union, Any, Callable, Optional
 
-import matplotlib.cm as cm
+import dask
 import numba
 import numpy as np
 from PIL import Image
 
-from .cmaps import ensure_cmaps_loaded
+from .cmaps import get_cmap_colors
 from .tilegrid import TileGrid, GeoExtent, GLOBAL_GEO_EXTENT
 from .utils import downsample_ndarray, aggregate_ndarray_first
 from ..cache import Cache
@@ -54,6 +58,15 @@ LevelMapper = Callable[['TiledImage', int, Optional[Any]], 'TiledImage']
 TileAggregator = Callable[[Tile, Tile, Tile, Tile], Tile]
 LevelImageIdFactory = Callable[[int], str]
 
+_CHUNK_READER_POOL = None
+_CHUNK_READER_POOL_LOCK = threading.Lock()
+
+# Per-thread scratch buffers for tile data that doesn't outlive a tile computation
+_SCRATCH = threading.local()
+
+# Color index of invalid values, see quantize_array()
+QUANTIZED_NO_DATA = 0xffff
+
 
 class TiledImage(metaclass=ABCMeta):
     """
@@ -397,20 +410,7 @@ class TransformArrayImage(DecoratorImage):
 
         if self._force_masked and not np.ma.is_masked(tile):
             with measure_time(tile_tag + "mask"):
-                # if tile is not masked
-                if self._no_data_value is not None:
-                    # and we have a fill value, return a masked tile
-                    tile = np.ma.masked_equal(tile, self._no_data_value)
-                elif self._valid_range is not None:
-                    valid_min, valid_max = self._valid_range
-                    # and we have a valid min or max, return a masked tile
-                    if valid_min is not None:
-                        tile = np.ma.masked_less(tile, valid_min)
-                    if valid_max is not None:
-                        tile = np.ma.masked_greater(tile, valid_max)
-                elif np.issubdtype(tile.dtype, np.floating) or np.issubdtype(tile.dtype, np.complexfloating):
-                    # and it is of float type, return a masked tile with a mask from invalids, i.e. NaN, -Inf, +Inf
-                    tile = np.ma.masked_invalid(tile)
+                tile = mask_array(tile, no_data_value=self._no_data_value, valid_range=self._valid_range)
 
         return tile
 
@@ -430,6 +430,8 @@ class ColorMappedRgbaImage(DecoratorImage):
     :param format: Image format, e.g. "JPEG", "PNG"
     :param tile_cache: optional tile cache
     :param log_perf: whether to log runtime performance information
+    :param quantized: Whether the source tiles are color indices as returned by quantize_array()
+           rather than data values. Indices out of the color range, e.g. QUANTIZED_NO_DATA, become transparent.
     """
 
     def __init__(self,
@@ -442,16 +444,20 @@ class ColorMappedRgbaImage(DecoratorImage):
                  encode: bool = False,
                  format: str = None,
                  tile_cache=None,
-                 trace_perf: bool = False):
+                 trace_perf: bool = False,
+                 quantized: bool = False):
         super().__init__(source_image, image_id=image_id, format=format, mode='RGBA', tile_cache=tile_cache,
                          trace_perf=trace_perf)
         self._value_range = value_range
         self._cmap_name = cmap_name if cmap_name else 'jet'
-        ensure_cmaps_loaded()
-        self._cmap = cm.get_cmap(self._cmap_name, num_colors)
-        self._cmap.set_bad('k', 0)
+        self._num_colors = num_colors
+        # Color lookup table of packed RGBA values, see map_colors_lut(), plus an extra,
+        # fully transparent color for all color indices >= num_colors
+        self._packed_colors = np.append(get_cmap_colors(self._cmap_name, num_colors).view(np.uint32).reshape(-1),
+                                        np.uint32(0))
         self._no_data_value = no_data_value
         self._encode = encode
+        self._quantized = quantized
 
     def compute_tile_from_source_tile(self,
                                       tile_x: int, tile_y: int,
@@ -459,49 +465,78 @@ class ColorMappedRgbaImage(DecoratorImage):
         measure_time = self.measure_time
         tile_tag = self._get_tile_tag(tile_x, tile_y)
 
-        with measure_time(tile_tag + "mask"):
-            value_min, value_max = self._value_range
-            if not np.ma.is_masked(source_tile):
-                if self._no_data_value is not None:
-                    array = np.ma.masked_equal(source_tile, self._no_data_value)
-                    array = array.clip(value_min, value_max, out=array)
-                elif np.issubdtype(source_tile.dtype, np.floating):
-                    array = np.ma.masked_invalid(source_tile)
-                    array = array.clip(value_min, value_max, out=array)
-                else:
-                    array = source_tile.clip(value_min, value_max)
-            else:
-                array = source_tile.clip(value_min, value_max)
-
-        old_shape = array.shape
-        height = old_shape[-2]
-        width = old_shape[-1]
-        if width * height == array.size:
-            array = np.reshape(array, (height, width))
-        else:
+        height = source_tile.shape[-2]
+        width = source_tile.shape[-1]
+        if width * height != source_tile.size:
             # noinspection PyTypeChecker
-            index = [0] * (array.ndim - 2) + [slice(None), slice(None)]
-            array = array[index]
-
-        # check if we can optimize the following calls by using Numexpr
-        # see https://github.com/pydata/numexpr/wiki/Numexpr-Users-Guide
-        with measure_time(tile_tag + "normalise"):
-            array -= value_min
-            array *= 1.0 / (value_max - value_min)
+            source_tile = source_tile[(source_tile.ndim - 2) * (0,)]
+
+        encode_format = self.format if self._encode else None
+        value_min, value_max = self._value_range
+        no_data_value = float(self._no_data_value) if self._no_data_value is not None else float(np.nan)
+
+        color_indices = None
+        if self._quantized:
+            color_indices = source_tile
+        elif encode_format == 'PNG':
+            with measure_time(tile_tag + "quantize"):
+                # Buffers are reused, as images created from them below are encoded immediately
+                color_indices = _get_scratch_buffer(width * height, np.uint16)
+                quantize_values(np.ma.getdata(source_tile).reshape(-1),
+                                np.ma.getmaskarray(source_tile).reshape(-1),
+                                float(value_min),
+                                float(value_max),
+                                no_data_value,
+                                self._num_colors,
+                                color_indices)
+                color_indices = color_indices.reshape((height, width))
+
+        if encode_format == 'PNG':
+            with measure_time(tile_tag + "map palette"):
+                palette_image = _get_scratch_buffer(width * height, np.uint8).reshape((height, width))
+                palette_indices = np.empty(self._num_colors + 1, dtype=np.int32)
+                num_palette_colors = map_palette_indices(color_indices, self._num_colors,
+                                                         palette_image, palette_indices)
+            if num_palette_colors <= 256:
+                # Color-mapped tiles usually use only a fraction of the colors. Palette PNGs are
+                # several times faster to encode and much smaller than RGBA PNGs of the same pixels.
+                palette_colors = self._packed_colors[palette_indices[:num_palette_colors]]
+                if not palette_colors.any():
+                    return encode_transparent_image((width, height), encode_format)
+                with measure_time(tile_tag + "create image"):
+                    palette_colors = palette_colors.view(np.uint8).reshape((-1, 4))
+                    image = Image.fromarray(palette_image, mode='P')
+                    image.putpalette(palette_colors[:, 0:3].tobytes())
+                    image.info['transparency'] = palette_colors[:, 3].tobytes()
+                with measure_time(tile_tag + "encode PNG"):
+                    return encode_image(image, encode_format)
 
         with measure_time(tile_tag + "map colors"):
-            array = self._cmap(array, bytes=True)
+            if encode_format:
+                packed_rgba = _get_scratch_buffer(width * height, np.uint32)
+            else:
+                packed_rgba = np.empty(width * height, dtype=np.uint32)
+            if color_indices is not None:
+                np.take(self._packed_colors, color_indices, out=packed_rgba.reshape(color_indices.shape), mode='clip')
+            else:
+                map_colors_lut(np.ma.getdata(source_tile).reshape(-1),
+                               np.ma.getmaskarray(source_tile).reshape(-1),
+                               float(value_min),
+                               float(value_max),
+                               no_data_value,
+                               self._packed_colors[:-1],
+                               packed_rgba)
+            array = packed_rgba.view(np.uint8).reshape((height, width, 4))
+
+        if encode_format and not packed_rgba.any():
+            return encode_transparent_image((width, height), encode_format)
 
         with measure_time(tile_tag + "create image"):
             image = Image.fromarray(array, mode=self.mode)
 
         if self._encode and self.format:
             with measure_time(tile_tag + "encode PNG"):
-                ostream = io.BytesIO()
-                image.save(ostream, format=self.format)
-                encoded_image = ostream.getvalue()
-                ostream.close()
-                return encoded_image
+                return encode_image(image, self.format)
         else:
             return image
 
@@ -564,11 +599,8 @@ class ColorMappedRgbaImage2(OpImage):
         self._encode = encode
         self._flip_y = flip_y
         self._num_colors = num_colors
-        ensure_cmaps_loaded()
         self._cmap_range = cmap_range
-        cmap = cm.get_cmap(cmap_name, num_colors)
-        # cmap.set_bad('k', 0)
-        self._colors = cmap(np.linspace(0, 1, num_colors))
+        self._colors = get_cmap_colors(cmap_name, num_colors)
 
     def compute_tile(self,
                      tile_x: int, tile_y: int,
@@ -595,7 +627,9 @@ class ColorMappedRgbaImage2(OpImage):
 
         with measure_time(tile_tag + "values"):
             # convert tile into numpy array
-            if hasattr(tile, "values"):
+            tile = compute_tile_data(tile)
+            # Most tiles are numpy arrays already, don't probe them for an attribute they don't have
+            if not isinstance(tile, np.ndarray) and hasattr(tile, "values"):
                 tile = tile.values
 
         with measure_time(tile_tag + "trim"):
@@ -615,17 +649,15 @@ class ColorMappedRgbaImage2(OpImage):
                               no_data_value)
             tile = tile.reshape(shape + (4,))
 
+        if self._encode and self.format and not tile.any():
+            return encode_transparent_image((shape[-1], shape[-2]), self.format)
+
         with measure_time(tile_tag + "make image"):
             image = Image.fromarray(tile, mode=self.mode)
 
         with measure_time(tile_tag + "save PNG"):
             if self._encode and self.format:
-                # Saving a PNG file is slow: https://github.com/python-pillow/Pillow/issues/1211
-                ostream = io.BytesIO()
-                image.save(ostream, format=self.format, compress_level=1)
-                encoded_image = ostream.getvalue()
-                ostream.close()
-                return encoded_image
+                return encode_image(image, self.format)
             else:
                 return image
 
@@ -635,7 +667,110 @@ class ColorMappedRgbaImage2(OpImage):
         return ImagePyramid.create_from_image(self, create_pil_downsampling_image, **kwargs)
 
 
-@numba.njit(parallel=True)
+@numba.njit(cache=True)
+def map_colors_lut(values,
+                   mask,
+                   value_min,
+                   value_max,
+                   no_data_value,
+                   packed_colors,
+                   packed_rgba):
+    """
+    Map *values* to colors in a single pass over the data. Clips, normalises and looks up color values at once.
+
+    :param values: 1D array of values
+    :param mask: 1D boolean array, True for values that are invalid
+    :param value_min: value mapped to the first color
+    :param value_max: value mapped to the last color
+    :param no_data_value: value that is considered invalid, may be NaN
+    :param packed_colors: 1D color lookup table of RGBA colors packed into uint32 values
+    :param packed_rgba: 1D uint32 output array of packed RGBA colors, invalid values are fully transparent
+    """
+    num_colors = packed_colors.size
+    scale = num_colors / (value_max - value_min) if value_max > value_min else 0.0
+    no_data_value_not_nan = not np.isnan(no_data_value)
+    for i in range(values.size):
+        v = values[i]
+        if mask[i] or np.isnan(v) or (no_data_value_not_nan and v == no_data_value):
+            packed_rgba[i] = 0
+        else:
+            j = int((v - value_min) * scale)
+            if j < 0:
+                j = 0
+            elif j >= num_colors:
+                j = num_colors - 1
+            packed_rgba[i] = packed_colors[j]
+
+
+@numba.njit(cache=True)
+def quantize_values(values,
+                    mask,
+                    value_min,
+                    value_max,
+                    no_data_value,
+                    num_colors,
+                    indices):
+    """
+    Quantize *values* into color indices. Uses the same clipping and normalisation as map_colors_lut().
+
+    :param values: 1D array of values
+    :param mask: 1D boolean array, True for values that are invalid
+    :param value_min: value mapped to the first color
+    :param value_max: value mapped to the last color
+    :param no_data_value: value that is considered invalid, may be NaN
+    :param num_colors: number of colors
+    :param indices: 1D uint16 output array of color indices, invalid values are set to QUANTIZED_NO_DATA
+    """
+    scale = num_colors / (value_max - value_min) if value_max > value_min else 0.0
+    no_data_value_not_nan = not np.isnan(no_data_value)
+    for i in range(values.size):
+        v = values[i]
+        if mask[i] or np.isnan(v) or (no_data_value_not_nan and v == no_data_value):
+            indices[i] = QUANTIZED_NO_DATA
+        else:
+            j = int((v - value_min) * scale)
+            if j < 0:
+                j = 0
+            elif j >= num_colors:
+                j = num_colors - 1
+            indices[i] = j
+
+
+@numba.njit(cache=True)
+def map_palette_indices(color_indices,
+                        num_colors,
+                        palette_image,
+                        palette_indices):
+    """
+    Map the *color_indices* of an image to the indices of a palette comprising the used colors only.
+    Stops as soon as more than 256 colors are used, as they won't fit into an 8-bit palette.
+
+    :param color_indices: 2D array of color indices, indices >= num_colors denote transparent pixels
+    :param num_colors: number of colors
+    :param palette_image: 2D uint8 output array of palette indices
+    :param palette_indices: 1D output array of size num_colors + 1, receives the color index of each palette entry
+           with num_colors denoting the transparent color
+    :return: the number of palette colors, the outputs are only complete if it is not greater than 256
+    """
+    palette_index_of_color = np.full(num_colors + 1, -1, dtype=np.int32)
+    num_palette_colors = 0
+    height, width = color_indices.shape
+    for y in range(height):
+        for x in range(width):
+            color_index = min(int(color_indices[y, x]), num_colors)
+            palette_index = palette_index_of_color[color_index]
+            if palette_index < 0:
+                if num_palette_colors == 256:
+                    return num_palette_colors + 1
+                palette_index = num_palette_colors
+                palette_index_of_color[color_index] = palette_index
+                palette_indices[palette_index] = color_index
+                num_palette_colors += 1
+            palette_image[y, x] = palette_index
+    return num_palette_colors
+
+
+@numba.njit(parallel=True, cache=True)
 def map_colors(tile,
                colors,
                num_colors,
@@ -658,10 +793,7 @@ def map_colors(tile,
                 j = num_colors - 1
             else:
                 j = int(num_colors * (v - cmap_min) / (cmap_max - cmap_min))
-            output[i][0] = int(255 * colors[j][0])
-            output[i][1] = int(255 * colors[j][1])
-            output[i][2] = int(255 * colors[j][2])
-            output[i][3] = int(255 * colors[j][3])
+            output[i] = colors[j]
     return output
 
 
@@ -865,7 +997,7 @@ class FastNdarrayDownsamplingImage(OpImage):
 
         # Let's see if it has the xarray.DataArray.load() method.
         # Pre-loading of tile data makes it easier to find bottlenecks in the image processing chain.
-        if hasattr(tile, 'load'):
+        if not isinstance(tile, np.ndarray) and hasattr(tile, 'load'):
             with measure_time(tile_tag + "load"):
                 tile.load()
 
@@ -888,6 +1020,7 @@ class NdarrayImage(OpImage):
     :param tile_size: the tile size
     :param image_id: optional unique image identifier
     :param tile_cache: an optional tile cache
+    :param fill_value: value used to pad tiles at the image borders
     """
 
     def __init__(self,
@@ -895,7 +1028,8 @@ class NdarrayImage(OpImage):
                  tile_size: Size2D,
                  image_id: str = None,
                  tile_cache: Cache = None,
-                 trace_perf=False):
+                 trace_perf=False,
+                 fill_value: Number = np.nan):
         width, height = array.shape[-1], array.shape[-2]
         tile_width, tile_height = tile_size
         num_tiles = (width + tile_width - 1) // tile_width, (height + tile_height - 1) // tile_height
@@ -908,13 +1042,14 @@ class NdarrayImage(OpImage):
                          tile_cache=tile_cache,
                          trace_perf=trace_perf)
         self._array = array
+        self._fill_value = fill_value
         self._empty_tile = None
 
     def compute_tile(self, tile_x: int, tile_y: int, rectangle: Rectangle2D) -> Tile:
         x, y, w, h = rectangle
-        tile = self._array[..., y:y + h, x:x + w]
+        tile = compute_tile_data(self._array[..., y:y + h, x:x + w])
         # ensure that our tile size is w x h
-        return trim_tile(tile, self.tile_size)
+        return trim_tile(tile, self.tile_size, fill_value=self._fill_value)
 
 
 LC_STANDARD_NAMES = {'land_cover_lccs algorithmic_confidence', 'land_cover_lccs status_flag', 'land_cover_lccs',
@@ -1055,6 +1190,134 @@ def create_ndarray_downsampling_image(source_image: TiledImage,
     return NdarrayDownsamplingImage(higher_level_image, **kwargs)
 
 
+def encode_image(image: Image.Image, format: str) -> bytes:
+    """
+    Encode a PIL image into the given image file format.
+
+    PNG images are written using the lowest compression level. Saving a PNG file using Pillow's
+    default compression level is slow (https://github.com/python-pillow/Pillow/issues/1211),
+    while compression level 1 yields only slightly larger images for color-mapped map tiles
+    at less than half of the CPU time.
+
+    :param image: The PIL image
+    :param format: The image format, e.g. "PNG", "JPEG"
+    :return: the encoded image bytes
+    """
+    with io.BytesIO() as ostream:
+        if format == 'PNG':
+            image.save(ostream, format=format, compress_level=1)
+        else:
+            image.save(ostream, format=format)
+        return ostream.getvalue()
+
+
+@functools.lru_cache(maxsize=16)
+def encode_transparent_image(size: Size2D, format: str) -> bytes:
+    """
+    Encode a fully transparent RGBA image into the given image file format.
+
+    Tiles that contain no valid data at all are quite common, e.g. outside of a dataset's
+    coverage, so they are encoded only once per size and format.
+
+    :param size: The image size as (width, height)
+    :param format: The image format, e.g. "PNG"
+    :return: the encoded image bytes
+    """
+    return encode_image(Image.new('RGBA', size, (0, 0, 0, 0)), format)
+
+
+def mask_array(array: np.ndarray,
+               no_data_value: Number = None,
+               valid_range: Tuple[Number, Number] = None) -> np.ndarray:
+    """
+    Mask the invalid values of *array*.
+
+    :param array: a numpy array
+    :param no_data_value: optional no-data value, if given, only values equal to it are invalid
+    :param valid_range: optional valid range, used if *no_data_value* is not given
+    :return: a masked array, or *array* if it is neither of float type nor a no-data value or valid range is given
+    """
+    if no_data_value is not None:
+        # we have a fill value, return a masked array
+        return np.ma.masked_equal(array, no_data_value)
+    if valid_range is not None:
+        valid_min, valid_max = valid_range
+        # we have a valid min or max, return a masked array
+        if valid_min is not None:
+            array = np.ma.masked_less(array, valid_min)
+        if valid_max is not None:
+            array = np.ma.masked_greater(array, valid_max)
+        return array
+    if np.issubdtype(array.dtype, np.floating) or np.issubdtype(array.dtype, np.complexfloating):
+        # it is of float type, return a masked array with a mask from invalids, i.e. NaN, -Inf, +Inf
+        return np.ma.masked_invalid(array)
+    return array
+
+
+def quantize_array(array: np.ndarray,
+                   value_range: Tuple[float, float],
+                   num_colors: int = 256,
+                   no_data_value: Number = None) -> np.ndarray:
+    """
+    Quantize the values of *array* into color indices as used by ColorMappedRgbaImage(..., quantized=True).
+    Color-mapping the returned indices gives exactly the colors of color-mapping *array* itself,
+    but the indices take only two bytes per pixel and are mapped to colors by a plain table lookup.
+
+    :param array: a numpy array, may be masked
+    :param value_range: value range mapped to the colors
+    :param num_colors: number of colors
+    :param no_data_value: optional no-data value
+    :return: an uint16 array of the shape of *array*, invalid values are QUANTIZED_NO_DATA
+    """
+    value_min, value_max = value_range
+    indices = np.empty(array.size, dtype=np.uint16)
+    quantize_values(np.ma.getdata(array).reshape(-1),
+                    np.ma.getmaskarray(array).reshape(-1),
+                    float(value_min),
+                    float(value_max),
+                    float(no_data_value) if no_data_value is not None else float(np.nan),
+                    num_colors,
+                    indices)
+    return indices.reshape(array.shape)
+
+
+def compute_tile_data(tile: Tile) -> Tile:
+    """
+    Compute the data of a lazy, dask-backed tile, e.g. a subset of a dataset variable.
+
+    A tile usually spans multiple chunks. These are read concurrently by a thread pool of
+    twice the number of CPUs shared by all tiles, so the number of concurrent chunk reads
+    is bounded no matter how many tiles are computed at the same time.
+    Tiles that are not dask-backed are returned as-is.
+
+    :param tile: The tile, e.g. a ``xarray.DataArray`` or ``dask.array.Array``
+    :return: the tile with computed data
+    """
+    if not dask.is_dask_collection(tile):
+        return tile
+    global _CHUNK_READER_POOL
+    if _CHUNK_READER_POOL is None:
+        with _CHUNK_READER_POOL_LOCK:
+            if _CHUNK_READER_POOL is None:
+                _CHUNK_READER_POOL = multiprocessing.pool.ThreadPool(2 * (os.cpu_count() or 1))
+    return tile.compute(pool=_CHUNK_READER_POOL)
+
+
+def _get_scratch_buffer(size: int, dtype) -> np.ndarray:
+    """
+    Get a 1D scratch buffer of given *size* and *dtype* for the current thread.
+    Its contents are undefined and will be overwritten by the next caller in the same thread.
+    """
+    key = size, np.dtype(dtype).str
+    buffers = getattr(_SCRATCH, 'buffers', None)
+    if buffers is None:
+        buffers = _SCRATCH.buffers = dict()
+    buffer = buffers.get(key)
+    if buffer is None:
+        buffer = buffers[key] = np.empty(size, dtype=dtype)
+    return buffer
+
+
 def trim_tile(tile: Tile, expected_tile_size: Size2D, fill_value: float = np.nan) -> Tile:
     """
     Trim a tile.
@@ -1068,14 +1331,16 @@ def trim_tile(tile: Tile, expected_tile_size: Size2D, fill_value: float = np.nan
     """
     expected_width, expected_height = expected_tile_size
     actual_width, actual_height = tile.shape[-1], tile.shape[-2]
+    # keep the tile's data type if it can represent fill_value, e.g. for integer tiles with an integer fill_value
+    pad_dtype = tile.dtype if np.can_cast(np.min_scalar_type(fill_value), tile.dtype) else np.float64
     if expected_width > actual_width:
         # expand in width and pad with fill_value
-        h_pad = np.empty((actual_height, expected_width - actual_width))
+        h_pad = np.empty((actual_height, expected_width - actual_width), dtype=pad_dtype)
         h_pad.fill(fill_value)
         tile = np.hstack((tile, h_pad))
     if expected_height > actual_height:
         # expand in height and pad with fill_value
-        v_pad = np.empty((expected_height - actual_height, expected_width))
+        v_pad = np.empty((expected_height - actual_height, expected_width), dtype=pad_dtype)
         v_pad.fill(fill_value)
         tile = np.vstack((tile, v_pad))
     if expected_width < actual_width or expected_height < actual_height:
@@ -1,12 +1,17 @@
+import collections
+import collections.abc
+import concurrent.futures
 import os
+import re
 import threading
 from abc import abstractmethod, ABCMeta
-from typing import Sequence, Any, Dict, Callable
+from typing import Sequence, Any, Dict, Callable, Iterator, List, MutableMapping
 
 import s3fs
 import xarray as xr
 import zarr
 
+from .defaults import OBS_STORE_CACHE_CAPACITY, OBS_PREFETCH_DEPTH, OBS_PREFETCH_MAX_WORKERS
 from .im import TileGrid
 from .perf import measure_time
 from .utils import get_dataset_bounds
@@ -90,7 +95,9 @@ class LazyMultiLevelDataset(MultiLevelDataset, metaclass=ABCMeta):
     def tile_grid(self) -> TileGrid:
         if self._tile_grid is None:
             with self._lock:
-                self._tile_grid = self._get_tile_grid_lazily()
+                # Check again, another thread may have computed it while we were waiting for the lock
+                if self._tile_grid is None:
+                    self._tile_grid = self._get_tile_grid_lazily()
         return self._tile_grid
 
     def get_dataset(self, index: int) -> xr.Dataset:
@@ -103,8 +110,9 @@ class LazyMultiLevelDataset(MultiLevelDataset, metaclass=ABCMeta):
         if index not in self._level_datasets:
             kwargs = self._kwargs if self._kwargs is not None else {}
             with self._lock:
-                # noinspection PyTypeChecker
-                self._level_datasets[index] = self._get_dataset_lazily(index, **kwargs)
+                if index not in self._level_datasets:
+                    # noinspection PyTypeChecker
+                    self._level_datasets[index] = self._get_dataset_lazily(index, **kwargs)
         # noinspection PyTypeChecker
         return self._level_datasets[index]
 
@@ -187,7 +195,7 @@ class FileStorageMultiLevelDataset(LazyMultiLevelDataset):
                     base_dir = os.path.dirname(self._dir_path)
                     level_path = os.path.join(base_dir, level_path)
         with measure_time(tag=f"opened local dataset {level_path} for level {index}"):
-            return xr.open_zarr(level_path, **zarr_kwargs)
+            return open_local_zarr(level_path, **zarr_kwargs)
 
     def _get_tile_grid_lazily(self):
         """
@@ -209,18 +217,19 @@ class ObjectStorageMultiLevelDataset(LazyMultiLevelDataset):
     def __init__(self, ds_id: str,
                  obs_file_system: s3fs.S3FileSystem,
                  dir_path: str,
-                 zarr_kwargs: Dict[str, Any] = None, exception_type=ValueError):
+                 zarr_kwargs: Dict[str, Any] = None, exception_type=ValueError,
+                 prefetch_depth: int = OBS_PREFETCH_DEPTH):
 
         level_paths = {}
         for entry in obs_file_system.walk(dir_path, directories=True):
-            basename = None
+            basename, ext = None, None
             if entry.endswith(".zarr") and obs_file_system.isdir(entry):
-                basename, _ = os.path.splitext(entry)
+                basename, ext = os.path.splitext(entry)
             elif entry.endswith(".link") and obs_file_system.isfile(entry):
-                basename, _ = os.path.splitext(entry)
+                basename, ext = os.path.splitext(entry)
             if basename is not None and basename.isdigit():
                 level = int(basename)
-                level_paths[level] = dir_path + "/" + entry
+                level_paths[level] = (ext, dir_path + "/" + entry)
 
         num_levels = len(level_paths)
         # Consistency check
@@ -233,6 +242,7 @@ class ObjectStorageMultiLevelDataset(LazyMultiLevelDataset):
         self._dir_path = dir_path
         self._level_paths = level_paths
         self._num_levels = num_levels
+        self._prefetch_depth = prefetch_depth
 
     @property
     def num_levels(self) -> int:
@@ -248,17 +258,16 @@ class ObjectStorageMultiLevelDataset(LazyMultiLevelDataset):
         """
         ext, level_path = self._level_paths[index]
         if ext == ".link":
-            with self._obs_file_system.open(level_path, "w") as fp:
+            with self._obs_file_system.open(level_path, "r") as fp:
                 level_path = fp.read()
                 # if file_path is a relative path, resolve it against the levels directory
                 if not os.path.isabs(level_path):
                     base_dir = os.path.dirname(self._dir_path)
                     level_path = os.path.join(base_dir, level_path)
 
-        store = s3fs.S3Map(root=level_path, s3=self._obs_file_system, check=False)
-        cached_store = zarr.LRUStoreCache(store, max_size=2 ** 28)
         with measure_time(tag=f"opened remote dataset {level_path} for level {index}"):
-            return xr.open_zarr(cached_store, **zarr_kwargs)
+            return open_obs_zarr(self._obs_file_system, level_path, prefetch_depth=self._prefetch_depth,
+                                 **zarr_kwargs)
 
     def _get_tile_grid_lazily(self):
         """
@@ -456,3 +465,133 @@ def _get_cube_spatial_sizes(dataset: xr.Dataset):
         tile_width, tile_height = spatial_chunks[-1], spatial_chunks[-2]
 
     return width, height, tile_width, tile_height
+
+
+def open_obs_zarr(obs_file_system: s3fs.S3FileSystem, path: str,
+                  prefetch_depth: int = OBS_PREFETCH_DEPTH, **zarr_kwargs) -> xr.Dataset:
+    """
+    Open a zarr dataset from object storage.
+
+    Chunks read are kept in an in-memory LRU cache of capacity ``OBS_STORE_CACHE_CAPACITY`` bytes.
+    If the dataset has consolidated metadata, it is opened from that single object instead of
+    reading the metadata of the group and each of its variables separately.
+    Unless *zarr_kwargs* say otherwise, variables are chunked like the zarr arrays,
+    so that a tile is read from whole chunks.
+
+    :param obs_file_system: The object storage file system
+    :param path: The path of the zarr dataset in *obs_file_system*
+    :param prefetch_depth: The number of following chunks read ahead whenever a chunk is read,
+        see ``_PrefetchStore``. Zero disables reading ahead.
+    :param zarr_kwargs: Keyword arguments accepted by the ``xarray.open_zarr()`` function.
+    :return: the dataset
+    """
+    store = s3fs.S3Map(root=path, s3=obs_file_system, check=False)
+    if 'consolidated' not in zarr_kwargs:
+        zarr_kwargs = dict(zarr_kwargs, consolidated='.zmetadata' in store)
+    if 'chunks' not in zarr_kwargs:
+        zarr_kwargs = dict(zarr_kwargs, chunks={})
+    if prefetch_depth > 0:
+        store = _PrefetchStore(store, prefetch_depth)
+    cached_store = zarr.LRUStoreCache(store, max_size=OBS_STORE_CACHE_CAPACITY)
+    return xr.open_zarr(cached_store, **zarr_kwargs)
+
+
+# Reads chunks ahead for the stores of all datasets, so that the number of concurrent requests is bounded
+_PREFETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=OBS_PREFETCH_MAX_WORKERS,
+                                                           thread_name_prefix='xcube-obs-prefetch')
+
+# Matches chunk keys such as "chl/0.12.7", groups are the key without the last index, and the last index
+_CHUNK_KEY_PATTERN = re.compile(r'^(.*/(?:\d+\.)*)(\d+)$')
+
+
+class _PrefetchStore(collections.abc.MutableMapping):
+    """
+    A zarr store that, whenever a chunk is read, reads the *prefetch_depth* chunks following it
+    in the last dimension of its array ahead, in the background.
+
+    Each chunk read from object storage waits for the first byte for a long time. Tiles
+    next to each other are usually requested together, so reading their chunks ahead
+    overlaps these waits with the decoding and rendering of the current tile.
+
+    Chunks read ahead are held until they are read, at most ``_MAX_PENDING`` of them;
+    they are usually kept by an ``zarr.LRUStoreCache`` on top of this store afterwards.
+
+    :param store: The store to read from.
+    :param prefetch_depth: The number of chunks read ahead.
+    :param executor: The executor reading chunks ahead, defaults to a shared one.
+    """
+
+    _MAX_PENDING = 256
+
+    def __init__(self, store: MutableMapping, prefetch_depth: int,
+                 executor: concurrent.futures.Executor = None):
+        self._store = store
+        self._prefetch_depth = prefetch_depth
+        self._executor = executor or _PREFETCH_EXECUTOR
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key: str) -> bytes:
+        with self._lock:
+            future = self._pending.pop(key, None)
+            self._prefetch(key)
+        if future is not None:
+            # Raises KeyError for a missing chunk, just like the store does
+            return future.result()
+        return self._store[key]
+
+    def __setitem__(self, key: str, value: bytes):
+        self._discard(key)
+        self._store[key] = value
+
+    def __delitem__(self, key: str):
+        self._discard(key)
+        del self._store[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._store
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._store)
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def _discard(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _prefetch(self, key: str):
+        for next_key in self._get_next_keys(key):
+            if next_key not in self._pending:
+                self._pending[next_key] = self._executor.submit(self._store.__getitem__, next_key)
+        while len(self._pending) > self._MAX_PENDING:
+            self._pending.popitem(last=False)
+
+    def _get_next_keys(self, key: str) -> List[str]:
+        match = _CHUNK_KEY_PATTERN.match(key)
+        if match is None:
+            # Metadata such as ".zarray", or a key not of a chunk
+            return []
+        prefix, index = match.group(1), int(match.group(2))
+        return [f'{prefix}{index + i}' for i in range(1, self._prefetch_depth + 1)]
+
+
+def open_local_zarr(path: str, **zarr_kwargs) -> xr.Dataset:
+    """
+    Open a zarr dataset from the local file system.
+
+    If the dataset has consolidated metadata, it is opened from that single file instead of
+    reading the metadata of the group and each of its variables separately.
+    Unless *zarr_kwargs* say otherwise, variables are chunked like the zarr arrays,
+    so that a tile is read from whole chunks.
+
+    :param path: The path of the zarr dataset
+    :param zarr_kwargs: Keyword arguments accepted by the ``xarray.open_zarr()`` function.
+    :return: the dataset
+    """
+    if 'consolidated' not in zarr_kwargs:
+        zarr_kwargs = dict(zarr_kwargs, consolidated=os.path.isfile(os.path.join(path, '.zmetadata')))
+    if 'chunks' not in zarr_kwargs:
+        zarr_kwargs = dict(zarr_kwargs, chunks={})
+    return xr.open_zarr(path, **zarr_kwargs)
@@ -19,6 +19,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import functools
 import os
 
 from xcube_server.im import GLOBAL_GEO_EXTENT
@@ -41,14 +42,17 @@ class NaturalEarth2Image(AbstractTiledImage):
     TILE_SIZE = 256
 
     @staticmethod
+    @functools.lru_cache(maxsize=1)
     def get_pyramid() -> ImagePyramid:
         """
-        Return an instance of a 'Natural Earth v2' image pyramid:
+        Return the instance of a 'Natural Earth v2' image pyramid:
         * global coverage
         * JPEG RGB format
         * 3 levels of detail: 0 to 2
         * tile size: 256 pixels
         * 2 x 1 tiles on level zero
+
+        The pyramid is immutable and its tiles are read from file on demand, so a single instance is shared.
         """
         dir_path = os.path.join(os.path.dirname(__file__), 'res', 'ne2')
         return ImagePyramid(TileGrid(NaturalEarth2Image.NUM_LEVELS,
@@ -101,7 +101,10 @@ class RequestParams(metaclass=ABCMeta):
         :raise: ServiceBadRequestError
         """
         value = self.get_query_argument(name, default=default)
-        return self.to_int(name, value) if value is not None else default
+        # Query argument not given, default is already of the target type
+        if value is None or value is default:
+            return default
+        return self.to_int(name, value)
 
     def get_query_argument_float(self,
                                  name: str,
@@ -114,7 +117,10 @@ class RequestParams(metaclass=ABCMeta):
         :raise: ServiceBadRequestError
         """
         value = self.get_query_argument(name, default=default)
-        return self.to_float(name, value) if value is not None else default
+        # Query argument not given, default is already of the target type
+        if value is None or value is default:
+            return default
+        return self.to_float(name, value)
 
     def get_query_argument_datetime(self,
                                     name: str,
@@ -127,5 +133,7 @@ class RequestParams(metaclass=ABCMeta):
         :raise: ServiceBadRequestError
         """
         value = self.get_query_argument(name, default=default)
-
-        return self.to_datetime(name, value) if value is not None else default
+        # Query argument not given, default is already of the target type
+        if value is None or value is default:
+            return default
+        return self.to_datetime(name, value)
@@ -20,12 +20,14 @@
 # SOFTWARE.
 
 import asyncio
+import functools
 import json
 import logging
 import os
+import re
 import signal
 import sys
-import time
+import threading
 import traceback
 from datetime import datetime
 from json import JSONDecodeError
@@ -34,21 +36,56 @@ from typing import Optional, Any, Dict
 import tornado.escape
 import tornado.options
 import yaml
-from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import enable_pretty_logging
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 from tornado.web import RequestHandler, Application
 
 from .context import ServiceContext
 from .defaults import DEFAULT_ADDRESS, DEFAULT_PORT, DEFAULT_CONFIG_FILE, DEFAULT_UPDATE_PERIOD, DEFAULT_LOG_PREFIX, \
-    DEFAULT_TILE_CACHE_SIZE, DEFAULT_NAME, DEFAULT_TRACE_PERF, DEFAULT_TILE_COMP_MODE
+    DEFAULT_TILE_CACHE_SIZE, DEFAULT_NAME, DEFAULT_TRACE_PERF, DEFAULT_TILE_COMP_MODE, DEFAULT_NUM_WORKERS, \
+    DEFAULT_DATASET_CACHE_SIZE
 from .errors import ServiceBadRequestError
 from .reqparams import RequestParams
 from .undefined import UNDEFINED
 
+try:
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 __author__ = "Norman Fomferra (Brockmann Consult GmbH)"
 
 _LOG = logging.getLogger('xcube')
 
+# Use LibYAML's much faster loader if available
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Log directories already created by services of this process
+_LOG_DIRS = set()
+
+# Minimum period in seconds in which the configuration file is polled even if it is observed, because
+# file system events are not reported for all file systems, e.g. network shares
+_OBSERVED_CONFIG_CHECK_PERIOD = 60.
+
+# Period in seconds in which workers check whether their supervisor process is still alive
+_SUPERVISOR_CHECK_PERIOD = 1.
+
+# Maximum number of stack frames sent with error responses, see ServiceRequestHandler.write_error()
+_MAX_TRACEBACK_FRAMES = 20
+
+# A {{NAME}} placeholder in URL patterns, see url_pattern()
+_URL_PLACEHOLDER_RE = re.compile(r'{{(.*?)}}', re.DOTALL)
+# Matches any characters but the RFC 2396 reserved ones, see url_pattern()
+_URL_NAME_PATTERN = r'(?P<%s>[^\;\/\?\:\@\&\=\+\$\,]+)'
+
 
 class Service:
     """
@@ -66,7 +103,10 @@ class Service:
                  update_period: Optional[float] = DEFAULT_UPDATE_PERIOD,
                  trace_perf: bool = DEFAULT_TRACE_PERF,
                  log_file_prefix: str = DEFAULT_LOG_PREFIX,
-                 log_to_stderr: bool = False) -> None:
+                 log_to_stderr: bool = False,
+                 access_log: bool = False,
+                 num_workers: int = DEFAULT_NUM_WORKERS,
+                 dataset_cache_size: Optional[int] = DEFAULT_DATASET_CACHE_SIZE) -> None:
 
         """
         Start a tile service.
@@ -84,24 +124,38 @@ class Service:
         :param update_period: if not-None, time of idleness in seconds before service is updated
         :param log_file_prefix: Log file prefix, default is "xcube_server.log"
         :param log_to_stderr: Whether logging should be shown on stderr
+        :param access_log: Whether successful requests should be logged too
+        :param num_workers: Number of server processes sharing the port, zero or a negative value
+            means one per CPU. Each process has its own caches.
+        :param dataset_cache_size: Maximum number of opened datasets kept in memory by each process.
+            None, zero or a negative value means no limit.
         :return: service information dictionary
         """
         log_dir = os.path.dirname(log_file_prefix)
-        if log_dir and not os.path.isdir(log_dir):
+        if log_dir and log_dir not in _LOG_DIRS:
             os.makedirs(log_dir, exist_ok=True)
+            _LOG_DIRS.add(log_dir)
 
         options = tornado.options.options
         options.log_file_prefix = log_file_prefix or 'xcube_server.log'
         options.log_to_stderr = log_to_stderr
         enable_pretty_logging()
+        # Tornado logs every successful request on level INFO, which means formatting and writing
+        # a log record per tile. Unless asked for, only log failed requests (4xx and 5xx).
+        logging.getLogger('tornado.access').setLevel(logging.INFO if access_log else logging.WARNING)
 
         tile_cache_config = parse_tile_cache_config(tile_cache_size)
 
         self.config_file = os.path.abspath(config_file) if config_file else None
-        self.config_mtime = None
+        self.config_stat = None
+        self.config_data = None
         self.update_period = update_period
         self.update_timer = None
+        self.supervisor_timer = None
+        self.config_observer = None
         self.config_error = None
+        # Configuration checks run in executor threads, triggered both by file system events and polling
+        self._config_lock = threading.Lock()
         self.service_info = dict(port=port,
                                  address=address,
                                  started=datetime.now().isoformat(sep=' '),
@@ -111,19 +165,48 @@ class Service:
                                       base_dir=os.path.dirname(self.config_file or os.path.abspath('')),
                                       tile_comp_mode=tile_comp_mode,
                                       trace_perf=trace_perf,
-                                      mem_tile_cache_capacity=tile_cache_config.get("capacity"))
+                                      mem_tile_cache_capacity=tile_cache_config.get("capacity"),
+                                      dataset_cache_capacity=dataset_cache_size)
         self._maybe_load_config()
 
         application.service_context = self.context
-        application.time_of_last_activity = time.process_time()
         self.application = application
 
-        self.server = application.listen(port, address=address or 'localhost')
+        if uvloop is not None:
+            # Must be set before the event loop is created, that is, when the server starts listening
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        if num_workers == 1:
+            self.server = application.listen(port, address=address or 'localhost')
+        else:
+            # Bind before forking so that all workers accept connections on the same sockets.
+            # Must happen before any event loop or thread is created, the parent process
+            # only supervises the workers and never returns from fork_processes().
+            sockets = bind_sockets(port, address=address or 'localhost')
+            supervisor_pid = os.getpid()
+            try:
+                fork_processes(max(num_workers, 0))
+            except KeyboardInterrupt:
+                # Workers receive CTRL+C too and shut down by themselves
+                sys.exit(0)
+            self.service_info['pid'] = os.getpid()
+            self.server = HTTPServer(application)
+            self.server.add_sockets(sockets)
+            # Shut down if the supervisor has been killed, e.g. by SIGTERM, which is not forwarded to workers
+            self.supervisor_timer = PeriodicCallback(functools.partial(self._check_supervisor, supervisor_pid),
+                                                     _SUPERVISOR_CHECK_PERIOD * 1000)
+            self.supervisor_timer.start()
         # Ensure we have the same event loop in all threads
         asyncio.set_event_loop_policy(_GlobalEventLoopPolicy(asyncio.get_event_loop()))
         # Register handlers for common termination signals
-        signal.signal(signal.SIGINT, self._sig_handler)
-        signal.signal(signal.SIGTERM, self._sig_handler)
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                # The signal is delivered through the event loop's wakeup fd and dispatched as a normal callback
+                loop.add_signal_handler(sig, self._on_signal, sig)
+            except NotImplementedError:
+                # Event loops on Windows don't support signal handlers
+                signal.signal(sig, self._sig_handler)
         self._maybe_load_config()
         self._maybe_install_update_check()
 
@@ -156,12 +239,29 @@ class Service:
         except Exception:
             pass
 
+        if self.supervisor_timer is not None:
+            self.supervisor_timer.stop()
+            self.supervisor_timer = None
+
+        if self.config_observer is not None:
+            self.config_observer.stop()
+            self.config_observer = None
+
         if self.server:
             self.server.stop()
             self.server = None
 
         IOLoop.current().stop()
 
+    def _check_supervisor(self, supervisor_pid: int):
+        if os.getppid() != supervisor_pid:
+            _LOG.warning(f'supervisor process {supervisor_pid} has gone')
+            self._on_shut_down()
+
+    def _on_signal(self, sig):
+        _LOG.warning(f'caught signal {sig}')
+        self._on_shut_down()
+
     # noinspection PyUnusedLocal
     def _sig_handler(self, sig, frame):
         _LOG.warning(f'caught signal {sig}')
@@ -170,35 +270,88 @@ class Service:
     def _maybe_install_update_check(self):
         if self.update_period is None or self.update_period <= 0:
             return
-        IOLoop.current().call_later(self.update_period, self._maybe_check_for_updates)
+        update_period = self.update_period
+        if self.config_observer is not None or self._maybe_install_config_observer():
+            update_period = max(update_period, _OBSERVED_CONFIG_CHECK_PERIOD)
+        IOLoop.current().call_later(update_period, self._maybe_check_for_updates)
+
+    def _maybe_install_config_observer(self) -> bool:
+        """
+        If the optional "watchdog" package is installed, let the OS notify us about changes of the
+        configuration file (inotify, FSEvents, etc.), so it can be polled much less frequently than
+        every *update_period* seconds.
+
+        :return: True, if the observer has been installed
+        """
+        if watchdog is None:
+            return False
+        config_file = self.config_file or DEFAULT_CONFIG_FILE
+        config_dir = os.path.dirname(config_file)
+        if not os.path.isdir(config_dir):
+            return False
+        io_loop = IOLoop.current()
+        # Directories are observed, so we also notice editors that replace the file
+        observer = watchdog.observers.Observer()
+        observer.daemon = True
+        observer.schedule(_ConfigFileEventHandler(config_file, lambda: io_loop.add_callback(self._check_for_updates)),
+                          config_dir)
+        try:
+            observer.start()
+        except OSError as e:
+            # E.g. the number of inotify watches is exhausted
+            _LOG.warning(f'cannot observe configuration file {config_file!r}, polling instead: {e}')
+            return False
+        self.config_observer = observer
+        return True
+
+    def _check_for_updates(self):
+        io_loop = IOLoop.current()
+        future = io_loop.run_in_executor(None, self._maybe_load_config)
+        io_loop.add_future(future, lambda f: f.result())
 
     def _maybe_check_for_updates(self):
-        self._maybe_load_config()
-        self._maybe_install_update_check()
+        # Checking and loading the configuration may block on slow file systems,
+        # so do it off the IOLoop thread and schedule the next check once it is done.
+        io_loop = IOLoop.current()
+        future = io_loop.run_in_executor(None, self._maybe_load_config)
+        io_loop.add_future(future, self._on_updates_checked)
+
+    def _on_updates_checked(self, future):
+        try:
+            future.result()
+        finally:
+            self._maybe_install_update_check()
 
     def _maybe_load_config(self):
+        with self._config_lock:
+            self._maybe_load_config_locked()
+
+    def _maybe_load_config_locked(self):
         config_file = self.config_file
         if config_file is None:
             config_file = DEFAULT_CONFIG_FILE
         try:
-            stat = os.stat(config_file)
-        except OSError as e:
+            # Resolve the path only once and check the very file we are going to read
+            with open(config_file, 'rb') as stream:
+                stat = os.fstat(stream.fileno())
+                # Integer nanoseconds can be compared safely, the size catches changes within the timestamp resolution
+                config_stat = stat.st_mtime_ns, stat.st_size
+                if self.config_stat == config_stat:
+                    return
+                self.config_stat = config_stat
+                config_data = stream.read()
+            if config_data == self.config_data:
+                # Touched or saved without changes, no need to parse and update the context
+                self.config_error = None
+                return
+            self.context.config = yaml.load(config_data, Loader=_YAML_LOADER)
+            self.config_data = config_data
+            self.config_error = None
+            _LOG.info(f'configuration file {config_file!r} successfully loaded')
+        except (yaml.YAMLError, OSError) as e:
             if self.config_error is None:
                 _LOG.error(f'configuration file {config_file!r}: {e}')
                 self.config_error = e
-            return
-        if self.config_mtime != stat.st_mtime:
-            self.config_mtime = stat.st_mtime
-            try:
-                with open(config_file) as stream:
-                    self.context.config = yaml.safe_load(stream)
-                self.config_error = None
-                _LOG.info(f'configuration file {config_file!r} successfully loaded')
-            except (yaml.YAMLError, OSError) as e:
-                if self.config_error is None:
-                    _LOG.error(f'configuration file {config_file!r}: {e}')
-                    self.config_error = e
-                return
 
 
 # noinspection PyAbstractClass
@@ -207,10 +360,12 @@ class ServiceRequestHandler(RequestHandler):
     def __init__(self, application, request, **kwargs):
         super().__init__(application, request, **kwargs)
         self._params = ServiceRequestParams(self)
+        # Handlers are instantiated per request, the service context of an application never changes
+        self._service_context = application.service_context
 
     @property
     def service_context(self) -> ServiceContext:
-        return self.application.service_context
+        return self._service_context
 
     @property
     def base_url(self):
@@ -236,39 +391,26 @@ class ServiceRequestHandler(RequestHandler):
         except (JSONDecodeError, TypeError, ValueError) as e:
             raise ServiceBadRequestError(f"Invalid or missing {name} in request body") from e
 
-    def on_finish(self):
-        """
-        Store time of last activity so we can measure time of inactivity and then optionally auto-exit.
-        """
-        self.application.time_of_last_activity = time.process_time()
-
     def write_error(self, status_code, **kwargs):
         self.set_header('Content-Type', 'application/json')
+        error = {
+            'code': status_code,
+            'message': self._reason,
+        }
         # if self.settings.get("serve_traceback") and "exc_info" in kwargs:
-        if "exc_info" in kwargs:
-            # in debug mode, try to send a traceback
-            lines = []
-            for line in traceback.format_exception(*kwargs["exc_info"]):
-                lines.append(line)
-            self.finish(json.dumps({
-                'error': {
-                    'code': status_code,
-                    'message': self._reason,
-                    'traceback': lines,
-                }
-            }, indent=2))
-        else:
-            self.finish(json.dumps({
-                'error': {
-                    'code': status_code,
-                    'message': self._reason,
-                }
-            }, indent=2))
+        # Client errors (bad tile coordinates, malformed queries) are frequent and expected,
+        # their tracebacks would only point to the place where the request has been rejected.
+        if "exc_info" in kwargs and (status_code >= 500 or self.settings.get('debug')):
+            # in debug mode, try to send a traceback,
+            # the innermost frames locate the error, the outer ones are Tornado and asyncio internals
+            error['traceback'] = traceback.format_exception(*kwargs["exc_info"], limit=-_MAX_TRACEBACK_FRAMES)
+        self.finish(json.dumps({'error': error}, indent=2 if self.settings.get('debug') else None))
 
 
 class ServiceRequestParams(RequestParams):
     def __init__(self, handler: RequestHandler):
         self.handler = handler
+        self._query_arguments = None
 
     def get_query_argument(self, name: str, default: Optional[str] = UNDEFINED) -> Optional[str]:
         """
@@ -278,14 +420,36 @@ class ServiceRequestParams(RequestParams):
         :return: the value or none
         :raise: ServiceBadRequestError
         """
-        value = self.handler.get_query_argument(name, default=default)
+        query_arguments = self._query_arguments
+        if query_arguments is None:
+            # Handlers ask for many (mostly absent) arguments, so decode the given ones once
+            # and answer all lookups from a plain dict.
+            query_arguments = {query_name: self.handler.get_query_argument(query_name)
+                               for query_name in self.handler.request.query_arguments}
+            self._query_arguments = query_arguments
+        value = query_arguments.get(name, default)
         if value is UNDEFINED:
             raise ServiceBadRequestError(f'Missing query parameter "{name}"')
         return value
 
 
+class _ConfigFileEventHandler:
+    """
+    A watchdog event handler that calls *callback* for any event concerning *config_file*.
+    Called from the observer's thread.
+    """
+
+    def __init__(self, config_file: str, callback):
+        self._config_file = config_file
+        self._callback = callback
+
+    def dispatch(self, event):
+        if self._config_file in (event.src_path, getattr(event, 'dest_path', None)):
+            self._callback()
+
+
 # noinspection PyAbstractClass
-class _GlobalEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+class _GlobalEventLoopPolicy(uvloop.EventLoopPolicy if uvloop is not None else asyncio.DefaultEventLoopPolicy):
     """
     Event loop policy that has one fixed global loop for all threads.
 
@@ -310,6 +474,7 @@ class _GlobalEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
         return self._global_loop
 
 
+@functools.lru_cache(maxsize=256)
 def url_pattern(pattern: str):
     """
     Convert a string *pattern* where any occurrences of ``{{NAME}}`` are replaced by an equivalent
@@ -328,25 +493,16 @@ def url_pattern(pattern: str):
     :return: equivalent regex pattern
     :raise ValueError: if *pattern* is invalid
     """
-    name_pattern = '(?P<%s>[^\;\/\?\:\@\&\=\+\$\,]+)'
-    reg_expr = ''
-    pos = 0
-    while True:
-        pos1 = pattern.find('{{', pos)
-        if pos1 >= 0:
-            pos2 = pattern.find('}}', pos1 + 2)
-            if pos2 > pos1:
-                name = pattern[pos1 + 2:pos2]
-                if not name.isidentifier():
-                    raise ValueError('name in {{name}} must be a valid identifier, but got "%s"' % name)
-                reg_expr += pattern[pos:pos1] + (name_pattern % name)
-                pos = pos2 + 2
-            else:
-                raise ValueError('no matching "}}" after "{{" in "%s"' % pattern)
 
-        else:
-            reg_expr += pattern[pos:]
-            break
+    def replace_name(match) -> str:
+        name = match.group(1)
+        if not name.isidentifier():
+            raise ValueError('name in {{name}} must be a valid identifier, but got "%s"' % name)
+        return _URL_NAME_PATTERN % name
+
+    reg_expr = _URL_PLACEHOLDER_RE.sub(replace_name, pattern)
+    if '{{' in reg_expr:
+        raise ValueError('no matching "}}" after "{{" in "%s"' % pattern)
     return reg_expr
 
 
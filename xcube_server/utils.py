@@ -24,29 +24,32 @@ def get_dataset_bounds(dataset: Union[xr.Dataset, xr.DataArray]) -> Bounds:
     if lat_var is None:
         raise ValueError('Missing coordinate variable "lat"')
 
+    # Work on the raw coordinate arrays, indexing DataArrays would create a new DataArray for every element
     lon_bnds_name = lon_var.attrs["bounds"] if "bounds" in lon_var.attrs else "lon_bnds"
     if lon_bnds_name in dataset.coords:
-        lon_bnds_var = dataset.coords[lon_bnds_name]
-        lon_min = lon_bnds_var[0][0]
-        lon_max = lon_bnds_var[-1][1]
+        lon_bnds = dataset.coords[lon_bnds_name].values
+        lon_min = lon_bnds[0, 0]
+        lon_max = lon_bnds[-1, 1]
     else:
-        lon_min = lon_var[0]
-        lon_max = lon_var[-1]
-        delta = min(abs(np.diff(lon_var)))
+        lon = lon_var.values
+        lon_min = lon[0]
+        lon_max = lon[-1]
+        delta = np.min(np.abs(np.diff(lon)))
         lon_min -= 0.5 * delta
         lon_max += 0.5 * delta
 
     lat_bnds_name = lat_var.attrs["bounds"] if "bounds" in lat_var.attrs else "lat_bnds"
     if lat_bnds_name in dataset.coords:
-        lat_bnds_var = dataset.coords[lat_bnds_name]
-        lat1 = lat_bnds_var[0][0]
-        lat2 = lat_bnds_var[-1][1]
+        lat_bnds = dataset.coords[lat_bnds_name].values
+        lat1 = lat_bnds[0, 0]
+        lat2 = lat_bnds[-1, 1]
         lat_min = min(lat1, lat2)
         lat_max = max(lat1, lat2)
     else:
-        lat1 = lat_var[0]
-        lat2 = lat_var[-1]
-        delta = min(abs(np.diff(lat_var)))
+        lat = lat_var.values
+        lat1 = lat[0]
+        lat2 = lat[-1]
+        delta = np.min(np.abs(np.diff(lat)))
         lat_min = min(lat1, lat2) - 0.5 * delta
         lat_max = max(lat1, lat2) + 0.5 * delta
 